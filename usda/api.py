@@ -0,0 +1,234 @@
+import json
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.views.decorators.csrf import csrf_exempt
+
+from usda import documents, jobs, query, registry, similarity
+from usda import search as search_index
+from usda.caching import versioned_page
+from usda.models import Food, ImportJob
+from usda.nutrition import food_nutrition
+from usda.recipes import RecipeError, aggregate_many
+
+# Read only JSON views. All of them take an optional fields parameter, a
+# comma separated subset of FIELDS, to keep the responses small.
+
+FIELDS = ( 'long_desc', 'short_desc', 'common_name', 'food_group', 'refuse_percent', 'weights', 'nutrients' )
+BATCH_LIMIT = getattr( settings, 'USDA_API_BATCH_LIMIT', 100 )
+SEARCH_LIMIT = 100
+MEAL_LIMIT = getattr( settings, 'USDA_API_MEAL_LIMIT', 10000 )
+
+class ApiError( ValueError ):
+	pass
+
+def error( message, status=400 ):
+	return JsonResponse( { 'error' : message }, status=status )
+
+def split( value ):
+	return [ v.strip() for v in value.split( ',' ) if v.strip() ]
+
+def get_fields( params ):
+	# From the QueryDict of the request, GET or POST.
+	fields = split( params.get( 'fields', '' ) ) or FIELDS
+	unknown = set( fields ) - set( FIELDS )
+	if unknown:
+		raise ApiError( 'Unknown fields %s, use some of %s' % ( ', '.join( sorted( unknown ) ), ', '.join( FIELDS ) ) )
+	return fields
+
+def get_daily_amounts( name ):
+	# The daily value profile picked with ?dv=<name>, None for the default.
+	if not name:
+		return None
+	try:
+		return registry.daily_value_profile( name )
+	except KeyError:
+		raise ApiError( 'Unknown daily value profile %s, use one of %s' % ( name, ', '.join( registry.daily_value_profiles() ) ) )
+
+def number( value ):
+	return float( value ) if value is not None else None
+
+def food_data( food, nutrition, fields ):
+	data = { 'nbd_no' : food.nbd_no }
+	groups = registry.food_groups()
+	for f in fields:
+		if f == 'food_group':
+			group = groups.get( food.food_group_id )
+			data[ f ] = { 'code' : food.food_group_id, 'name' : group.name if group else None }
+		elif f == 'weights':
+			data[ f ] = [ { 'sequence' : w.sequence, 'amount' : number( w.amount ), 'description' : w.description,
+					'grams' : number( w.weight ) } for w in nutrition.weights ]
+		elif f == 'nutrients':
+			nutrients = []
+			for n, definition, amounts, daily_values in nutrition.rows():
+				d = { 'code' : definition.code, 'name' : definition.name, 'units' : definition.units,
+						'amount' : amounts[0], 'daily_value' : daily_values[0] }
+				if 'weights' in fields:
+					d[ 'servings' ] = [ { 'amount' : a, 'daily_value' : dv } for a, dv in zip( amounts[1:], daily_values[1:] ) ]
+				nutrients.append( d )
+			data[ f ] = nutrients
+		else:
+			data[ f ] = getattr( food, f )
+	return data
+
+def document_data( document, fields, daily_amounts=None ):
+	# food_data of a food from its precomputed document.
+	data = { 'nbd_no' : document[ 'nbd_no' ] }
+	for f in fields:
+		if f == 'weights':
+			data[ f ] = [ { 'sequence' : w.sequence, 'amount' : w.amount, 'description' : w.description, 'grams' : w.weight }
+					for w in documents.weight_entries( document ) ]
+		elif f == 'nutrients':
+			nutrients = []
+			for n in documents.nutrient_entries( document, daily_amounts=daily_amounts ):
+				d = { 'code' : n.code, 'name' : n.definition.name, 'units' : n.definition.units,
+						'amount' : n.servings[0][0], 'daily_value' : n.servings[0][1] }
+				if 'weights' in fields:
+					d[ 'servings' ] = [ { 'amount' : a, 'daily_value' : dv } for a, dv in n.servings[1:] ]
+				d[ 'footnotes' ] = n.footnotes
+				d[ 'sources' ] = n.sources
+				nutrients.append( d )
+			data[ f ] = nutrients
+		else:
+			data[ f ] = document[ f ]
+	return data
+
+@versioned_page
+def food( request, pk ):
+	try:
+		fields = get_fields( request.GET )
+		daily_amounts = get_daily_amounts( request.GET.get( 'dv' ) )
+	except ApiError as e:
+		return error( str( e ) )
+	document = documents.get_document( pk )
+	if document is None:
+		raise Http404( 'No food %s' % pk )
+	return JsonResponse( document_data( document, fields, daily_amounts ) )
+
+@versioned_page
+def search( request ):
+	text = request.GET.get( 'q', '' )
+	groups = split( request.GET.get( 'food_group', '' ) )
+	try:
+		limit = min( int( request.GET.get( 'limit', SEARCH_LIMIT ) ), SEARCH_LIMIT )
+	except ValueError:
+		return error( 'limit must be a number' )
+	ids = search_index.search( text, groups, limit )
+	foods = Food.objects.in_bulk( ids )
+	results = [ { 'nbd_no' : i, 'long_desc' : foods[ i ].long_desc, 'short_desc' : foods[ i ].short_desc,
+			'food_group' : foods[ i ].food_group_id } for i in ids if i in foods ]
+	return JsonResponse( { 'query' : text, 'results' : results } )
+
+@versioned_page
+def similar( request, pk ):
+	# ?k=10&metric=cosine&food_group=0100&where=203 > 10&less=307
+	try:
+		k = min( int( request.GET.get( 'k', 10 ) ), SEARCH_LIMIT )
+	except ValueError:
+		return error( 'k must be a number' )
+	try:
+		results = similarity.similar( pk, k, request.GET.get( 'metric', 'cosine' ),
+				food_groups=split( request.GET.get( 'food_group', '' ) ),
+				constraints=query.parse_predicates( request.GET.get( 'where', '' ) ),
+				less=split( request.GET.get( 'less', '' ) ),
+				more=split( request.GET.get( 'more', '' ) ) )
+	except ( similarity.SimilarityError, query.QueryError ) as e:
+		return error( str( e ) )
+	foods = Food.objects.in_bulk( [ r[0] for r in results ] )
+	return JsonResponse( { 'nbd_no' : pk, 'results' : [ { 'nbd_no' : i, 'short_desc' : foods[ i ].short_desc, 'score' : score }
+			for i, score in results if i in foods ] } )
+
+def batch( request ):
+	# Up to BATCH_LIMIT foods given as ?nbd_no=01001,01009 with only the
+	# nutrients given as ?nutrients=203,307 if any, and the %DV of the
+	# profile given as ?dv=fda-2020 if any. The foods, nutrients and
+	# weights are fetched with one query each and written out one food at a
+	# time. A POST of the same parameters needs the CSRF token.
+	params = request.POST if request.method == 'POST' else request.GET
+	ids = split( params.get( 'nbd_no', '' ) )
+	codes = split( params.get( 'nutrients', '' ) ) or None
+	if not ids:
+		return error( 'Give the foods as nbd_no=01001,01009' )
+	if len( ids ) > BATCH_LIMIT:
+		return error( 'At most %d foods can be requested at once' % BATCH_LIMIT )
+	try:
+		fields = get_fields( params )
+		daily_amounts = get_daily_amounts( params.get( 'dv' ) )
+	except ApiError as e:
+		return error( str( e ) )
+	if codes:
+		unknown = set( codes ) - set( registry.nutrient_definitions() )
+		if unknown:
+			return error( 'Unknown nutrients %s' % ', '.join( sorted( unknown ) ) )
+
+	foods = Food.objects.in_bulk( ids )
+	if 'nutrients' in fields or 'weights' in fields:
+		nutrition = food_nutrition( [ i for i in ids if i in foods ], codes, daily_amounts )
+	else:
+		nutrition = {}
+
+	def stream():
+		yield '{"foods": ['
+		first = True
+		for i in ids:
+			if i not in foods:
+				continue
+			yield ( '' if first else ',' ) + json.dumps( food_data( foods[ i ], nutrition.get( i ), fields ) )
+			first = False
+		yield '], "missing": %s}' % json.dumps( [ i for i in ids if i not in foods ] )
+	return StreamingHttpResponse( stream(), content_type='application/json' )
+
+@csrf_exempt
+def recipes( request ):
+	# POST { "meals" : [ [ [ "01001", "1" ], [ "09003", 150 ] ], ... ] } with
+	# the ingredients of each meal as in usda.recipes, or { "ingredients" :
+	# [ ... ] } for a single recipe.
+	if request.method != 'POST':
+		return error( 'POST the meals as JSON', status=405 )
+	try:
+		data = json.loads( request.body.decode( 'utf-8' ) )
+		meals = data[ 'meals' ] if 'meals' in data else [ data[ 'ingredients' ] ]
+	except ( ValueError, KeyError, TypeError ):
+		return error( 'Give the meals as { "meals" : [ [ [ nbd_no, sequence or grams ], ... ], ... ] }' )
+	if len( meals ) > MEAL_LIMIT:
+		return error( 'At most %d meals can be totalled at once' % MEAL_LIMIT )
+	try:
+		results = aggregate_many( meals )
+	except RecipeError as e:
+		return error( str( e ) )
+	return JsonResponse( { 'meals' : [ m.as_dict() for m in results ] } )
+
+def staff_only( request ):
+	user = getattr( request, 'user', None )
+	if not ( user is not None and user.is_staff ):
+		raise Http404( 'No imports here' )
+
+@transaction.non_atomic_requests
+def imports( request ):
+	# GET lists the latest imports, POST file=sr27.zip&loader=copy starts
+	# one of the zips in USDA_IMPORT_DIR. Staff only, and the POST needs the
+	# CSRF token like any other form of the site. Not atomic with
+	# ATOMIC_REQUESTS, the job has to be committed before its thread runs.
+	staff_only( request )
+	if request.method != 'POST':
+		return JsonResponse( { 'imports' : [ job.progress() for job in jobs.jobs() ] } )
+	directory = getattr( settings, 'USDA_IMPORT_DIR', None )
+	if not directory:
+		return error( 'Set USDA_IMPORT_DIR to the directory of the SR27 zips', status=503 )
+	path = os.path.join( directory, os.path.basename( request.POST.get( 'file', '' ) ) )
+	if not os.path.isfile( path ):
+		return error( 'Give one of the zips in USDA_IMPORT_DIR as file' )
+	try:
+		job = jobs.start( path, request.POST.get( 'loader', 'executemany' ) )
+	except ValueError as e:
+		return error( str( e ), status=409 if isinstance( e, jobs.JobError ) else 400 )
+	return JsonResponse( job.progress(), status=202 )
+
+def import_job( request, pk ):
+	staff_only( request )
+	try:
+		return JsonResponse( ImportJob.objects.get( pk=pk ).progress() )
+	except ImportJob.DoesNotExist:
+		raise Http404( 'No import %s' % pk )
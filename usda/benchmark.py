@@ -0,0 +1,108 @@
+import random
+import time
+import zipfile
+
+# Synthetic SR27 release files for benchmarking the importer, and the
+# timers bench_sr27 threads through its import pipeline.
+#
+# Scale 1 has about the row counts of the real SR27 release. Larger scales
+# multiply the foods until the five digit nbd_no runs out and then the
+# nutrients per food, up to the 999 three digit nutrient codes.
+
+FOODS = 8800
+NUTRIENTS_PER_FOOD = 77
+NUTRIENT_DEFINITIONS = 150
+FOOD_GROUPS = 25
+DERIVATIONS = 55
+DATA_TYPES = 10
+LANGUAL_DESCRIPTIONS = 775
+LANGUAL_PER_FOOD = 4
+WEIGHTS_PER_FOOD = 2
+FOOTNOTE_EVERY = 16
+DATA_SOURCES = 680
+LINKS_PER_FOOD = 21
+
+MAX_FOODS = 99999
+MAX_NUTRIENT_DEFINITIONS = 999
+
+WORDS = ( 'cheese', 'butter', 'milk', 'raw', 'cooked', 'boiled', 'salted', 'with', 'without', 'skin', 'beef', 'chicken',
+		'apple', 'bread', 'whole', 'wheat', 'frozen', 'canned', 'drained', 'fat', 'lean', 'only', 'roasted', 'dry' )
+
+def text( rng, words ):
+	return ' '.join( rng.choice( WORDS ) for i in range( words ) )
+
+def line( *values ):
+	# SR27 quotes text with ~ and separates fields with ^.
+	return '^'.join( '~%s~' % v if isinstance( v, str ) else ( '' if v is None else str( v ) ) for v in values ) + '\r\n'
+
+def sizes( scale ):
+	foods = min( max( int( FOODS * scale ), 1 ), MAX_FOODS )
+	per_food = max( int( round( NUTRIENTS_PER_FOOD * FOODS * scale / foods ) ), 1 )
+	definitions = min( max( NUTRIENT_DEFINITIONS, per_food ), MAX_NUTRIENT_DEFINITIONS )
+	return foods, min( per_food, definitions ), definitions
+
+def write_zip( path, scale=1, seed=27 ):
+	# Writes a release zip with consistent references and returns the
+	# number of rows of every file in it.
+	rng = random.Random( seed )
+	foods, per_food, definitions = sizes( scale )
+	food_ids = [ '%05d' % ( i + 1 ) for i in range( foods ) ]
+	groups = [ '%02d00' % ( i + 1 ) for i in range( FOOD_GROUPS ) ]
+	codes = [ '%03d' % ( i + 1 ) for i in range( definitions ) ]
+	derivations = [ 'D%03d' % i for i in range( DERIVATIONS ) ]
+	types = [ '%d' % i for i in range( DATA_TYPES ) ]
+	factors = [ 'A%04d' % i for i in range( LANGUAL_DESCRIPTIONS ) ]
+	sources = [ 'S%05d' % i for i in range( DATA_SOURCES ) ]
+	counts = {}
+
+	with zipfile.ZipFile( path, 'w', zipfile.ZIP_DEFLATED ) as z:
+		def add( name, rows ):
+			count = 0
+			with z.open( name, 'w' ) as f:
+				for row in rows:
+					f.write( line( *row ).encode( 'ISO-8859-1' ) )
+					count += 1
+			counts[ name ] = count
+
+		add( 'FD_GROUP.txt', ( ( g, text( rng, 3 ) ) for g in groups ) )
+		add( 'NUTR_DEF.txt', ( ( c, rng.choice( ( 'g', 'mg', 'µg', 'IU', 'kcal' ) ), 'T%s' % c, text( rng, 2 ), '%d' % rng.randint( 0, 3 ), i * 10 )
+				for i, c in enumerate( codes ) ) )
+		add( 'DERIV_CD.txt', ( ( d, text( rng, 6 ) ) for d in derivations ) )
+		add( 'LANGDESC.txt', ( ( f, text( rng, 4 ) ) for f in factors ) )
+		add( 'FOOD_DES.txt', ( ( f, rng.choice( groups ), text( rng, 8 ), text( rng, 4 )[ :60 ].upper(), '', '', rng.choice( ( 'Y', '' ) ),
+				'', rng.randint( 0, 60 ), '', 6.38, 4.27, 8.79, 3.87 ) for f in food_ids ) )
+		add( 'SRC_CD.txt', ( ( t, text( rng, 5 ) ) for t in types ) )
+		add( 'LANGUAL.txt', ( ( f, factor ) for f in food_ids for factor in rng.sample( factors, LANGUAL_PER_FOOD ) ) )
+		add( 'NUT_DATA.txt', ( ( f, c, round( rng.random() * 100, 3 ), rng.randint( 0, 20 ), None, rng.choice( types ), rng.choice( derivations ),
+				'', '', None, None, None, None, None, None, '', '%02d/%d' % ( rng.randint( 1, 12 ), rng.randint( 1990, 2014 ) ), '' )
+				for f in food_ids for c in sorted( rng.sample( codes, per_food ) ) ) )
+		add( 'WEIGHT.txt', ( ( f, '%d' % ( s + 1 ), 1, text( rng, 2 ), round( rng.random() * 300, 1 ), None, None )
+				for f in food_ids for s in range( WEIGHTS_PER_FOOD ) ) )
+		add( 'FOOTNOTE.txt', ( ( f, '01', 'N', rng.choice( codes ), text( rng, 10 ) ) for f in food_ids[ ::FOOTNOTE_EVERY ] ) )
+		add( 'DATA_SRC.txt', ( ( s, text( rng, 3 ), text( rng, 8 ), '2001', text( rng, 2 ), '', '', '1', '9' ) for s in sources ) )
+		add( 'DATSRCLN.txt', ( ( f, c, rng.choice( sources ) ) for f in food_ids for c in sorted( rng.sample( codes, min( LINKS_PER_FOOD, per_food ) ) ) ) )
+	return counts
+
+class Timer( object ):
+	# Accumulates the time spent producing the items of an iterator. The
+	# time of the stages feeding it is included, exclusive() takes it out.
+	def __init__( self, iterable, inner=None ):
+		self.iterable = iter( iterable )
+		self.inner = inner
+		self.seconds = 0.0
+		self.count = 0
+
+	def __iter__( self ):
+		return self
+
+	def __next__( self ):
+		start = time.perf_counter()
+		try:
+			item = next( self.iterable )
+		finally:
+			self.seconds += time.perf_counter() - start
+		self.count += 1
+		return item
+
+	def exclusive( self ):
+		return self.seconds - ( self.inner.seconds if self.inner else 0.0 )
@@ -0,0 +1,110 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import condition
+
+from usda.instrumentation import timer
+from usda.models import DatasetVersion
+
+# SR27 only changes with an import, so pages are cached for as long as the
+# dataset version they were rendered from is current. Every key includes
+# that version and bump_version() moves to a new one, so nothing has to be
+# deleted and nothing stale is ever served. The version itself is only
+# trusted for VERSION_TTL seconds and then read again from DatasetVersion,
+# so that a bump made by another process reaches every worker even when
+# each of them has a cache of its own, as with the default LocMemCache.
+#
+# Only pages that are the same for everyone are cached : none for signed
+# in users, and none that show messages of the messages framework.
+
+VERSION_KEY = 'usda:dataset-version'
+VERSION_TTL = getattr( settings, 'USDA_VERSION_TTL', 5 )
+PAGE_TIMEOUT = 24 * 60 * 60
+
+def get_version():
+	# ( version, modified ) of the data, from the cache so that conditional
+	# GETs can be answered without touching the database.
+	stamp = cache.get( VERSION_KEY )
+	if stamp is None:
+		try:
+			v = DatasetVersion.objects.get( pk=1 )
+			stamp = ( v.version, v.modified )
+		except DatasetVersion.DoesNotExist:
+			stamp = ( 0, None )
+		cache.set( VERSION_KEY, stamp, VERSION_TTL )
+	return stamp
+
+def bump_version():
+	with transaction.atomic():
+		v, created = DatasetVersion.objects.select_for_update().get_or_create( pk=1 )
+		v.version += 1
+		v.modified = timezone.now()
+		v.save()
+	cache.set( VERSION_KEY, ( v.version, v.modified ), VERSION_TTL )
+	return v.version
+
+def versioned_key( prefix, key ):
+	return 'usda:%s:%d:%s' % ( prefix, get_version()[0], hashlib.md5( key.encode( 'utf-8' ) ).hexdigest() )
+
+def page_etag( request, *args, **kwargs ):
+	return hashlib.md5( ( '%d:%s' % ( get_version()[0], request.get_full_path() ) ).encode( 'utf-8' ) ).hexdigest()
+
+def page_modified( request, *args, **kwargs ):
+	return get_version()[1]
+
+def cacheable( request ):
+	# Whether the page is the same for everyone : no signed in user and no
+	# messages waiting to be shown, or shown while rendering it.
+	user = getattr( request, 'user', None )
+	if user is not None and user.is_authenticated():
+		return False
+	messages = getattr( request, '_messages', None )
+	return messages is None or not len( messages )
+
+def versioned_page( view ):
+	# Serves the page rendered for the same path from the cache, and lets
+	# clients revalidate with ETag / If-Modified-Since. The validators only
+	# depend on the version and the path, so pages that are not the same
+	# for everyone get neither.
+	def cached_view( request, *args, **kwargs ):
+		key = versioned_key( 'page', request.get_full_path() )
+		cached = cache.get( key )
+		if cached is not None:
+			request.usda_cache = 'hit'
+			content, content_type = cached
+			return HttpResponse( content, content_type=content_type )
+		request.usda_cache = 'miss'
+		response = view( request, *args, **kwargs )
+		if hasattr( response, 'render' ):
+			with timer( request, 'render' ):
+				response.render()
+		if response.status_code == 200 and not response.streaming and cacheable( request ):
+			cache.set( key, ( response.content, response[ 'Content-Type' ] ), PAGE_TIMEOUT )
+		return response
+	conditional_view = condition( etag_func=page_etag, last_modified_func=page_modified )( cached_view )
+
+	@wraps( view )
+	def page_view( request, *args, **kwargs ):
+		if request.method not in ( 'GET', 'HEAD' ):
+			return view( request, *args, **kwargs )
+		if not cacheable( request ):
+			request.usda_cache = 'bypass'
+			return view( request, *args, **kwargs )
+		response = conditional_view( request, *args, **kwargs )
+		if cacheable( request ):
+			# The session cookie is what makes a page per user.
+			patch_vary_headers( response, ( 'Cookie', ) )
+		else:
+			# Messages shown while rendering : not the page others get.
+			request.usda_cache = 'bypass'
+			for header in ( 'ETag', 'Last-Modified' ):
+				if response.has_header( header ):
+					del response[ header ]
+		return response
+	return page_view
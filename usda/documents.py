@@ -0,0 +1,165 @@
+from collections import namedtuple
+import json
+import zlib
+
+from django.apps import apps as live_apps
+from django.db import connection, transaction
+
+from usda import fanout
+from usda.models import FoodGroup, NutrientDefinition, FoodDocument
+from usda.nutrition import FoodNutrition, chunks, round_half_up
+from usda.registry import food_groups, nutrient_definitions, read_table
+
+# What the food page and api/food/ show of a food only changes with an
+# import, so it is computed once per food and stored in FoodDocument, and
+# serving a food is a single primary key lookup. A document is a JSON
+# object with the Food columns of FOOD_FIELDS, food_group as { code, name },
+# weights as [ sequence, amount, description, grams ] lists, langual as
+# [ code, description ] lists and nutrients, in sr_order, as lists of
+# NUTRIENT_FIELDS. servings holds [ amount, %DV ] for 100g followed by each
+# weight, so that load_daily can redo the %DV from per_100g alone. Names
+# and units of the nutrients come from the registry when it is shown.
+
+FOOD_FIELDS = ( 'nbd_no', 'long_desc', 'short_desc', 'common_name', 'manufacturer_name', 'survey',
+		'refuse_desc', 'refuse_percent', 'scientific_name' )
+NUTRIENT_FIELDS = ( 'code', 'per_100g', 'added_nutrition', 'servings', 'footnotes', 'sources' )
+
+Weight = namedtuple( 'Weight', ( 'sequence', 'amount', 'description', 'weight' ) )
+
+# A nutrient of a document with its NutrientDefinition registry entry.
+NutrientEntry = namedtuple( 'NutrientEntry', NUTRIENT_FIELDS + ( 'definition', ) )
+
+def encode( document ):
+	return zlib.compress( json.dumps( document, separators=( ',', ':' ) ).encode( 'utf-8' ) )
+
+def decode( data ):
+	return json.loads( zlib.decompress( bytes( data ) ).decode( 'utf-8' ) )
+
+def number( value ):
+	return float( value ) if value is not None else None
+
+def daily_value( per_100g, grams, daily_amount ):
+	# As NutritionMatrix computes it.
+	if not daily_amount:
+		return None
+	return round_half_up( per_100g * ( grams / 100 ) / float( daily_amount ) * 100, 1 )
+
+def build_documents( food_ids, apps=live_apps ):
+	# The documents of the given foods keyed by nbd_no, from one query per
+	# table for each chunk of foods. They come from the tables of apps, the
+	# live ones or the shadow ones of an import, which the registry does
+	# not hold.
+	if apps is live_apps:
+		definitions, groups = nutrient_definitions(), food_groups()
+	else:
+		definitions, groups = read_table( NutrientDefinition, apps ), read_table( FoodGroup, apps )
+	Food, GramWeight, LanguaLFactor, Nutrient, Footnote, DataSourceLink = [ apps.get_model( 'usda', name ) for name in
+			( 'Food', 'GramWeight', 'LanguaLFactor', 'Nutrient', 'Footnote', 'DataSourceLink' ) ]
+	documents = {}
+	for ids in chunks( food_ids ):
+		results = fanout.fetch(
+			foods=lambda: list( Food.objects.filter( nbd_no__in=ids ).values_list( 'food_group', *FOOD_FIELDS ) ),
+			weights=lambda: list( GramWeight.objects.filter( food__in=ids ).order_by( 'food', 'sequence' )
+					.values_list( 'food', 'sequence', 'amount', 'description', 'weight' ) ),
+			langual=lambda: list( LanguaLFactor.objects.filter( food__in=ids ).order_by( 'food', 'factor' )
+					.values_list( 'food', 'factor', 'factor__description' ) ),
+			nutrients=lambda: Nutrient.objects.filter( food__in=ids ).lean(),
+			footnotes=lambda: list( Footnote.objects.filter( food__in=ids, nutrient_definition__isnull=False ).order_by( 'id' )
+					.values_list( 'food', 'nutrient_definition', 'text' ) ),
+			sources=lambda: list( DataSourceLink.objects.filter( food__in=ids ).order_by( 'id' )
+					.values_list( 'food', 'nutrient_definition', 'data_source__title' ) ) )
+		weights = {}
+		for food_id, sequence, amount, description, weight in results[ 'weights' ]:
+			weights.setdefault( food_id, [] ).append( Weight( sequence, amount, description, weight ) )
+		langual = {}
+		for food_id, code, description in results[ 'langual' ]:
+			langual.setdefault( food_id, [] ).append( [ code, description ] )
+		nutrients = {}
+		for n in results[ 'nutrients' ]:
+			nutrients.setdefault( n.food_id, [] ).append( n )
+		notes = {}
+		for food_id, code, text in results[ 'footnotes' ]:
+			notes.setdefault( ( food_id, code ), [] ).append( text )
+		sources = {}
+		for food_id, code, title in results[ 'sources' ]:
+			sources.setdefault( ( food_id, code ), [] ).append( title )
+
+		for row in results[ 'foods' ]:
+			group_id, food = row[0], dict( zip( FOOD_FIELDS, row[1:] ) )
+			group = groups.get( group_id )
+			food[ 'food_group' ] = { 'code' : group_id, 'name' : group.name if group else None }
+			food_weights = weights.get( food[ 'nbd_no' ], [] )
+			food[ 'weights' ] = [ [ w.sequence, number( w.amount ), w.description, number( w.weight ) ] for w in food_weights ]
+			food[ 'langual' ] = langual.get( food[ 'nbd_no' ], [] )
+			nutrition = FoodNutrition( food[ 'nbd_no' ], nutrients.get( food[ 'nbd_no' ], [] ), food_weights, definitions )
+			food[ 'nutrients' ] = [ [ n.nutrient_id, float( n.amount ), n.added_nutrition, [ list( v ) for v in zip( amounts, daily_values ) ],
+					notes.get( ( food[ 'nbd_no' ], n.nutrient_id ), [] ), sources.get( ( food[ 'nbd_no' ], n.nutrient_id ), [] ) ]
+					for n, definition, amounts, daily_values in nutrition.rows() ]
+			documents[ food[ 'nbd_no' ] ] = food
+	return documents
+
+def rebuild_documents( apps=live_apps ):
+	# Replaces every document, returns how many there are.
+	document = apps.get_model( 'usda', 'FoodDocument' )
+	food_ids = list( apps.get_model( 'usda', 'Food' ).objects.order_by( 'nbd_no' ).values_list( 'nbd_no', flat=True ) )
+	count = 0
+	with transaction.atomic():
+		document.objects.all().delete()
+		for ids in chunks( food_ids ):
+			documents = build_documents( ids, apps )
+			document.objects.bulk_create( [ document( food_id=i, data=encode( d ) ) for i, d in documents.items() ] )
+			count += len( documents )
+	return count
+
+def update_daily_values( daily_amounts ):
+	# Redoes only the %DV of the nutrients given as { code : daily_amount }
+	# in every document that has them. Returns how many changed.
+	qn = connection.ops.quote_name
+	meta = FoodDocument._meta
+	sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % ( qn( meta.db_table ), qn( meta.get_field( 'data' ).column ), qn( meta.pk.column ) )
+	pks = list( FoodDocument.objects.order_by( 'pk' ).values_list( 'pk', flat=True ) )
+	count = 0
+	with transaction.atomic():
+		for ids in chunks( pks ):
+			changed = []
+			for pk, data in FoodDocument.objects.filter( pk__in=ids ).values_list( 'pk', 'data' ):
+				document = decode( data )
+				grams = [ 100.0 ] + [ w[3] for w in document[ 'weights' ] ]
+				found = False
+				for n in document[ 'nutrients' ]:
+					if n[0] in daily_amounts:
+						for serving, g in zip( n[3], grams ):
+							serving[1] = daily_value( n[1], g, daily_amounts[ n[0] ] )
+						found = True
+				if found:
+					changed.append( ( encode( document ), pk ) )
+			if changed:
+				connection.cursor().executemany( sql, changed )
+				count += len( changed )
+	return count
+
+def get_document( nbd_no ):
+	# The stored document, or one built from the tables until the next
+	# import has stored it. None if there is no such food.
+	try:
+		return decode( FoodDocument.objects.values_list( 'data', flat=True ).get( pk=nbd_no ) )
+	except FoodDocument.DoesNotExist:
+		return build_documents( [ nbd_no ] ).get( nbd_no )
+
+def nutrient_entries( document, definitions=None, daily_amounts=None ):
+	# With daily_amounts, a daily value profile from the registry, the %DV
+	# are those of the profile instead of the default ones stored.
+	if definitions is None:
+		definitions = nutrient_definitions()
+	if daily_amounts is not None:
+		grams = [ 100.0 ] + [ w[3] for w in document[ 'weights' ] ]
+	entries = []
+	for n in document[ 'nutrients' ]:
+		servings = n[3]
+		if daily_amounts is not None:
+			servings = [ [ s[0], daily_value( n[1], g, daily_amounts.get( n[0] ) ) ] for s, g in zip( servings, grams ) ]
+		entries.append( NutrientEntry( n[0], n[1], n[2], servings, n[4], n[5], definitions.get( n[0] ) ) )
+	return entries
+
+def weight_entries( document ):
+	return [ Weight( *w ) for w in document[ 'weights' ] ]
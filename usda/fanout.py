@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+# The food page and the food list run a few queries that don't depend on
+# each other. With the database across a network most of their time is
+# round trips, so fetch() sends them at once from a small pool of threads
+# and the page waits for the slowest query instead of all of them in turn.
+# Every thread keeps its own connection open for as long as it lives, so
+# the pool is a connection pool as well. SQLite serializes them anyway, and
+# inside a transaction the other connections would not see its writes, so
+# there they run one after the other, as with USDA_FANOUT_WORKERS below 2.
+
+WORKERS = getattr( settings, 'USDA_FANOUT_WORKERS', 4 )
+
+lock = threading.Lock()
+executor = None
+
+def enabled():
+	return WORKERS > 1 and connection.vendor != 'sqlite' and not connection.in_atomic_block
+
+def get_executor():
+	global executor
+	with lock:
+		if executor is None:
+			executor = ThreadPoolExecutor( max_workers=WORKERS )
+	return executor
+
+def call( function ):
+	# Like close_if_unusable_or_obsolete, but without closing the
+	# connections that are fine whatever CONN_MAX_AGE is.
+	if connection.connection is not None and connection.errors_occurred and not connection.is_usable():
+		connection.close()
+	return function()
+
+def fetch( **queries ):
+	# Calls each of the functions and returns their results by name.
+	if not enabled():
+		return dict( ( name, function() ) for name, function in queries.items() )
+	pool = get_executor()
+	futures = dict( ( name, pool.submit( call, function ) ) for name, function in queries.items() )
+	return dict( ( name, future.result() ) for name, future in futures.items() )
@@ -0,0 +1,253 @@
+import cProfile
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.http import JsonResponse, Http404
+from django.shortcuts import render as render_page
+from django.test.utils import CaptureQueriesContext
+
+# Timing of the usda views. instrumented( name ) wraps a view and records
+# for each request its latency, database queries and time, template render
+# time and whether versioned_page served it from the cache. They are logged
+# to usda.requests as structured fields, added to per view histograms that
+# the metrics view returns, and requests slower than
+# USDA_PROFILE_THRESHOLD seconds are written to USDA_PROFILE_DIR as cProfile
+# dumps when they were sampled, with probability USDA_PROFILE_SAMPLE.
+# Queries are counted by count_queries(), which keeps no SQL. Only with
+# DEBUG are the statements captured, for the record.usda_sql of the log.
+
+logger = logging.getLogger( 'usda.requests' )
+
+# Upper bounds of the histogram buckets in milliseconds.
+BUCKETS = ( 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000 )
+
+class Histogram( object ):
+
+	def __init__( self, buckets=BUCKETS ):
+		self.buckets = buckets
+		self.counts = [ 0 ] * ( len( buckets ) + 1 )
+		self.count = 0
+		self.sum = 0.0
+
+	def add( self, value ):
+		i = 0
+		while i < len( self.buckets ) and value > self.buckets[ i ]:
+			i += 1
+		self.counts[ i ] += 1
+		self.count += 1
+		self.sum += value
+
+	def as_dict( self ):
+		# Cumulative counts per upper bound, like Prometheus.
+		buckets = []
+		total = 0
+		for bound, count in zip( list( self.buckets ) + [ 'inf' ], self.counts ):
+			total += count
+			buckets.append( [ bound, total ] )
+		return { 'count' : self.count, 'sum' : round( self.sum, 3 ), 'buckets' : buckets }
+
+class Metrics( object ):
+	# In process totals per view, for the metrics view.
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset( self ):
+		self.views = {}
+
+	def record( self, view, fields ):
+		with self.lock:
+			stats = self.views.get( view )
+			if stats is None:
+				stats = self.views[ view ] = { 'latency_ms' : Histogram(), 'db_ms' : Histogram(), 'render_ms' : Histogram(),
+						'queries' : Histogram( ( 0, 1, 2, 5, 10, 20, 50, 100, 200 ) ), 'cache' : {}, 'status' : {} }
+			for name in ( 'latency_ms', 'db_ms', 'render_ms', 'queries' ):
+				stats[ name ].add( fields[ name ] )
+			cache = fields[ 'cache' ] or 'none'
+			stats[ 'cache' ][ cache ] = stats[ 'cache' ].get( cache, 0 ) + 1
+			status = str( fields[ 'status' ] )
+			stats[ 'status' ][ status ] = stats[ 'status' ].get( status, 0 ) + 1
+
+	def as_dict( self ):
+		with self.lock:
+			return dict( ( view, dict( ( name, value.as_dict() if isinstance( value, Histogram ) else dict( value ) )
+					for name, value in stats.items() ) ) for view, stats in self.views.items() )
+
+metrics = Metrics()
+
+class QueryCounter( object ):
+	def __init__( self ):
+		self.count = 0
+		self.seconds = 0.0
+
+	def __len__( self ):
+		return self.count
+
+	def add( self, seconds ):
+		self.count += 1
+		self.seconds += seconds
+
+class CountingCursor( object ):
+	# A cursor that adds every statement it runs and its time to a
+	# QueryCounter, without keeping the SQL as the debug cursor does.
+	def __init__( self, cursor, counter ):
+		self.cursor = cursor
+		self.counter = counter
+
+	def __getattr__( self, name ):
+		return getattr( self.cursor, name )
+
+	def __iter__( self ):
+		return iter( self.cursor )
+
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *exc_info ):
+		return self.cursor.__exit__( *exc_info )
+
+	def timed( self, method, *args ):
+		start = time.perf_counter()
+		try:
+			return method( *args )
+		finally:
+			self.counter.add( time.perf_counter() - start )
+
+	def execute( self, sql, params=None ):
+		return self.timed( self.cursor.execute, sql, params )
+
+	def executemany( self, sql, param_list ):
+		return self.timed( self.cursor.executemany, sql, param_list )
+
+@contextmanager
+def count_queries( counter=None, using=DEFAULT_DB_ALIAS ):
+	# Counts the queries of this thread's connection inside the block by
+	# wrapping the cursors it hands out. Nested blocks all count them.
+	counter = counter if counter is not None else QueryCounter()
+	wrapper = connections[ using ]
+	patched = wrapper.__dict__.get( 'cursor' )
+	cursor = wrapper.cursor
+	wrapper.cursor = lambda: CountingCursor( cursor(), counter )
+	try:
+		yield counter
+	finally:
+		if patched is None:
+			del wrapper.cursor
+		else:
+			wrapper.cursor = patched
+
+class RequestTimings( object ):
+	# Phases timed while a request is handled, see timer().
+	def __init__( self ):
+		self.phases = {}
+
+	def add( self, phase, seconds ):
+		self.phases[ phase ] = self.phases.get( phase, 0.0 ) + seconds
+
+@contextmanager
+def timer( request, phase ):
+	# Adds the time spent in the block to the phase of an instrumented request.
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		timings = getattr( request, 'usda_timings', None )
+		if timings is not None:
+			timings.add( phase, time.perf_counter() - start )
+
+def timed( phase ):
+	# Decorator for helpers taking the request first, like get_page.
+	def decorator( function ):
+		@wraps( function )
+		def timed_function( request, *args, **kwargs ):
+			with timer( request, phase ):
+				return function( request, *args, **kwargs )
+		return timed_function
+	return decorator
+
+def render( request, *args, **kwargs ):
+	# django.shortcuts.render, timed as the render phase.
+	with timer( request, 'render' ):
+		return render_page( request, *args, **kwargs )
+
+def start_profile():
+	rate = getattr( settings, 'USDA_PROFILE_SAMPLE', 0 )
+	if getattr( settings, 'USDA_PROFILE_THRESHOLD', None ) is None or not rate or random.random() >= rate:
+		return None
+	profile = cProfile.Profile()
+	try:
+		profile.enable()
+	except ValueError:
+		# Another request of this process is being profiled already.
+		return None
+	return profile
+
+def dump_profile( profile, view, latency ):
+	directory = getattr( settings, 'USDA_PROFILE_DIR', None ) or '.'
+	if not os.path.isdir( directory ):
+		os.makedirs( directory )
+	path = os.path.join( directory, '%s_%s_%dms.prof' % ( view, time.strftime( '%Y%m%d_%H%M%S' ), latency ) )
+	profile.dump_stats( path )
+	return path
+
+def instrumented( name ):
+	def decorator( view ):
+		@wraps( view )
+		def instrumented_view( request, *args, **kwargs ):
+			request.usda_timings = timings = RequestTimings()
+			profile = start_profile()
+			start = time.perf_counter()
+			status = 500
+			counter = QueryCounter()
+			captured = None
+			try:
+				with ExitStack() as stack:
+					stack.enter_context( count_queries( counter ) )
+					if settings.DEBUG:
+						captured = stack.enter_context( CaptureQueriesContext( connection ) )
+					response = view( request, *args, **kwargs )
+					if hasattr( response, 'render' ) and not getattr( response, 'is_rendered', True ):
+						with timer( request, 'render' ):
+							response.render()
+				status = response.status_code
+				return response
+			except Http404:
+				status = 404
+				raise
+			finally:
+				latency = time.perf_counter() - start
+				if profile is not None:
+					profile.disable()
+				fields = { 'view' : name, 'path' : request.path, 'method' : request.method, 'status' : status,
+						'latency_ms' : round( latency * 1000, 2 ),
+						'queries' : counter.count,
+						'db_ms' : round( counter.seconds * 1000, 2 ),
+						'render_ms' : round( timings.phases.get( 'render', 0.0 ) * 1000, 2 ),
+						'cache' : getattr( request, 'usda_cache', None ) }
+				for phase, seconds in timings.phases.items():
+					if phase != 'render':
+						fields[ '%s_ms' % phase ] = round( seconds * 1000, 2 )
+				threshold = getattr( settings, 'USDA_PROFILE_THRESHOLD', None )
+				if profile is not None and threshold is not None and latency >= threshold:
+					fields[ 'profile' ] = dump_profile( profile, name, fields[ 'latency_ms' ] )
+				metrics.record( name, fields )
+				extra = { 'usda' : fields }
+				if captured is not None:
+					extra[ 'usda_sql' ] = captured.captured_queries
+				logger.info( ' '.join( '%s=%s' % item for item in sorted( fields.items() ) ), extra=extra )
+		return instrumented_view
+	return decorator
+
+def metrics_view( request ):
+	# The histograms of this process. Only for staff and INTERNAL_IPS.
+	user = getattr( request, 'user', None )
+	if not ( user is not None and user.is_staff ) and request.META.get( 'REMOTE_ADDR' ) not in settings.INTERNAL_IPS:
+		raise Http404( 'No metrics here' )
+	return JsonResponse( { 'pid' : os.getpid(), 'views' : metrics.as_dict() } )
@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import time
+import traceback
+import zipfile
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction, IntegrityError
+from django.db.transaction import TransactionManagementError
+from django.db.migrations.state import ModelState, ProjectState
+from django.utils import timezone
+
+from usda import documents, query, registry, search
+from usda.caching import bump_version
+from usda.loaders import get_loader
+from usda.models import FoodDocument, ImportJob
+from usda.management.commands.load_daily import sync_daily_amounts
+from usda.management.commands.load_sr27 import FoodGroupFile, NutrientDefFile, DataDerivationFile, LanguaLDescriptionFile, \
+						FoodFile, DatatypeFile, LanguaLFactorFile, NutrientFile, WeightFile, FootnoteFile, \
+						DataSourceFile, DataSourceLinkFile, dependency_order, related_models, rebuild_files
+
+# SR27 imports run in the background of the web process. Every table is
+# loaded into a shadow copy first, <table>_shadow<job id>, while the site
+# keeps serving the live tables. The food documents, the search index and
+# the nutrient query table are then built from the shadow tables into
+# shadow tables of their own. Only once all of them are ready are the live
+# tables renamed out of the way and the shadow tables into their place, in
+# one short transaction, so reads see either the old release or the new
+# one, never a partial one, and wait for the renames at most. The progress
+# is kept on the ImportJob row, for the imports API of any process to read.
+
+FILES = ( FoodGroupFile, NutrientDefFile, DataDerivationFile, LanguaLDescriptionFile, FoodFile, DatatypeFile,
+		LanguaLFactorFile, NutrientFile, WeightFile, FootnoteFile, DataSourceFile, DataSourceLinkFile )
+# The tables an import replaces, those of the models in dependency order
+# and those the search backends and the nutrient queries manage themselves.
+MODELS = dependency_order( [ cls.model for cls in FILES ] + [ FoodDocument ] )
+TABLES = ( search.TABLE, query.TABLE )
+logger = logging.getLogger(__name__)
+
+# Seconds between progress updates of the job row.
+PROGRESS_INTERVAL = 1.0
+# A job whose row was not updated for this long died with its process.
+STALE_AFTER = getattr( settings, 'USDA_IMPORT_STALE_AFTER', 15 * 60 )
+
+# One worker, so that imports queue up instead of loading the same shadow
+# tables at once.
+executor = ThreadPoolExecutor( max_workers=1 )
+
+class JobError( ValueError ):
+	pass
+
+def shadow_name( table, job ):
+	# Named after the job, so that the index names the schema editor
+	# derives from it never clash with those of the live tables, which
+	# carry the name of the job that loaded them.
+	return '%s_shadow%d' % ( table, job.pk )
+
+def retired_name( table, job ):
+	return '%s_old%d' % ( table, job.pk )
+
+def job_tables( job ):
+	# Every table the job creates, the ones referencing others first.
+	tables = [ model._meta.db_table for model in reversed( MODELS ) ] + list( TABLES )
+	return [ shadow_name( t, job ) for t in tables ] + [ retired_name( t, job ) for t in tables ]
+
+def drop_tables( tables ):
+	qn = connection.ops.quote_name
+	cursor = connection.cursor()
+	for table in tables:
+		cursor.execute( 'DROP TABLE IF EXISTS %s' % qn( table ) )
+
+def shadow_apps( job ):
+	# Copies of MODELS on the shadow tables of the job, in an app registry
+	# of their own, for the schema editor, the loaders and the builders of
+	# the derived tables. Their foreign keys point at each other.
+	state = ProjectState()
+	for model in MODELS:
+		model_state = ModelState.from_model( model )
+		model_state.options[ 'db_table' ] = shadow_name( model._meta.db_table, job )
+		state.add_model_state( model_state )
+	apps = state.render()
+	for model in MODELS:
+		# The state has no custom managers, documents need Nutrient's lean().
+		apps.get_model( 'usda', model._meta.object_name ).add_to_class( 'objects', type( model.objects )() )
+	return apps
+
+def shadow_model( apps, model ):
+	return apps.get_model( 'usda', model._meta.object_name )
+
+def create_shadow_tables( apps ):
+	# Same schema as the live tables. Returns the statements adding the
+	# indexes and foreign keys, which are quicker to add once the rows are
+	# in than to keep up to date while they load.
+	models = [ shadow_model( apps, model ) for model in MODELS ]
+	drop_tables( [ model._meta.db_table for model in reversed( models ) ] )
+	with connection.schema_editor() as editor:
+		for model in models:
+			editor.create_model( model )
+		statements, editor.deferred_sql = editor.deferred_sql, []
+	return statements
+
+def index_shadow_tables( apps, statements ):
+	cursor = connection.cursor()
+	for sql in statements:
+		cursor.execute( sql )
+	# The rows were loaded with their primary keys, see numbered().
+	for sql in connection.ops.sequence_reset_sql( no_style(), [ shadow_model( apps, model ) for model in MODELS ] ):
+		cursor.execute( sql )
+
+def numbered( rows, model ):
+	# The rows without a primary key of their own are numbered here, so
+	# that references to them can be checked before the sequence is set.
+	pk = model._meta.pk.attname
+	for i, row in enumerate( rows, 1 ):
+		if pk not in row:
+			row[ pk ] = i
+		yield row
+
+def count_rows( zip_file, files ):
+	total = 0
+	for f in files:
+		with zip_file.open( f.fileName ) as data:
+			total += sum( 1 for line in data if line.strip() )
+	return total
+
+class Progress( object ):
+	# Keeps the job row up to date, at most every PROGRESS_INTERVAL
+	# seconds while a table loads.
+	def __init__( self, job ):
+		self.job = job
+		self.done = 0
+		self.base = 0
+		self.last = 0.0
+
+	def save( self, **fields ):
+		for name, value in fields.items():
+			setattr( self.job, name, value )
+		self.job.rows_done = self.done
+		self.job.updated = timezone.now()
+		ImportJob.objects.filter( pk=self.job.pk ).update( rows_done=self.job.rows_done, updated=self.job.updated, **fields )
+		self.last = time.time()
+
+	def table( self, name ):
+		self.base = self.done
+		self.save( table=name )
+
+	def report( self, count ):
+		self.done = self.base + count
+		if time.time() - self.last >= PROGRESS_INTERVAL:
+			self.save()
+
+def load_shadow( f, zip_file, loader, progress, apps ):
+	# References are checked against the shadow tables loaded before.
+	for model in related_models( f.model ):
+		f.keys[ model ] = set( shadow_model( apps, model ).objects.values_list( 'pk', flat=True ) )
+	progress.table( f.tableName )
+	rows = numbered( ( f.process_row( row ) for row in f.read_rows( zip_file ) ), f.model )
+	return get_loader( loader, shadow_model( apps, f.model ), progress=progress.report ).load( rows )
+
+def build_derived( apps, job, progress ):
+	# The daily amounts of the new nutrient definitions, then the search
+	# index, the nutrient query table and the food documents, all from and
+	# into shadow tables. The in memory search index needs no table, it
+	# rebuilds itself once the dataset version changed.
+	sync_daily_amounts( apps=apps )
+	backend = search.get_backend()
+	if backend.stored:
+		progress.table( search.TABLE )
+		backend.rebuild( shadow_name( search.TABLE, job ), apps )
+	progress.table( query.TABLE )
+	query.rebuild_table( shadow_name( query.TABLE, job ), apps )
+	progress.table( FoodDocument._meta.db_table )
+	documents.rebuild_documents( apps )
+
+def swap( job ):
+	# Renames the live tables to retired names and the shadow tables to
+	# the live names, in one transaction. Renames only change the catalog,
+	# so however large the tables, readers are held up for as long as that
+	# takes and go from the old release to the new one in a single step.
+	# The retired tables are dropped once it committed.
+	existing = set( connection.introspection.table_names() )
+	renames = []
+	for table in [ model._meta.db_table for model in MODELS ] + list( TABLES ):
+		if shadow_name( table, job ) in existing:
+			if table in existing:
+				renames.append( ( table, retired_name( table, job ) ) )
+			renames.append( ( shadow_name( table, job ), table ) )
+	qn = connection.ops.quote_name
+	try:
+		with transaction.atomic():
+			cursor = connection.cursor()
+			if connection.vendor == 'mysql':
+				# MySQL commits around DDL, but renames in one statement.
+				cursor.execute( 'RENAME TABLE %s' % ', '.join( '%s TO %s' % ( qn( old ), qn( new ) ) for old, new in renames ) )
+			else:
+				for old, new in renames:
+					cursor.execute( 'ALTER TABLE %s RENAME TO %s' % ( qn( old ), qn( new ) ) )
+	finally:
+		registry.registry.invalidate()
+	bump_version()
+	retired = [ new for old, new in renames if new == retired_name( old, job ) ]
+	drop_tables( reversed( retired ) )
+
+def run( job ):
+	# Runs the whole import of the job, in the worker thread or in the
+	# foreground for load_sr27 --shadow.
+	files = [ cls() for cls in FILES ]
+	progress = Progress( job )
+	try:
+		apps = shadow_apps( job )
+		progress.save( phase=ImportJob.COUNTING, started=timezone.now() )
+		with zipfile.ZipFile( job.filename, mode='r' ) as zip_file:
+			progress.save( rows_total=count_rows( zip_file, files ) )
+			statements = create_shadow_tables( apps )
+			progress.save( phase=ImportJob.LOADING )
+			for f in files:
+				load_shadow( f, zip_file, job.loader, progress, apps )
+		progress.table( 'indexes' )
+		index_shadow_tables( apps, statements )
+		build_derived( apps, job, progress )
+		progress.save( phase=ImportJob.SWAPPING, table='' )
+		swap( job )
+		progress.save( phase=ImportJob.INDEXING )
+		rebuild_files( set( MODELS ) )
+		progress.save( phase=ImportJob.DONE, finished=timezone.now(), active=None )
+	except Exception:
+		progress.save( phase=ImportJob.FAILED, finished=timezone.now(), error=traceback.format_exc(), active=None )
+		raise
+	finally:
+		drop_tables( job_tables( job ) )
+	return job
+
+def run_in_thread( pk ):
+	# The thread has its own connection, which is closed once done.
+	try:
+		run( ImportJob.objects.get( pk=pk ) )
+	except Exception:
+		# run() records its failures on the job, but not e.g. those of
+		# reading the job. Those mark it failed here, or it would hold up
+		# every other import until it is stale.
+		logger.exception( 'Import %s failed', pk )
+		ImportJob.objects.filter( pk=pk, active=True ).update( phase=ImportJob.FAILED, error=traceback.format_exc(),
+				finished=timezone.now(), active=None )
+	finally:
+		connection.close()
+
+def create( filename, loader ):
+	# The job of a new import. Its active column is unique, so while a job
+	# runs inserting another one fails, however close together they come.
+	now = timezone.now()
+	stale = ImportJob.objects.filter( active=True, updated__lt=now - datetime.timedelta( seconds=STALE_AFTER ) )
+	for job in stale:
+		drop_tables( job_tables( job ) )
+	stale.update( phase=ImportJob.FAILED, error='Interrupted', finished=now, active=None )
+	try:
+		with transaction.atomic():
+			return ImportJob.objects.create( filename=filename, loader=loader, updated=now, active=True )
+	except IntegrityError:
+		raise JobError( 'An import is running already' )
+
+def start( filename, loader='executemany' ):
+	# Queues an import of the zip and returns its job right away.
+	if loader == 'orm':
+		raise JobError( 'The orm loader cannot write to the shadow tables, use executemany or copy' )
+	get_loader( loader, ImportJob ) # Unknown loaders and copy without PostgreSQL fail here.
+	if connection.in_atomic_block:
+		# The worker reads the job over a connection of its own, it has to
+		# be committed by then. Django 1.7 has no on_commit to wait for.
+		raise TransactionManagementError( 'Start imports outside of a transaction, see transaction.non_atomic_requests' )
+	job = create( filename, loader )
+	executor.submit( run_in_thread, job.pk )
+	return job
+
+def jobs( limit=20 ):
+	return ImportJob.objects.order_by( '-created' )[ :limit ]
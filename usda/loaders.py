@@ -0,0 +1,154 @@
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+# Bulk insert backends for the SR27 importer. Every loader takes an iterable
+# of rows as produced by USDAFile.process_row, i.e. dicts keyed by field
+# attname ( food_id rather than food ), and returns how many it inserted.
+
+class Loader( object ):
+	batch_size = 10000
+
+	def __init__( self, model, table=None, using=DEFAULT_DB_ALIAS, progress=None ):
+		self.model = model
+		self.table = table or model._meta.db_table
+		self.using = using
+		self.connection = connections[ using ]
+		self.progress = progress
+		self.fields = dict( ( f.attname, f ) for f in model._meta.concrete_fields )
+		self.attnames = None
+
+	def columns( self, row ):
+		# The column list is taken from the first row, so it follows
+		# whatever fieldNames and process_row of the importer produce.
+		if self.attnames is None:
+			self.attnames = [ f.attname for f in self.model._meta.concrete_fields if f.attname in row ]
+			unknown = set( row ) - set( self.attnames )
+			if unknown:
+				raise ValueError( '%s has no columns %s' % ( self.model.__name__, ', '.join( sorted( unknown ) ) ) )
+			self.preps = [ self.fields[ a ].get_db_prep_save for a in self.attnames ]
+		return self.attnames
+
+	def values( self, row ):
+		self.columns( row )
+		return tuple( prep( row[ a ], self.connection ) for prep, a in zip( self.preps, self.attnames ) )
+
+	def batches( self, rows ):
+		batch = []
+		for row in rows:
+			batch.append( row )
+			if len( batch ) == self.batch_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
+	def report( self, count ):
+		if self.progress:
+			self.progress( count )
+
+	def load( self, rows ):
+		raise NotImplementedError
+
+class OrmLoader( Loader ):
+	def __init__( self, model, table=None, **kwargs ):
+		if table and table != model._meta.db_table:
+			raise ValueError( 'The orm loader can only write to %s' % model._meta.db_table )
+		super( OrmLoader, self ).__init__( model, **kwargs )
+
+	def load( self, rows ):
+		count = 0
+		for batch in self.batches( rows ):
+			with transaction.atomic( using=self.using ):
+				self.model.objects.using( self.using ).bulk_create( [ self.model( **row ) for row in batch ] )
+			count += len( batch )
+			self.report( count )
+		return count
+
+class ExecuteManyLoader( Loader ):
+	def load( self, rows ):
+		qn = self.connection.ops.quote_name
+		count = 0
+		sql = None
+		for batch in self.batches( rows ):
+			values = [ self.values( row ) for row in batch ]
+			if sql is None:
+				sql = 'INSERT INTO %s (%s) VALUES (%s)' % ( qn( self.table ),
+						', '.join( qn( self.fields[ a ].column ) for a in self.attnames ),
+						', '.join( [ '%s' ] * len( self.attnames ) ) )
+			with transaction.atomic( using=self.using ):
+				self.connection.cursor().executemany( sql, values )
+			count += len( batch )
+			self.report( count )
+		return count
+
+def copy_value( value ):
+	if value is None:
+		return '\\N'
+	return str( value ).replace( '\\', '\\\\' ).replace( '\t', '\\t' ).replace( '\n', '\\n' ).replace( '\r', '\\r' )
+
+class CopyStream( object ):
+	# A read only file that renders rows in COPY text format as the
+	# database asks for them, so nothing is buffered beyond one read.
+	def __init__( self, loader, rows ):
+		self.loader = loader
+		self.rows = iter( rows )
+		self.buffer = ''
+		self.count = 0
+
+	def line( self, row ):
+		return '\t'.join( copy_value( v ) for v in self.loader.values( row ) ) + '\n'
+
+	def read( self, size=-1 ):
+		chunks = [ self.buffer ]
+		length = len( self.buffer )
+		while size < 0 or length < size:
+			try:
+				line = self.line( next( self.rows ) )
+			except StopIteration:
+				break
+			chunks.append( line )
+			length += len( line )
+			self.count += 1
+			if self.count % self.loader.batch_size == 0:
+				self.loader.report( self.count )
+		data = ''.join( chunks )
+		if size < 0:
+			size = len( data )
+		self.buffer = data[ size: ]
+		return data[ :size ]
+
+class CopyLoader( Loader ):
+	def __init__( self, model, **kwargs ):
+		super( CopyLoader, self ).__init__( model, **kwargs )
+		if self.connection.vendor != 'postgresql':
+			raise ValueError( 'The copy loader needs PostgreSQL, not %s' % self.connection.vendor )
+
+	def load( self, rows ):
+		rows = iter( rows )
+		try:
+			first = next( rows )
+		except StopIteration:
+			return 0
+		qn = self.connection.ops.quote_name
+		self.columns( first )
+		stream = CopyStream( self, rows )
+		stream.buffer = stream.line( first )
+		stream.count = 1
+		sql = 'COPY %s (%s) FROM STDIN' % ( qn( self.table ),
+				', '.join( qn( self.fields[ a ].column ) for a in self.attnames ) )
+		with transaction.atomic( using=self.using ):
+			self.connection.cursor().copy_expert( sql, stream )
+		self.report( stream.count )
+		return stream.count
+
+LOADERS = {
+	'orm' : OrmLoader,
+	'executemany' : ExecuteManyLoader,
+	'copy' : CopyLoader,
+}
+
+def get_loader( name, model, **kwargs ):
+	try:
+		cls = LOADERS[ name ]
+	except KeyError:
+		raise ValueError( 'Unknown loader %s, use one of %s' % ( name, ', '.join( sorted( LOADERS ) ) ) )
+	return cls( model, **kwargs )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+
+from usda.models import Nutrient, AmountField, FLOAT_AMOUNTS
+
+def column_field( field, as_float ):
+	# A plain FloatField or DecimalField for the column of field.
+	name, path, args, kwargs = field.deconstruct()
+	if as_float:
+		del kwargs[ 'max_digits' ], kwargs[ 'decimal_places' ]
+		column = models.FloatField( *args, **kwargs )
+	else:
+		column = models.DecimalField( *args, **kwargs )
+	column.set_attributes_from_name( name )
+	column.model = field.model
+	return column
+
+class Command(BaseCommand):
+	args = 'float|decimal'
+	help = 'Converts the amount columns of the Nutrient table to doubles, for USDA_FLOAT_AMOUNTS, or back to decimals.'
+
+	def handle( self, *args, **options ):
+		if len( args ) != 1 or args[0] not in ( 'float', 'decimal' ):
+			raise CommandError( 'Give float or decimal' )
+		as_float = args[0] == 'float'
+		if as_float != FLOAT_AMOUNTS:
+			print( "Set USDA_FLOAT_AMOUNTS = %s to go with %s columns" % ( as_float, args[0] ) )
+		if connection.vendor == 'sqlite':
+			# Its decimal columns have NUMERIC affinity, which keeps amounts
+			# with decimal places as doubles already.
+			print( "SQLite stores decimals and doubles the same way, there is nothing to convert" )
+			return
+		fields = [ f for f in Nutrient._meta.fields if isinstance( f, AmountField ) ]
+		with connection.schema_editor() as editor:
+			for field in fields:
+				editor.alter_field( Nutrient, column_field( field, not as_float ), column_field( field, as_float ) )
+				print( "Converted %s.%s to %s" % ( Nutrient._meta.db_table, field.column, args[0] ) )
@@ -0,0 +1,195 @@
+import csv
+import datetime
+import json
+from optparse import make_option
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from usda.benchmark import Timer, write_zip
+from usda.caching import bump_version
+from usda.instrumentation import count_queries
+from usda.loaders import get_loader, LOADERS
+from usda.models import Food, Nutrient, NutrientDefinition, Footnote, FLOAT_AMOUNTS
+from usda.management.commands.load_sr27 import FoodGroupFile, NutrientDefFile, DataDerivationFile, LanguaLDescriptionFile, \
+						FoodFile, DatatypeFile, LanguaLFactorFile, NutrientFile, WeightFile, FootnoteFile, \
+						DataSourceFile, DataSourceLinkFile, clear_tables, peak_memory, resource
+
+FILES = ( FoodGroupFile, NutrientDefFile, DataDerivationFile, LanguaLDescriptionFile, FoodFile, DatatypeFile,
+		LanguaLFactorFile, NutrientFile, WeightFile, FootnoteFile, DataSourceFile, DataSourceLinkFile )
+OPERATIONS = ( 'to_db', 'to_db_bulk', 'to_json', 'to_yaml', 'reads' )
+# How many foods and nutrients the reads operation looks up.
+READ_FOODS = 200
+READ_NUTRIENTS = 20
+
+class Command(BaseCommand):
+	help = 'Benchmarks the SR27 importer on synthetic release files. This replaces the SR27 tables of the database.'
+	option_list = BaseCommand.option_list + (
+		make_option( '--scales', default='1', help='Comma separated multiples of the SR27 row counts to generate, e.g. 1,10,100. Default 1.' ),
+		make_option( '--operations', default='to_db_bulk,to_json,to_yaml',
+			help='Comma separated importer paths to run, of %s. Default to_db_bulk,to_json,to_yaml. '
+				'reads times the queries of the food page and the nutrient queries on what was loaded.' % ', '.join( OPERATIONS ) ),
+		make_option( '--loaders', default='orm', help='Comma separated loaders to run to_db_bulk with, of %s. Default orm.' % ', '.join( sorted( LOADERS ) ) ),
+		make_option( '--output', help='The JSON file to write the results to. Default bench_<database>_<time>.json.' ),
+		make_option( '--compare', help='A JSON file of an earlier run to compare the results with.' ),
+		make_option( '--workdir', help='Where to keep the generated zips and fixtures. Default a temporary directory that is removed afterwards.' ),
+		make_option( '--noinput', action='store_false', dest='interactive', default=True,
+			help='Do not ask before replacing the SR27 tables.' ),
+	)
+
+	def handle( self, *args, **options ):
+		try:
+			scales = [ float( s ) for s in options[ 'scales' ].split( ',' ) ]
+		except ValueError:
+			raise CommandError( '--scales takes numbers, e.g. 1,10,100' )
+		operations = options[ 'operations' ].split( ',' )
+		loaders = options[ 'loaders' ].split( ',' )
+		for name in set( operations ) - set( OPERATIONS ):
+			raise CommandError( 'Unknown operation %s, use some of %s' % ( name, ', '.join( OPERATIONS ) ) )
+		for name in set( loaders ) - set( LOADERS ):
+			raise CommandError( 'Unknown loader %s, use some of %s' % ( name, ', '.join( sorted( LOADERS ) ) ) )
+		writes_db = set( operations ) & set( ( 'to_db', 'to_db_bulk' ) )
+		if writes_db and options[ 'interactive' ]:
+			answer = input( 'This replaces every SR27 table of the %s database %s. Type yes to continue: ' % (
+					connection.vendor, connection.settings_dict[ 'NAME' ] ) )
+			if answer != 'yes':
+				raise CommandError( 'Benchmark cancelled.' )
+
+		workdir = options[ 'workdir' ] or tempfile.mkdtemp( prefix='bench_sr27' )
+		if not os.path.isdir( workdir ):
+			os.makedirs( workdir )
+		started = datetime.datetime.now()
+		report = { 'started' : started.isoformat(), 'database' : connection.vendor, 'python' : platform.python_version(),
+				'django' : django.get_version(), 'platform' : platform.platform(), 'float_amounts' : FLOAT_AMOUNTS, 'results' : [] }
+		try:
+			for scale in scales:
+				path = os.path.join( workdir, 'sr27_%gx.zip' % scale )
+				if not os.path.exists( path ):
+					start = time.time()
+					counts = write_zip( path, scale )
+					print( "Generated %s with %d rows in %.1fs" % ( path, sum( counts.values() ), time.time() - start ) )
+				with zipfile.ZipFile( path ) as zip_file:
+					for operation in operations:
+						for loader in ( loaders if operation == 'to_db_bulk' else [ None ] ):
+							report[ 'results' ].extend( self.run( operation, loader, scale, zip_file, workdir ) )
+		finally:
+			if writes_db:
+				bump_version()
+			if not options[ 'workdir' ]:
+				shutil.rmtree( workdir )
+
+		output = options[ 'output' ] or 'bench_%s_%s.json' % ( connection.vendor, started.strftime( '%Y%m%d_%H%M%S' ) )
+		with open( output, 'w' ) as f:
+			json.dump( report, f, indent=2, sort_keys=True )
+		print( "Wrote %s" % output )
+		if options[ 'compare' ]:
+			with open( options[ 'compare' ] ) as f:
+				compare( json.load( f ), report )
+
+	def run( self, operation, loader, scale, zip_file, workdir ):
+		if operation == 'reads':
+			return self.run_reads( scale )
+		results = []
+		if operation in ( 'to_db', 'to_db_bulk' ):
+			clear_tables( [ cls.model for cls in FILES ] )
+		for cls in FILES:
+			f = cls()
+			rss = peak_rss()
+			start = time.perf_counter()
+			phases = None
+			with count_queries() as queries:
+				if operation == 'to_db_bulk':
+					rows, phases = load_timed( f, zip_file, loader )
+				elif operation == 'to_db':
+					rows = f.to_db( zip_file )[0]
+				elif operation == 'to_json':
+					rows = f.to_json( zip_file, os.path.join( workdir, '%s.json' % f.tableName ) )
+				else:
+					rows = f.to_yaml( zip_file, os.path.join( workdir, '%s.yaml' % f.tableName ) )
+			seconds = time.perf_counter() - start
+			peak = peak_rss()
+			result = { 'scale' : scale, 'operation' : operation, 'loader' : loader, 'table' : f.tableName, 'rows' : rows,
+					'seconds' : round( seconds, 4 ), 'rows_per_sec' : round( rows / seconds, 1 ) if seconds else None,
+					'queries' : len( queries ), 'peak_rss_mb' : peak, 'rss_growth_mb' : round( peak - rss, 1 ) if peak is not None else None }
+			if phases:
+				result[ 'phases' ] = phases
+			print( "%gx %-10s %-12s %-26s %9d rows %8.2fs %10.0f rows/sec %7d queries, peak memory %s" % ( scale, operation,
+					loader or '', f.tableName, rows, seconds, result[ 'rows_per_sec' ] or 0, len( queries ), peak_memory() ) )
+			results.append( result )
+		return results
+
+	def run_reads( self, scale ):
+		# The same lookups through model instances and through the lean
+		# projection, and the ( nutrient, amount ) index.
+		rng = random.Random( 27 )
+		foods = list( Food.objects.values_list( 'pk', flat=True ) )
+		foods = rng.sample( foods, min( READ_FOODS, len( foods ) ) )
+		codes = list( NutrientDefinition.objects.values_list( 'pk', flat=True ) )
+		codes = rng.sample( codes, min( READ_NUTRIENTS, len( codes ) ) )
+		reads = (
+			( 'nutrients_models', lambda: sum( len( list( Nutrient.objects.filter( food=f ) ) ) for f in foods ) ),
+			( 'nutrients_lean', lambda: sum( len( Nutrient.objects.filter( food=f ).lean() ) for f in foods ) ),
+			( 'nutrients_by_amount', lambda: sum( len( list( Nutrient.objects.filter( nutrient=c, amount__gt=10 )
+					.order_by( '-amount' ).values_list( 'food', flat=True )[ :50 ] ) ) for c in codes ) ),
+			( 'footnotes', lambda: sum( len( list( Footnote.objects.filter( food=f, nutrient_definition__in=codes ) ) ) for f in foods ) ),
+		)
+		results = []
+		for name, read in reads:
+			start = time.perf_counter()
+			with count_queries() as queries:
+				rows = read()
+			seconds = time.perf_counter() - start
+			result = { 'scale' : scale, 'operation' : 'reads', 'loader' : None, 'table' : name, 'rows' : rows,
+					'seconds' : round( seconds, 4 ), 'rows_per_sec' : round( rows / seconds, 1 ) if seconds else None,
+					'queries' : len( queries ), 'peak_rss_mb' : peak_rss(), 'rss_growth_mb' : None }
+			print( "%gx %-10s %-12s %-26s %9d rows %8.2fs %10.0f rows/sec %7d queries" % ( scale, 'reads', '', name, rows,
+					seconds, result[ 'rows_per_sec' ] or 0, len( queries ) ) )
+			results.append( result )
+		return results
+
+def peak_rss():
+	# ru_maxrss only grows, so per table only the growth of the peak can
+	# be told apart.
+	if resource is None:
+		return None
+	rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+	if sys.platform == 'darwin':
+		rss /= 1024
+	return round( rss / 1024.0, 1 )
+
+def load_timed( f, zip_file, loader ):
+	# USDAFile.load_bulk with a timer between each stage of the pipeline:
+	# reading and decoding the zip member, splitting it into fields,
+	# process_row and inserting, which is what the loader spends on top.
+	start = time.perf_counter()
+	with f.get_zip_data( zip_file ) as data:
+		read = Timer( data )
+		parse = Timer( csv.DictReader( read, f.fieldNames, delimiter=f.delimiter, quotechar=f.quote ), read )
+		process = Timer( ( f.process_row( row ) for row in parse ), parse )
+		rows = get_loader( loader, f.model ).load( process )
+	f.loaded()
+	total = time.perf_counter() - start
+	return rows, { 'zip_read' : round( read.exclusive(), 4 ), 'parse' : round( parse.exclusive(), 4 ),
+			'process_row' : round( process.exclusive(), 4 ), 'insert' : round( total - process.seconds, 4 ) }
+
+def compare( old, new ):
+	# Rows/sec of the new run relative to the old one, per matching result.
+	key = lambda r: ( r[ 'scale' ], r[ 'operation' ], r[ 'loader' ], r[ 'table' ] )
+	before = dict( ( key( r ), r ) for r in old[ 'results' ] )
+	print( "Compared with %s on %s :" % ( old[ 'started' ], old[ 'database' ] ) )
+	for r in new[ 'results' ]:
+		o = before.get( key( r ) )
+		if not o or not o[ 'rows_per_sec' ] or not r[ 'rows_per_sec' ]:
+			continue
+		print( "%gx %-10s %-12s %-26s %10.0f -> %10.0f rows/sec ( x%.2f ), %d -> %d queries" % ( r[ 'scale' ], r[ 'operation' ],
+				r[ 'loader' ] or '', r[ 'table' ], o[ 'rows_per_sec' ], r[ 'rows_per_sec' ], r[ 'rows_per_sec' ] / o[ 'rows_per_sec' ],
+				o[ 'queries' ], r[ 'queries' ] ) )
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import itertools
+import json
+from optparse import make_option
+import random
+import time
+from urllib.request import urlopen
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve
+from django.db import connection, close_old_connections
+from django.test import RequestFactory
+
+from usda import fanout
+from usda.models import Food
+
+# How many foods the requests are spread over.
+FOODS = 500
+
+class Command(BaseCommand):
+	help = 'Load tests the food page and the food list with concurrent clients, with and without the query fan-out.'
+	option_list = BaseCommand.option_list + (
+		make_option( '--clients', default='1,8,32', help='Comma separated numbers of concurrent clients. Default 1,8,32.' ),
+		make_option( '--requests', type='int', default=400, help='Requests per number of clients. Default 400.' ),
+		make_option( '--fanout', default='off,on',
+			help='Run with the fan-out of usda.fanout off, on or both, comma separated. Default off,on. Ignored with --url.' ),
+		make_option( '--url', help='The usda/ URL of a running server to send the requests to, '
+			'e.g. http://localhost:8000/usda/. By default the views are called in this process.' ),
+		make_option( '--cached', action='store_true', help='Let the page cache answer repeated pages. By default every request misses it.' ),
+		make_option( '--output', help='Write the results to this JSON file.' ),
+	)
+
+	def handle( self, *args, **options ):
+		try:
+			levels = [ int( c ) for c in options[ 'clients' ].split( ',' ) ]
+		except ValueError:
+			raise CommandError( '--clients takes numbers, e.g. 1,8,32' )
+		modes = [ None ] if options[ 'url' ] else options[ 'fanout' ].split( ',' )
+		for mode in set( modes ) - set( ( None, 'on', 'off' ) ):
+			raise CommandError( 'Unknown --fanout %s, use off, on or both' % mode )
+		foods = list( Food.objects.values_list( 'pk', flat=True )[ :FOODS ] )
+		if not foods:
+			raise CommandError( 'Load SR27 first, there are no foods' )
+		rng = random.Random( 27 )
+		paths = [ rng.choice( ( 'food/%s/' % rng.choice( foods ), '' ) ) for i in range( options[ 'requests' ] ) ]
+		if connection.vendor == 'sqlite' and not options[ 'url' ]:
+			print( "SQLite runs the queries one after the other, the fan-out makes no difference there" )
+
+		workers = fanout.WORKERS
+		results = []
+		try:
+			for mode in modes:
+				if mode is not None:
+					fanout.WORKERS = workers if mode == 'on' else 0
+				for clients in levels:
+					result = self.run( paths, clients, options[ 'url' ], options[ 'cached' ] )
+					result[ 'fanout' ] = mode
+					results.append( result )
+					print( "fan-out %-3s %4d clients %6d requests %8.1f requests/sec, latency ms p50 %7.1f p95 %7.1f p99 %7.1f, %d errors" % (
+							mode or '', clients, result[ 'requests' ], result[ 'requests_per_sec' ], result[ 'p50_ms' ],
+							result[ 'p95_ms' ], result[ 'p99_ms' ], result[ 'errors' ] ) )
+		finally:
+			fanout.WORKERS = workers
+		if options[ 'output' ]:
+			with open( options[ 'output' ], 'w' ) as f:
+				json.dump( { 'started' : datetime.datetime.now().isoformat(), 'database' : connection.vendor,
+						'url' : options[ 'url' ], 'results' : results }, f, indent=2, sort_keys=True )
+			print( "Wrote %s" % options[ 'output' ] )
+
+	def run( self, paths, clients, url, cached ):
+		# Every path once, spread over the clients. Unless cached, each
+		# path gets a query string of its own, so versioned_page misses.
+		counter = itertools.count()
+		factory = RequestFactory()
+
+		def request( path ):
+			n = next( counter )
+			if not cached:
+				path += '?run=%d' % n
+			start = time.perf_counter()
+			try:
+				if url:
+					with urlopen( url.rstrip( '/' ) + '/' + path ) as response:
+						response.read()
+						ok = response.status == 200
+				else:
+					ok = self.call( factory, path ) == 200
+			except Exception:
+				ok = False
+			return time.perf_counter() - start, ok
+
+		start = time.perf_counter()
+		with ThreadPoolExecutor( max_workers=clients ) as pool:
+			timings = list( pool.map( request, paths ) )
+		seconds = time.perf_counter() - start
+		latencies = sorted( t for t, ok in timings )
+		percentile = lambda p: round( latencies[ min( int( p * len( latencies ) ), len( latencies ) - 1 ) ] * 1000, 1 )
+		return { 'clients' : clients, 'requests' : len( timings ), 'seconds' : round( seconds, 3 ),
+				'requests_per_sec' : round( len( timings ) / seconds, 1 ), 'errors' : sum( 1 for t, ok in timings if not ok ),
+				'p50_ms' : percentile( 0.5 ), 'p95_ms' : percentile( 0.95 ), 'p99_ms' : percentile( 0.99 ) }
+
+	def call( self, factory, path ):
+		# The view of the path, called the way the handler would.
+		close_old_connections()
+		request = factory.get( '/' + path )
+		request.user = AnonymousUser()
+		match = resolve( '/' + path.split( '?' )[0], urlconf='usda.urls' )
+		response = match.func( request, *match.args, **match.kwargs )
+		return response.status_code
@@ -1,55 +1,94 @@
 import decimal
+import json
+from optparse import make_option
+import os
 
+from django.apps import apps as live_apps
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+from django.db import connection, transaction
+from django.utils import timezone
 
-from usda.models import NutrientDefinition
+from usda import documents, registry
+from usda.caching import bump_version
+from usda.models import NutrientDefinition, DailyValueProfile, DailyValue
+
+# The daily value profiles shipped with the app, see the file for its format.
+DAILY_VALUES = os.path.join( os.path.dirname( __file__ ), '..', '..', 'data', 'daily_values.json' )
 
 class Command(BaseCommand):
-	help = 'Imports daily recommended values.'
+	args = '[<file>]'
+	help = 'Imports daily value profiles, the ones shipped in usda/data/daily_values.json by default.'
+	option_list = BaseCommand.option_list + (
+		make_option( '--default', help='The profile whose values the %DV columns show by default, instead of the one the file gives.' ),
+	)
 
 	def handle( self, *args, **options ):
+		path = args[0] if args else DAILY_VALUES
+		try:
+			with open( path ) as f:
+				data = json.load( f )
+			profiles = data[ 'profiles' ]
+			default = options[ 'default' ] or data.get( 'default' )
+		except ( IOError, ValueError, KeyError ) as e:
+			raise CommandError( 'Cannot read the profiles of %s : %s' % ( path, e ) )
+		if default not in [ p[ 'name' ] for p in profiles ]:
+			raise CommandError( 'There is no default profile %s in %s' % ( default, path ) )
 
-		values = [ ( '204', 65 ), # total fat
-				( '606', 20 ), # Saturated fat
-				( '601', 300 ), # Cholesterol
-				( '307', 2400 ), # Sodium
-				( '306', 3500 ), # Potassium
-				( '205', 300 ), # Total carbs
-				( '291', 25 ), # Fiber
-				( '203', 50 ), # Protein
-				( '318', 5000 ), # Vitamin A
-				( '401', 60 ), # Vitamin C
-				( '301', 1000 ), # Calcium
-				( '303', 18 ), # Iron
-				( '324', 400 ), # Vitamin D
-				( '323', 30 ), # Vitamin E
-				( '430', 80 ), # Vitamin K
-				( '404', '1.5' ), # Thiamin
-				( '406', 20 ), # Niacin
-				( '415', 2 ), # Vitamin B6
-				( '417', 400 ), # Folate
-				( '418', 6 ), # Vitamin B12
-				( '000', 300 ), # Biotin
-				( '410', 10 ), # Panthothenic acid
-				( '305', 1000 ), # Phosphorus
-				( '000', 150 ), # Iodine
-				( '304', 400 ), # Magnesium
-				( '309', 15 ), # Zinc
-				( '317', 70 ), # Selenium
-				( '312', 2 ), # Copper
-				( '315', 2 ), # Manganese
-				( '000', 120 ), # Chromium
-				( '000', 75 ), # Molybdenum
-				( '000', 3400 ), # Chloride
-				]
-
+		codes = set( NutrientDefinition.objects.values_list( 'code', flat=True ) )
+		if not codes:
+			raise CommandError( 'Load the nutrient definitions with load_sr27 first' )
 		with transaction.atomic():
-			for d in values:
-				if d[0] == '000':
-					continue
-				n = NutrientDefinition.objects.get( pk=d[0] )
-				n.daily_amount = decimal.Decimal( d[1] )
-				n.save( update_fields=[ 'daily_amount' ] )
-				print( "%s set to daily amount : %s" % ( n.name, n.daily_amount ) )
+			for p in profiles:
+				values = dict( ( code, decimal.Decimal( str( amount ) ) ) for code, amount in p[ 'values' ].items() )
+				unknown = set( values ) - codes
+				if unknown:
+					print( "Skipped the unknown nutrients %s of %s" % ( ', '.join( sorted( unknown ) ), p[ 'name' ] ) )
+				values = dict( ( code, amount ) for code, amount in values.items() if code in codes )
+				if self.load_profile( p[ 'name' ], p.get( 'description', '' ), values, p[ 'name' ] == default ):
+					print( "Loaded %d daily values of %s" % ( len( values ), p[ 'name' ] ) )
+				else:
+					print( "%s is unchanged" % p[ 'name' ] )
+			DailyValueProfile.objects.exclude( name=default ).update( is_default=False )
+			changed = sync_daily_amounts( default )
+			if changed:
+				print( "Set %d daily amounts from %s, updated the %%DV of %d food documents" % ( len( changed ), default,
+						documents.update_daily_values( changed ) ) )
+
+		registry.registry.invalidate()
+		print( "Dataset version is now %d" % bump_version() )
+
+	def load_profile( self, name, description, values, is_default ):
+		# Replaces the values of the profile in bulk when they changed, and
+		# moves it to a new version. Returns whether they did.
+		profile, created = DailyValueProfile.objects.get_or_create( name=name )
+		profile.description = description
+		profile.is_default = is_default
+		changed = dict( profile.daily_values.values_list( 'nutrient', 'amount' ) ) != values
+		if changed:
+			profile.daily_values.all().delete()
+			DailyValue.objects.bulk_create( [ DailyValue( profile=profile, nutrient_id=code, amount=amount )
+					for code, amount in sorted( values.items() ) ] )
+			profile.version += 1
+			profile.modified = timezone.now()
+		profile.save()
+		return changed
 
+def sync_daily_amounts( profile=None, apps=live_apps ):
+	# NutrientDefinition.daily_amount follows the default profile, or the
+	# named one, in one executemany of the amounts that changed. Returns
+	# them by code. load_sr27 calls it after reloading the definitions,
+	# usda.jobs with the apps of its shadow tables.
+	definitions = apps.get_model( 'usda', 'NutrientDefinition' )
+	profiles = DailyValueProfile.objects.filter( name=profile ) if profile else DailyValueProfile.objects.filter( is_default=True )
+	if not profiles.exists():
+		return {}
+	values = dict( DailyValue.objects.filter( profile__in=profiles ).values_list( 'nutrient', 'amount' ) )
+	current = dict( definitions.objects.values_list( 'code', 'daily_amount' ) )
+	changed = dict( ( code, values.get( code ) ) for code, amount in current.items() if amount != values.get( code ) )
+	if changed:
+		qn = connection.ops.quote_name
+		meta = definitions._meta
+		field = meta.get_field( 'daily_amount' )
+		connection.cursor().executemany( 'UPDATE %s SET %s = %%s WHERE %s = %%s' % ( qn( meta.db_table ), qn( field.column ),
+				qn( meta.pk.column ) ), [ ( field.get_db_prep_save( amount, connection ), code ) for code, amount in changed.items() ] )
+	return changed
@@ -0,0 +1,41 @@
+from optparse import make_option
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from usda import registry
+from usda.loaders import get_loader, LOADERS
+from usda.management.commands.load_sr27 import clear_tables, dependency_order, rebuild_derived, peak_memory
+from usda.snapshot import Snapshot
+
+class Command(BaseCommand):
+	args = '<snapshot>'
+	help = 'Replaces the tables in a snapshot written by load_sr27 --snapshot with its rows.'
+	option_list = BaseCommand.option_list + (
+		make_option( '--loader', type='choice', choices=sorted( LOADERS ), default='orm',
+			help='How rows are written to the database: orm ( bulk_create ), executemany or copy ( PostgreSQL only ). Default orm.' ),
+	)
+
+	def handle( self, *args, **options ):
+		if len( args ) != 1:
+			raise CommandError( 'Give the snapshot file' )
+		if not os.path.exists( args[0] ):
+			raise CommandError( '%s does not exist' % args[0] )
+
+		snapshot = Snapshot( args[0] )
+		try:
+			tables = dict( ( t.model, t ) for t in snapshot.tables.values() )
+			models = dependency_order( list( tables ) )
+			clear_tables( models )
+			for model in models:
+				start = time.time()
+				table = tables[ model ]
+				count = get_loader( options[ 'loader' ], model ).load( table.iter_rows() )
+				elapsed = time.time() - start
+				print( "Restored %d records of %s in %.1fs ( %d rows/sec ), peak memory %s" % ( count, model._meta.db_table,
+						elapsed, count / elapsed if elapsed else 0, peak_memory() ) )
+		finally:
+			snapshot.close()
+		registry.registry.invalidate()
+		rebuild_derived( set( models ) )
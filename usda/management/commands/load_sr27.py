@@ -1,5 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import csv
 import decimal
+import io
 from optparse import make_option
 import os
 import sys
@@ -7,10 +9,25 @@ import zipfile
 import json
 import yaml
 import datetime
-
+import gzip
+import hashlib
+import itertools
+import time
+try:
+	import resource
+except ImportError:
+	resource = None
+
+from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
-
+from django.db import models, transaction, connection, connections
+
+from usda import documents, query, registry, search, similarity
+from usda.caching import bump_version
+from usda.instrumentation import count_queries
+from usda.management.commands.load_daily import sync_daily_amounts
+from usda.loaders import get_loader, LOADERS
+from usda.snapshot import SnapshotWriter
 from usda.models import Food, FoodGroup, GramWeight, NutrientDefinition, Footnote, \
 						DataSource, DataDerivation, Nutrient, DataType, \
 						LanguaLFactor, LanguaLFactorDescription, DataSourceLink
@@ -20,8 +37,19 @@ class Command(BaseCommand):
 	option_list = BaseCommand.option_list + (
 		make_option( '--usda', help='The SR27 zipfile', default='sr27.zip' ),
 		make_option( '--db', action='store_true', help='Write to the database' ),
+		make_option( '--loader', type='choice', choices=sorted( LOADERS ), default='orm',
+			help='How rows are written to the database: orm ( bulk_create ), executemany or copy ( PostgreSQL only ). Default orm.' ),
+		make_option( '--incremental', action='store_true',
+			help='Only insert, update and delete the rows that differ from the database, instead of clearing and reloading the tables.' ),
+		make_option( '--shadow', action='store_true',
+			help='With --db --all, load into shadow tables and only replace the live tables once every table loaded, '
+				'as the imports API does. Needs --loader executemany or copy.' ),
+		make_option( '--jobs', type='int', default=1,
+			help='Load up to this many tables at once, each in its own process. Tables are only started once the tables they reference are loaded.' ),
 		make_option( '--json', help='Write to json file. Give the base of the filename. The table name and .json will be added.' ),
 		make_option( '--yaml', help='Write to yaml file. Give the base of the filename. The table name and .yaml will be added.' ),
+		make_option( '--gzip', action='store_true', help='Compress the json and yaml files with gzip, loaddata reads them as they are.' ),
+		make_option( '--snapshot', help='Write the selected tables to this binary snapshot file, which load_snapshot reads back.' ),
 		make_option( '--all', action='store_true', help='Import all data.' ),
 		make_option( '--food', action='store_true', help='Import foods.' ),
 		make_option( '--foodgroup', action='store_true', help='Import food groups.' ),
@@ -37,13 +65,52 @@ class Command(BaseCommand):
 		make_option( '--datatype', action='store_true', help='Import datatypes.' ),
 	)
 
-	def do_write( self, f, zip_file, write_db, write_yaml, write_json ):
+	def do_write( self, f, zip_file, write_db, write_yaml, write_json, loader='orm', snapshot=None, compress=False ):
+		start = time.time()
+		suffix = '.gz' if compress else ''
 		if write_db :
-			f.to_db_bulk( zip_file )
+			f.to_db_bulk( zip_file, clear=False, loader=loader )
 		if write_yaml:
-			f.to_yaml( zip_file, '%s_%s.yaml' % ( write_yaml, f.tableName ) )
+			f.to_yaml( zip_file, '%s_%s.yaml%s' % ( write_yaml, f.tableName, suffix ), compress )
 		if write_json:
-			f.to_json( zip_file, '%s_%s.json' % ( write_json, f.tableName ) )
+			f.to_json( zip_file, '%s_%s.json%s' % ( write_json, f.tableName, suffix ), compress )
+		if snapshot:
+			f.to_snapshot( zip_file, snapshot )
+		return time.time() - start
+
+	def update_incremental( self, files, filename, loader ):
+		with transaction.atomic():
+			with zipfile.ZipFile( filename, mode='r' ) as zip_file:
+				deletes = [ ( f, f.to_db_incremental( zip_file, loader ) ) for f in files ]
+			for f, pks in reversed( deletes ):
+				f.delete_rows( pks )
+
+	def load_parallel( self, files, filename, loader, jobs ):
+		# Every table waits for the selected tables it has foreign keys to,
+		# the rest are handed to the pool as soon as a worker is free.
+		selected = dict( ( f.model, f ) for f in files )
+		depends = dict( ( f, set( selected[ m ] for m in related_models( f.model ) if m in selected ) ) for f in files )
+		pending = list( files )
+		running = {}
+		done = set()
+		timings = []
+
+		# Forked workers must open their own connections instead of
+		# sharing the socket of the parent's.
+		for conn in connections.all():
+			conn.close()
+
+		with ProcessPoolExecutor( max_workers=jobs ) as pool:
+			while pending or running:
+				for f in [ f for f in pending if depends[ f ] <= done ]:
+					running[ pool.submit( load_table, type( f ), filename, loader ) ] = f
+					pending.remove( f )
+				finished, _ = wait( running, return_when=FIRST_COMPLETED )
+				for future in finished:
+					f = running.pop( future )
+					timings.append( ( f.tableName, future.result() ) )
+					done.add( f )
+		return timings
 
 	def handle( self, *args, **options ):
 
@@ -67,14 +134,200 @@ class Command(BaseCommand):
 				( 'weight', WeightFile() ),
 				( 'footnote', FootnoteFile() ),
 				( 'datasource', DataSourceFile() ),
-				( 'datasource', DataSourceLinkFile() ),
+				( 'datasourcelink', DataSourceLinkFile() ),
 				]
 
-
+		jobs = options[ 'jobs' ]
+		if jobs > 1 and write_db and connection.vendor == 'sqlite':
+			print( "SQLite allows only one writer at a time, loading tables one by one" )
+			jobs = 1
+
+		if options[ 'loader' ] == 'copy' and connection.vendor != 'postgresql':
+			raise CommandError( '--loader=copy needs PostgreSQL, this database is %s' % connection.vendor )
+
+		if options[ 'shadow' ]:
+			# usda.jobs imports this module.
+			from usda import jobs as import_jobs
+			if not ( write_db and do_all ):
+				raise CommandError( '--shadow replaces every table, give --db --all' )
+			if options[ 'loader' ] == 'orm':
+				raise CommandError( '--shadow needs --loader executemany or copy' )
+			try:
+				job = import_jobs.run( import_jobs.create( filename, options[ 'loader' ] ) )
+			except import_jobs.JobError as e:
+				raise CommandError( str( e ) )
+			print( "Replaced the SR27 tables with %d rows in %.1fs" % ( job.rows_done, job.progress()[ 'elapsed_seconds' ] ) )
+			return
+
+		commands = [ t for t in commands if do_all or options[ t[0] ] ]
+		if write_db and options[ 'incremental' ]:
+			self.update_incremental( [ t[1] for t in commands ], filename, options[ 'loader' ] )
+			write_db = False
+		elif write_db:
+			clear_tables( [ t[1].model for t in commands ] )
+
+		timings = []
+		if write_db and jobs > 1:
+			timings = self.load_parallel( [ t[1] for t in commands ], filename, options[ 'loader' ], jobs )
+			write_db = False
+
+		snapshot = SnapshotWriter( options[ 'snapshot' ] ) if options[ 'snapshot' ] else None
 		with zipfile.ZipFile( filename, mode='r' ) as zip_file:
 			for t in commands:
-				if do_all or options[ t[0] ]:
-					self.do_write( t[1], zip_file, write_db, write_yaml, write_json )
+				if write_db or write_yaml or write_json or snapshot:
+					timings.append( ( t[1].tableName, self.do_write( t[1], zip_file, write_db, write_yaml, write_json,
+							options[ 'loader' ], snapshot, options[ 'gzip' ] ) ) )
+		if snapshot:
+			strings = snapshot.close()
+			print( "Wrote %s, %d bytes with %d distinct strings" % ( snapshot.path, os.path.getsize( snapshot.path ), strings ) )
+
+		for table, elapsed in timings:
+			print( "%-26s %8.1fs" % ( table, elapsed ) )
+
+		loaded = set( f.model for name, f in commands ) if options[ 'db' ] else set()
+		rebuild_derived( loaded )
+
+def rebuild_derived( loaded ):
+	# Rebuild what is derived from the given models once they are loaded
+	# and start a new dataset version, which drops every cached page.
+	rebuild_tables( loaded )
+	rebuild_files( loaded )
+
+def rebuild_tables( loaded ):
+	# The derived tables, each rebuilt in a transaction. usda.jobs builds
+	# them from its shadow tables instead.
+	if NutrientDefinition in loaded:
+		changed = sync_daily_amounts()
+		if changed:
+			registry.registry.invalidate()
+			print( "Set %d daily amounts from the default daily value profile" % len( changed ) )
+	if loaded.intersection( ( Food, LanguaLFactor, LanguaLFactorDescription ) ):
+		start = time.time()
+		backend = search.rebuild_index()
+		print( "Rebuilt the %s food search index in %.1fs" % ( backend.name, time.time() - start ) )
+	if loaded.intersection( ( Food, Nutrient, NutrientDefinition ) ):
+		start = time.time()
+		count = query.rebuild_table()
+		print( "Rebuilt the nutrient query table with %d nutrients in %.1fs" % ( count, time.time() - start ) )
+	if loaded.difference( ( DataType, DataDerivation ) ):
+		start = time.time()
+		count = documents.rebuild_documents()
+		print( "Rebuilt the nutrition documents of %d foods in %.1fs" % ( count, time.time() - start ) )
+
+def rebuild_files( loaded ):
+	# The similarity index, which lives in files outside of any
+	# transaction, and the new dataset version.
+	if loaded.intersection( ( Food, Nutrient, NutrientDefinition ) ):
+		if similarity.numpy is not None:
+			start = time.time()
+			foods, nutrients = similarity.build_index()
+			print( "Rebuilt the similarity index of %d foods by %d nutrients in %.1fs" % ( foods, nutrients, time.time() - start ) )
+		else:
+			print( "Install numpy to build the similarity index" )
+	if loaded:
+		print( "Dataset version is now %d" % bump_version() )
+
+def load_table( cls, filename, loader ):
+	# Runs in a worker process of Command.load_parallel.
+	start = time.time()
+	with zipfile.ZipFile( filename, mode='r' ) as zip_file:
+		cls().to_db_bulk( zip_file, clear=False, loader=loader )
+	connection.close()
+	return time.time() - start
+
+def peak_memory():
+	# Peak resident set size of this process in MB, as a string for the
+	# summary lines. ru_maxrss is in kilobytes on Linux but bytes on OS X.
+	if resource is None:
+		return 'unknown'
+	rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+	if sys.platform == 'darwin':
+		rss /= 1024
+	return '%.1f MB' % ( rss / 1024.0 )
+
+# libyaml's emitter when PyYAML was built with it, it is many times faster.
+YAML_DUMPER = getattr( yaml, 'CSafeDumper', yaml.SafeDumper )
+
+# SQLite refuses statements with more host parameters than this.
+SQLITE_MAX_VARIABLES = 999
+
+def related_models( model ):
+	return [ f.rel.to for f in model._meta.fields if f.rel and f.rel.to is not model ]
+
+def dependency_order( models ):
+	# Order models so that each one comes after the models it references.
+	ordered = []
+	def visit( model ):
+		if model in ordered:
+			return
+		for parent in related_models( model ):
+			if parent in models:
+				visit( parent )
+		ordered.append( model )
+	for model in models:
+		visit( model )
+	return ordered
+
+def constrained_models( model ):
+	# The models referenced with a database constraint, which leaves out
+	# those that are meant to outlive a reload, see DailyValue.
+	return [ f.rel.to for f in model._meta.fields if f.rel and f.db_constraint and f.rel.to is not model ]
+
+def with_dependents( models ):
+	# Clearing a table means clearing every table that references it too,
+	# just like the cascading delete the ORM would have done.
+	models = set( models )
+	app_models = apps.get_app_config( 'usda' ).get_models()
+	changed = True
+	while changed:
+		changed = False
+		for model in app_models:
+			if model not in models and models.intersection( constrained_models( model ) ):
+				models.add( model )
+				changed = True
+	return models
+
+def delete_where( cursor, model, where, params ):
+	# Deletes the rows of model matching where, having deleted the rows
+	# referencing them first, table by table.
+	qn = connection.ops.quote_name
+	table = qn( model._meta.db_table )
+	for dependent in apps.get_app_config( 'usda' ).get_models():
+		for f in dependent._meta.fields:
+			if f.rel and f.rel.to is model and f.db_constraint and dependent is not model:
+				delete_where( cursor, dependent, '%s IN ( SELECT %s FROM %s WHERE %s )' % ( qn( f.column ),
+						qn( f.rel.get_related_field().column ), table, where ), params )
+	cursor.execute( 'DELETE FROM %s WHERE %s' % ( table, where ), params )
+
+def clear_tables( models ):
+	models = dependency_order( with_dependents( models ) )
+	models.reverse()
+	registry.registry.invalidate()
+	qn = connection.ops.quote_name
+	with transaction.atomic():
+		cursor = connection.cursor()
+		if connection.vendor == 'postgresql':
+			cursor.execute( 'TRUNCATE TABLE %s' % ', '.join( qn( m._meta.db_table ) for m in models ) )
+			for model in models:
+				print( "Truncated %s" % model._meta.db_table )
+			return
+
+		for model in models:
+			table = qn( model._meta.db_table )
+			if connection.vendor == 'sqlite':
+				pk = qn( model._meta.pk.column )
+				count = 0
+				while True:
+					cursor.execute( 'SELECT %s FROM %s LIMIT %d' % ( pk, table, SQLITE_MAX_VARIABLES ) )
+					ids = [ r[0] for r in cursor.fetchall() ]
+					if not ids:
+						break
+					cursor.execute( 'DELETE FROM %s WHERE %s IN (%s)' % ( table, pk, ', '.join( [ '%s' ] * len( ids ) ) ), ids )
+					count += len( ids )
+			else:
+				cursor.execute( 'DELETE FROM %s' % table )
+				count = cursor.rowcount
+			print( "Deleted %d records from %s" % ( count, model._meta.db_table ) )
 
 class USDAFile( object ):
 	DB = 1
@@ -83,9 +336,17 @@ class USDAFile( object ):
 	fileName = None
 	fieldNames = ()
 	tableName = None
+	# Attnames identifying a row across releases, the primary key if None.
+	naturalKey = None
+	# Whether to_object checks references against the database.
+	checkKeys = True
 	model = None
 	delimiter = '^'
 	quote = '~'
+
+	def __init__( self ):
+		self.keys = {}
+
 	def write( self, t, zipfile, outfile ):
 		if t == self.DB:
 			self.to_db( zipfile )
@@ -98,98 +359,220 @@ class USDAFile( object ):
 		return row
 
 	def get_zip_data( self, zipfile ):
-		#data = data.replace( b'\xb5', b'\xc2\xb5' )
-		#data = data.replace( b'\xe9', b'\xc3\xa9' )
-		data = zipfile.read( self.fileName )
-		data = data.decode( encoding='ISO-8859-1' )
-		#data = data.encode( 'UTF-8' ).decode( 'UTF-8' )
-		#print( data )
-		data = data.splitlines()
-		return data
+		# Decode the member incrementally instead of reading, decoding and
+		# splitting the whole file, so memory doesn't grow with its size.
+		return io.TextIOWrapper( zipfile.open( self.fileName ), encoding='ISO-8859-1', newline='' )
 
-	def remove_old( self ):
-		with transaction.atomic():
-			# just delete the old ones like this.
-			# We can't do the natural self.model.objects.all().delete()
-			# because it gives errors ( too many sql variables ).
-			# It also seems that you can't delete in bigger batches either
-			count = 0
-			while self.model.objects.count():
-				ids = self.model.objects.values_list('pk')[:1]
-				self.model.objects.filter(pk__in = ids).delete()
-				count += 1
-			print( "Deleted %d records from %s" % ( count, self.tablename ) )
-
-	def to_db_bulk( self, zipfile ):
-		data = self.get_zip_data( zipfile )
-		created = 0
-		i = 0
-		objs = []
-
-		self.remove_old()
-
-		for row in csv.DictReader( data, self.fieldNames, delimiter=self.delimiter, quotechar=self.quote):
-			row = self.process_row( row )
-			objs.append( self.model( **row ) )
-			created += 1
-			if i == 10000:
-				with transaction.atomic():
-					self.model.objects.bulk_create( objs )
-					objs = []
-					i = 0
-					print( "Saved 10000 records of %s. Total %d" % (self.tableName, created) )
-				transaction.commit()
-			i += 1
-		with transaction.atomic():
-			self.model.objects.bulk_create( objs )
+	def read_rows( self, zipfile ):
+		with self.get_zip_data( zipfile ) as data:
+			for row in csv.DictReader( data, self.fieldNames, delimiter=self.delimiter, quotechar=self.quote):
+				yield row
 
-		transaction.commit()
+	def remove_old( self ):
+		# We can't do the natural self.model.objects.all().delete()
+		# because it gives errors ( too many sql variables ).
+		clear_tables( [ self.model ] )
+
+	def to_db_bulk( self, zipfile, clear=True, loader='orm' ):
+		start = time.time()
+		with count_queries() as queries:
+			created = self.load_bulk( zipfile, clear, loader )
+		self.loaded()
+		elapsed = time.time() - start
+		print( "Created %d records of %s in %d queries, %.1fs ( %d rows/sec ), peak memory %s" % ( created, self.tableName,
+				len( queries ), elapsed, created / elapsed if elapsed else 0, peak_memory() ) )
+		return created
+
+	def report_progress( self, count ):
+		print( "Saved %d records of %s" % ( count, self.tableName ) )
+
+	def load_bulk( self, zipfile, clear=True, loader='orm' ):
+		loader = get_loader( loader, self.model, progress=self.report_progress )
+		if clear:
+			self.remove_old()
 
-		print( "Created %d records of %s" % ( created, self.tableName ) )
+		return loader.load( self.process_row( row ) for row in self.read_rows( zipfile ) )
 
 	def to_db( self, zipfile ):
-		data = self.get_zip_data( zipfile )
 		created = 0
 		updated = 0
 		i = 0
 
-		with transaction.atomic():
-			self.remove_old()
-			for row in csv.DictReader( data, self.fieldNames, delimiter=self.delimiter, quotechar=self.quote):
-				row = self.process_row( row )
-				o,o_created = self.model.objects.get_or_create( **row )
-				if o_created:
-					created += 1
-				else:
-					updated += 1
-
-		transaction.commit()
-		print( "Created %d, updated %d, records of %s" % ( created, updated, self.tableName ) )
+		with count_queries() as queries:
+			with transaction.atomic():
+				self.remove_old()
+				for row in self.read_rows( zipfile ):
+					row = self.process_row( row )
+					o,o_created = self.model.objects.get_or_create( **row )
+					if o_created:
+						created += 1
+					else:
+						updated += 1
+
+			transaction.commit()
+		self.loaded()
+		print( "Created %d, updated %d, records of %s in %d queries, peak memory %s" % ( created, updated, self.tableName, len( queries ), peak_memory() ) )
 		return created, updated
 
-	def to_json( self, zipfile, outfile ):
-		data = self.get_zip_data( zipfile )
-		jsonobjs = []
-		for row in csv.DictReader( data, self.fieldNames, delimiter=self.delimiter, quotechar=self.quote):
-			jsonobjs.append( { "model": 'usda.'+self.tableName, "fields" : row } )
-
-		with open( outfile, 'w' ) as f:
-			json.dump( jsonobjs, f, indent=2 )
-			print( "Created %d json objects of type %s into file %s" % ( len( jsonobjs ), self.tableName, outfile ) )
-
-		return len( jsonobjs )
-
-	def to_yaml( self, zipfile, outfile ):
-		data = self.get_zip_data( zipfile )
-		yamlobjs = []
-		for row in csv.DictReader( data, self.fieldNames, delimiter=self.delimiter, quotechar=self.quote):
-			yamlobjs.append(  { "model": 'usda.'+self.tableName, "fields" : row } )
+	def row_digest( self, fields, values ):
+		# Compare the values the database would be given, so that e.g.
+		# Decimal( '1.5' ) and Decimal( '1.500' ) hash the same.
+		values = [ f.get_db_prep_save( v, connection ) for f, v in zip( fields, values ) ]
+		return hashlib.md5( repr( values ).encode( 'utf-8' ) ).digest()
+
+	def to_db_incremental( self, zipfile, loader='orm' ):
+		# Applies the inserts and updates that make the table match the file
+		# and returns the primary keys of the rows that have to be deleted.
+		# Those are left to the caller, which deletes them in reverse FK
+		# order once every table has been brought up to date.
+		rows = ( self.process_row( row ) for row in self.read_rows( zipfile ) )
+		try:
+			first = next( rows )
+		except StopIteration:
+			return list( self.model.objects.values_list( 'pk', flat=True ) )
+
+		pk = self.model._meta.pk
+		auto_pk = isinstance( pk, models.AutoField )
+		fields = [ f for f in self.model._meta.concrete_fields if f.attname in first and not ( auto_pk and f is pk ) ]
+		columns = [ f.attname for f in fields ]
+		key = self.naturalKey or ( pk.attname, )
+		key_index = [ columns.index( k ) for k in key ]
+
+		existing = {}
+		for values in self.model.objects.values_list( pk.attname, *columns ).iterator():
+			existing[ tuple( values[ 1 + i ] for i in key_index ) ] = ( values[ 0 ], self.row_digest( fields, values[ 1: ] ) )
+
+		next_id = ( self.model.objects.aggregate( m=models.Max( pk.attname ) )[ 'm' ] or 0 ) + 1 if auto_pk else None
+		seen = set()
+		updates = []
+		counts = { 'unchanged' : 0 }
+
+		def changed_rows():
+			nonlocal next_id
+			for row in itertools.chain( [ first ], rows ):
+				values = [ row[ c ] for c in columns ]
+				k = tuple( values[ i ] for i in key_index )
+				if k in seen:
+					raise CommandError( '%s has more than one row for %s %r' % ( self.fileName, ', '.join( key ), k ) )
+				seen.add( k )
+				old = existing.pop( k, None )
+				if old is None:
+					if auto_pk and pk.attname in row:
+						row[ pk.attname ] = next_id
+						next_id += 1
+					yield row
+				elif old[ 1 ] != self.row_digest( fields, values ):
+					row = dict( zip( columns, values ) )
+					row[ pk.attname ] = old[ 0 ]
+					updates.append( row )
+				else:
+					counts[ 'unchanged' ] += 1
+
+		inserted = get_loader( loader, self.model ).load( changed_rows() )
+		if updates:
+			self.update_rows( [ f for f in fields if f is not pk ], updates, loader )
+
+		self.loaded()
+		deleted = [ v[ 0 ] for v in existing.values() ]
+		print( "%s: %d inserted, %d updated, %d to delete, %d unchanged" % ( self.tableName, inserted, len( updates ), len( deleted ), counts[ 'unchanged' ] ) )
+		return deleted
+
+	def update_rows( self, fields, rows, loader ):
+		# Loads the changed rows, primary key included, into a temporary
+		# table through the loader and copies the given fields over from it
+		# in a single UPDATE. The orm loader only writes to the table of its
+		# model, executemany stands in for it.
+		qn = connection.ops.quote_name
+		table = qn( self.model._meta.db_table )
+		changed = '%s_changed' % self.model._meta.db_table
+		temp = qn( changed )
+		pk = qn( self.model._meta.pk.column )
+		columns = [ qn( f.column ) for f in fields ]
+		cursor = connection.cursor()
+		cursor.execute( 'CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s WHERE 1 = 0' % ( temp, ', '.join( [ pk ] + columns ), table ) )
+		get_loader( 'executemany' if loader == 'orm' else loader, self.model, table=changed ).load( rows )
+		if connection.vendor == 'mysql':
+			sql = 'UPDATE %s JOIN %s t ON %s.%s = t.%s SET %s' % ( table, temp, table, pk, pk,
+					', '.join( '%s.%s = t.%s' % ( table, c, c ) for c in columns ) )
+		elif connection.vendor == 'postgresql' or ( connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= ( 3, 33 ) ):
+			sql = 'UPDATE %s SET %s FROM %s t WHERE %s.%s = t.%s' % ( table, ', '.join( '%s = t.%s' % ( c, c ) for c in columns ),
+					temp, table, pk, pk )
+		else:
+			sql = 'UPDATE %s SET %s WHERE %s IN ( SELECT %s FROM %s )' % ( table, ', '.join( '%s = ( SELECT t.%s FROM %s t WHERE t.%s = %s.%s )' % (
+					c, c, temp, pk, table, pk ) for c in columns ), pk, pk, temp )
+		cursor.execute( sql )
+		cursor.execute( 'DROP TABLE %s' % temp )
+
+	def delete_rows( self, pks ):
+		# One DELETE by primary key per batch, after those of the rows of
+		# other tables referencing them, as the cascade of the ORM would.
+		qn = connection.ops.quote_name
+		pk = qn( self.model._meta.pk.column )
+		cursor = connection.cursor()
+		for i in range( 0, len( pks ), SQLITE_MAX_VARIABLES ):
+			batch = pks[ i:i + SQLITE_MAX_VARIABLES ]
+			delete_where( cursor, self.model, '%s IN (%s)' % ( pk, ', '.join( [ '%s' ] * len( batch ) ) ), batch )
+		print( "Deleted %d records from %s" % ( len( pks ), self.tableName ) )
+
+	def typed_rows( self, zipfile ):
+		# The rows as process_row makes them, from a fresh importer so the
+		# ids process_row hands out start over and references are written
+		# without a database to check them.
+		f = type( self )()
+		f.checkKeys = False
+		return ( f.process_row( row ) for row in f.read_rows( zipfile ) )
+
+	def fixtures( self, zipfile ):
+		# The rows as loaddata records: model, pk and fields by name with
+		# foreign keys as their codes. Decimals and dates are written as
+		# strings like Django's serializers do. Rows without a primary key
+		# are numbered in file order.
+		meta = self.model._meta
+		fields = dict( ( f.attname, f.name ) for f in meta.concrete_fields )
+		model = '%s.%s' % ( meta.app_label, meta.model_name )
+		for i, row in enumerate( self.typed_rows( zipfile ) ):
+			pk = row.pop( meta.pk.attname, i + 1 )
+			for attname, value in row.items():
+				if isinstance( value, ( decimal.Decimal, datetime.date ) ):
+					row[ attname ] = value.isoformat() if isinstance( value, datetime.date ) else str( value )
+			yield { 'model' : model, 'pk' : pk, 'fields' : dict( ( fields[ a ], v ) for a, v in row.items() ) }
+
+	def open_fixture( self, outfile, compress=False ):
+		if compress:
+			return gzip.open( outfile, 'wt', encoding='utf-8' )
+		return open( outfile, 'w', encoding='utf-8' )
+
+	def to_json( self, zipfile, outfile, compress=False ):
+		count = 0
+		with self.open_fixture( outfile, compress ) as f:
+			f.write( '[' )
+			for record in self.fixtures( zipfile ):
+				if count:
+					f.write( ',' )
+				f.write( '\n' )
+				f.write( json.dumps( record, indent=2, sort_keys=True ) )
+				count += 1
+			f.write( '\n]\n' )
+		print( "Created %d json objects of type %s into file %s, peak memory %s" % ( count, self.tableName, outfile, peak_memory() ) )
+
+		return count
+
+	def to_yaml( self, zipfile, outfile, compress=False ):
+		count = 0
+		with self.open_fixture( outfile, compress ) as f:
+			# Each record is dumped as a one element list, which concatenate
+			# into the same top level list a single dump would produce.
+			for record in self.fixtures( zipfile ):
+				f.write( yaml.dump( [ record ], Dumper=YAML_DUMPER, indent=2, default_flow_style=False, allow_unicode=True ) )
+				count += 1
+		print( "Created %d yaml objects of type %s into file %s, peak memory %s" % ( count, self.tableName, outfile, peak_memory() ) )
 
-		with open( outfile, 'w' ) as f:
-			yaml.dump( yamlobjs, f, indent=2 )
-			print( "Created %d yaml objects of type %s into file %s" % ( len( yamlobjs ), self.tableName, outfile ) )
+		return count
 
-		return len( yamlobjs )
+	def to_snapshot( self, zipfile, writer ):
+		count = writer.write_table( self.model, self.typed_rows( zipfile ) )
+		print( "Wrote %d records of %s to the snapshot, peak memory %s" % ( count, self.tableName, peak_memory() ) )
+		return count
 
 	def to_decimal( self, row, field ):
 		if row[ field ] != '':
@@ -223,11 +606,31 @@ class USDAFile( object ):
 			row[ field ] = None
 		return row
 
+	def get_keys( self, model ):
+		# Every primary key of a referenced table is loaded once, so rows
+		# can be resolved by assigning the raw *_id without a query each.
+		# The reference tables come from the registry the views use.
+		if model not in self.keys:
+			if model in registry.MODELS:
+				self.keys[ model ] = registry.registry.table( model )
+			else:
+				self.keys[ model ] = set( model.objects.values_list( 'pk', flat=True ) )
+		return self.keys[ model ]
+
+	def loaded( self ):
+		# Called once the table has been written, so that the registry
+		# does not keep serving the codes it held before.
+		if self.model in registry.MODELS:
+			registry.registry.invalidate()
+
 	def to_object( self, row, field, model ):
-		if row[ field ] != '':
-			row[ field ] = model.objects.get( pk = row[field] )
+		value = row.pop( field )
+		if value == '':
+			row[ field + '_id' ] = None
+		elif not self.checkKeys or value in self.get_keys( model ):
+			row[ field + '_id' ] = value
 		else:
-			row[ field ] = None
+			raise CommandError( '%s references unknown %s %r in column %s' % ( self.fileName, model.__name__, value, field ) )
 		return row
 
 class FoodGroupFile( USDAFile ):
@@ -284,6 +687,7 @@ class LanguaLFactorFile( USDAFile ):
 	fieldNames = ( 'food', 'factor' )
 	tableName = 'langualfactor'
 	model = LanguaLFactor
+	naturalKey = ( 'food_id', 'factor_id' )
 
 	def process_row( self, row ):
 		row = self.to_object( row, 'food', Food )
@@ -294,6 +698,7 @@ class NutrientFile( USDAFile ):
 	fileName = 'NUT_DATA.txt'
 	tableName = 'nutrient'
 	model = Nutrient
+	naturalKey = ( 'food_id', 'nutrient_id' )
 	fieldNames = ( 'food', 'nutrient', 'amount', 'num_data_points',
 			'std_error', 'data_type', 'derivation', 'reference_food',
 			'added_nutrition', 'num_studies', 'min_value', 'max_value',
@@ -323,10 +728,12 @@ class WeightFile( USDAFile ):
 	fileName = 'WEIGHT.txt'
 	tableName = 'gramweight'
 	model = GramWeight
+	naturalKey = ( 'food_id', 'sequence' )
 	fieldNames = ( 'food', 'sequence', 'amount', 'description'
 			, 'weight', 'num_data_points', 'std_deviation' )
 
-	next_id = 0
+	# Rows are numbered from 1, like the sequences of the database do.
+	next_id = 1
 	def process_row( self, row ):
 		row = self.to_object( row, 'food', Food )
 		row = self.to_int( row, 'num_data_points' )
@@ -341,9 +748,10 @@ class FootnoteFile( USDAFile ):
 	fileName = 'FOOTNOTE.txt'
 	tableName = 'footnote'
 	model = Footnote
+	naturalKey = ( 'food_id', 'sequence', 'type_code', 'nutrient_definition_id' )
 	fieldNames = ( 'food', 'sequence', 'type_code',
 			'nutrient_definition', 'text' )
-	next_id = 0
+	next_id = 1
 	def process_row( self, row ):
 		row = self.to_object( row, 'food', Food )
 		row = self.to_object( row, 'nutrient_definition', NutrientDefinition )
@@ -363,6 +771,7 @@ class DataSourceLinkFile( USDAFile ):
 	fileName = 'DATSRCLN.txt'
 	tableName = 'datasourcelink'
 	model = DataSourceLink
+	naturalKey = ( 'food_id', 'nutrient_definition_id', 'data_source_id' )
 	fieldNames = ( 'food', 'nutrient_definition', 'data_source' )
 
 	def process_row( self, row ):
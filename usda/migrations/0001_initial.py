@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoodGroup',
+            fields=[
+                ('food_group_code', models.CharField(max_length=4, serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=60)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Food',
+            fields=[
+                ('nbd_no', models.CharField(max_length=5, serialize=False, primary_key=True)),
+                ('long_desc', models.CharField(max_length=200)),
+                ('short_desc', models.CharField(max_length=60)),
+                ('common_name', models.CharField(max_length=100, blank=True)),
+                ('manufacturer_name', models.CharField(max_length=65, blank=True)),
+                ('survey', models.NullBooleanField()),
+                ('refuse_desc', models.CharField(max_length=135, blank=True)),
+                ('refuse_percent', models.IntegerField(null=True, blank=True)),
+                ('scientific_name', models.CharField(max_length=65, blank=True)),
+                ('nitrogen_factor', models.DecimalField(null=True, max_digits=6, decimal_places=2, blank=True)),
+                ('protein_factor', models.DecimalField(null=True, max_digits=6, decimal_places=2, blank=True)),
+                ('fat_factor', models.DecimalField(null=True, max_digits=6, decimal_places=2, blank=True)),
+                ('carb_factor', models.DecimalField(null=True, max_digits=6, decimal_places=2, blank=True)),
+                ('food_group', models.ForeignKey(to='usda.FoodGroup')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='food',
+            index_together=set([('short_desc', 'nbd_no')]),
+        ),
+        migrations.CreateModel(
+            name='LanguaLFactorDescription',
+            fields=[
+                ('code', models.CharField(max_length=5, serialize=False, primary_key=True)),
+                ('description', models.CharField(max_length=140)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='LanguaLFactor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('factor', models.ForeignKey(to='usda.LanguaLFactorDescription')),
+                ('food', models.ForeignKey(to='usda.Food')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='langualfactordescription',
+            name='food',
+            field=models.ManyToManyField(to='usda.Food', through='usda.LanguaLFactor'),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='DataType',
+            fields=[
+                ('code', models.CharField(max_length=2, serialize=False, primary_key=True)),
+                ('description', models.CharField(max_length=60)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DataDerivation',
+            fields=[
+                ('code', models.CharField(max_length=4, serialize=False, primary_key=True)),
+                ('description', models.CharField(max_length=120)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='NutrientDefinition',
+            fields=[
+                ('code', models.CharField(max_length=3, serialize=False, primary_key=True)),
+                ('units', models.CharField(max_length=7)),
+                ('tagname', models.CharField(max_length=20, blank=True)),
+                ('name', models.CharField(max_length=60)),
+                ('num_decimal_places', models.IntegerField()),
+                ('sr_order', models.IntegerField()),
+                ('daily_amount', models.DecimalField(null=True, max_digits=13, decimal_places=3, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Nutrient',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('amount', models.DecimalField(max_digits=13, decimal_places=3)),
+                ('num_data_points', models.IntegerField()),
+                ('std_error', models.DecimalField(null=True, max_digits=11, decimal_places=3, blank=True)),
+                ('added_nutrition', models.NullBooleanField()),
+                ('num_studies', models.IntegerField(null=True, blank=True)),
+                ('min_value', models.DecimalField(null=True, max_digits=13, decimal_places=3, blank=True)),
+                ('max_value', models.DecimalField(null=True, max_digits=13, decimal_places=3, blank=True)),
+                ('degrees_of_freedom', models.IntegerField(null=True, blank=True)),
+                ('lower_error_bound', models.DecimalField(null=True, max_digits=13, decimal_places=3, blank=True)),
+                ('upper_error_bound', models.DecimalField(null=True, max_digits=13, decimal_places=3, blank=True)),
+                ('statistical_comments', models.CharField(max_length=10, blank=True)),
+                ('last_modified', models.DateField(null=True, blank=True)),
+                ('confidence_code', models.CharField(max_length=1, blank=True)),
+                ('data_type', models.ForeignKey(to='usda.DataType')),
+                ('derivation', models.ForeignKey(blank=True, to='usda.DataDerivation', null=True)),
+                ('food', models.ForeignKey(to='usda.Food')),
+                ('nutrient', models.ForeignKey(to='usda.NutrientDefinition')),
+                ('reference_food', models.ForeignKey(related_name='reference_food', blank=True, to='usda.Food', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='nutrient',
+            unique_together=set([('food', 'nutrient')]),
+        ),
+        migrations.AddField(
+            model_name='nutrientdefinition',
+            name='food',
+            field=models.ManyToManyField(to='usda.Food', through='usda.Nutrient'),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='GramWeight',
+            fields=[
+                ('sequence', models.CharField(max_length=2)),
+                ('amount', models.DecimalField(max_digits=8, decimal_places=3)),
+                ('description', models.CharField(max_length=84)),
+                ('weight', models.DecimalField(max_digits=8, decimal_places=1)),
+                ('num_data_points', models.IntegerField(null=True, blank=True)),
+                ('std_deviation', models.DecimalField(null=True, max_digits=10, decimal_places=3, blank=True)),
+                ('id', models.AutoField(serialize=False, primary_key=True)),
+                ('food', models.ForeignKey(to='usda.Food')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Footnote',
+            fields=[
+                ('sequence', models.CharField(max_length=4)),
+                ('type_code', models.CharField(max_length=1)),
+                ('text', models.CharField(max_length=200)),
+                ('id', models.AutoField(serialize=False, primary_key=True)),
+                ('food', models.ForeignKey(to='usda.Food')),
+                ('nutrient_definition', models.ForeignKey(blank=True, to='usda.NutrientDefinition', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DataSource',
+            fields=[
+                ('code', models.CharField(max_length=6, serialize=False, primary_key=True)),
+                ('authors', models.CharField(max_length=255, blank=True)),
+                ('title', models.CharField(max_length=255)),
+                ('year', models.CharField(max_length=4, blank=True)),
+                ('journal', models.CharField(max_length=135, blank=True)),
+                ('volume_city', models.CharField(max_length=16, blank=True)),
+                ('issue_state', models.CharField(max_length=5, blank=True)),
+                ('start_page', models.CharField(max_length=5, blank=True)),
+                ('end_page', models.CharField(max_length=5, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DataSourceLink',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('data_source', models.ForeignKey(to='usda.DataSource')),
+                ('food', models.ForeignKey(to='usda.Food')),
+                ('nutrient_definition', models.ForeignKey(to='usda.NutrientDefinition')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='nutrient',
+            field=models.ManyToManyField(to='usda.NutrientDefinition', through='usda.DataSourceLink'),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='DatasetVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('modified', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
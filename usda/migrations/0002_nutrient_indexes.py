@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import usda.models
+
+
+class Migration(migrations.Migration):
+    # The indexes the food page and the nutrient queries read through. The
+    # Nutrient amounts become AmountFields, still decimal columns whatever
+    # USDA_FLOAT_AMOUNTS is, the amount_columns command converts them.
+
+    dependencies = [
+        ('usda', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='nutrient',
+            index_together=set([('nutrient', 'amount')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='footnote',
+            index_together=set([('food', 'nutrient_definition')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='datasourcelink',
+            index_together=set([('food', 'nutrient_definition')]),
+        ),
+        migrations.AlterField(
+            model_name='nutrient',
+            name='amount',
+            field=usda.models.AmountField(max_digits=13, decimal_places=3),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='nutrient',
+            name='std_error',
+            field=usda.models.AmountField(max_digits=11, decimal_places=3, blank=True, null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='nutrient',
+            name='min_value',
+            field=usda.models.AmountField(max_digits=13, decimal_places=3, blank=True, null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='nutrient',
+            name='max_value',
+            field=usda.models.AmountField(max_digits=13, decimal_places=3, blank=True, null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='nutrient',
+            name='lower_error_bound',
+            field=usda.models.AmountField(max_digits=13, decimal_places=3, blank=True, null=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='nutrient',
+            name='upper_error_bound',
+            field=usda.models.AmountField(max_digits=13, decimal_places=3, blank=True, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usda', '0002_nutrient_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('loader', models.CharField(max_length=20)),
+                ('phase', models.CharField(default='queued', max_length=10, choices=[('queued', 'queued'), ('counting', 'counting'), ('loading', 'loading'), ('swapping', 'swapping'), ('indexing', 'indexing'), ('done', 'done'), ('failed', 'failed')])),
+                ('table', models.CharField(max_length=40, blank=True)),
+                ('rows_done', models.BigIntegerField(default=0)),
+                ('rows_total', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True, blank=True)),
+                ('updated', models.DateTimeField(null=True, blank=True)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
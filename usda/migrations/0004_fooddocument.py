@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usda', '0003_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoodDocument',
+            fields=[
+                ('food', models.OneToOneField(related_name='document', primary_key=True, serialize=False, to='usda.Food')),
+                ('data', models.BinaryField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usda', '0004_fooddocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyValueProfile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.SlugField(unique=True, max_length=40)),
+                ('description', models.CharField(max_length=200, blank=True)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('is_default', models.BooleanField(default=False)),
+                ('modified', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DailyValue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('amount', models.DecimalField(max_digits=13, decimal_places=3)),
+                ('nutrient', models.ForeignKey(to='usda.NutrientDefinition')),
+                ('profile', models.ForeignKey(related_name='daily_values', to='usda.DailyValueProfile')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyvalue',
+            unique_together=set([('profile', 'nutrient')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usda', '0005_dailyvalueprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='active',
+            field=models.NullBooleanField(unique=True, editable=False),
+            preserve_default=True,
+        ),
+    ]
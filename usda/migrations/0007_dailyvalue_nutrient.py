@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('usda', '0006_importjob_active'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dailyvalue',
+            name='nutrient',
+            field=models.ForeignKey(to='usda.NutrientDefinition', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING),
+            preserve_default=True,
+        ),
+    ]
@@ -1,8 +1,39 @@
+from collections import namedtuple
+
+from django.conf import settings
 from django.db import models
 from django.core.urlresolvers import reverse
+from django.utils.datastructures import DictWrapper
 
 # Create your models here.
 
+# With USDA_FLOAT_AMOUNTS the amounts of the Nutrient table are stored as
+# doubles instead of decimals: smaller rows, faster scans and no Decimal
+# objects to build on every read, for values that SR27 only gives to three
+# decimal places anyway. The migrations create decimal columns whatever the
+# setting, ./manage.py amount_columns float converts them.
+FLOAT_AMOUNTS = getattr( settings, 'USDA_FLOAT_AMOUNTS', False )
+
+class AmountField( models.DecimalField ):
+	# A DecimalField to the migrations and the schema, a FloatField to the
+	# values read and written when USDA_FLOAT_AMOUNTS is set.
+	def get_internal_type( self ):
+		return 'FloatField' if FLOAT_AMOUNTS else 'DecimalField'
+
+	def db_type( self, connection ):
+		data = DictWrapper( self.__dict__, connection.ops.quote_name, 'qn_' )
+		return connection.creation.data_types[ 'DecimalField' ] % data
+
+	def to_python( self, value ):
+		if FLOAT_AMOUNTS:
+			return models.FloatField.to_python( self, value )
+		return super( AmountField, self ).to_python( value )
+
+	def get_db_prep_save( self, value, connection ):
+		if FLOAT_AMOUNTS:
+			return self.to_python( value )
+		return super( AmountField, self ).get_db_prep_save( value, connection )
+
 class FoodGroup(models.Model):
 	food_group_code = models.CharField(max_length=4, primary_key=True)
 	name = models.CharField(max_length=60)
@@ -25,6 +56,10 @@ class Food(models.Model):
 	fat_factor = models.DecimalField(max_digits=6,decimal_places=2,blank=True, null=True)
 	carb_factor = models.DecimalField(max_digits=6,decimal_places=2,blank=True, null=True)
 
+	class Meta:
+		# The food listing seeks through this order.
+		index_together = ( ( 'short_desc', 'nbd_no' ), )
+
 	def __str__( self ):
 		return self.short_desc
 
@@ -61,28 +96,43 @@ class NutrientDefinition(models.Model):
 	def __str__( self ):
 		return self.name
 
+# The columns of Nutrient that pages and APIs read, see NutrientQuerySet.lean().
+NutrientValue = namedtuple( 'NutrientValue', ( 'food_id', 'nutrient_id', 'amount', 'added_nutrition' ) )
+
+class NutrientQuerySet( models.QuerySet ):
+
+	def lean( self ):
+		# The matching rows as NutrientValue tuples, reading only their
+		# columns and building no model instances.
+		return [ NutrientValue( *row ) for row in self.values_list( 'food', 'nutrient', 'amount', 'added_nutrition' ) ]
+
 class Nutrient(models.Model):
 	food = models.ForeignKey( Food, to_field='nbd_no' )
 	nutrient = models.ForeignKey( NutrientDefinition, to_field='code' )
-	amount = models.DecimalField(max_digits=13,decimal_places=3)
+	amount = AmountField(max_digits=13,decimal_places=3)
 	num_data_points = models.IntegerField()
-	std_error = models.DecimalField(max_digits=11,decimal_places=3, blank=True, null=True)
+	std_error = AmountField(max_digits=11,decimal_places=3, blank=True, null=True)
 	data_type = models.ForeignKey( DataType, to_field='code' )
 	derivation = models.ForeignKey( DataDerivation, blank=True, null=True, to_field='code' )
 	reference_food = models.ForeignKey( Food, blank=True, null=True, related_name='reference_food', to_field='nbd_no' )
 	added_nutrition = models.NullBooleanField( blank=True, null=True )
 	num_studies = models.IntegerField( blank=True,null=True )
-	min_value = models.DecimalField(max_digits=13,decimal_places=3, blank=True, null=True )
-	max_value = models.DecimalField(max_digits=13,decimal_places=3, blank=True, null=True )
+	min_value = AmountField(max_digits=13,decimal_places=3, blank=True, null=True )
+	max_value = AmountField(max_digits=13,decimal_places=3, blank=True, null=True )
 	degrees_of_freedom = models.IntegerField( blank=True, null=True )
-	lower_error_bound = models.DecimalField(max_digits=13,decimal_places=3, blank=True, null=True )
-	upper_error_bound = models.DecimalField(max_digits=13,decimal_places=3, blank=True, null=True )
+	lower_error_bound = AmountField(max_digits=13,decimal_places=3, blank=True, null=True )
+	upper_error_bound = AmountField(max_digits=13,decimal_places=3, blank=True, null=True )
 	statistical_comments = models.CharField(max_length=10, blank=True)
 	last_modified = models.DateField( blank=True, null=True )
 	confidence_code = models.CharField(max_length=1, blank=True)
 
+	objects = NutrientQuerySet.as_manager()
+
 	class Meta:
+		# The unique index serves the ( food, nutrient ) lookups of a food's
+		# page, the other one threshold queries and ranking by amount.
 		unique_together = ( 'food', 'nutrient' )
+		index_together = ( ( 'nutrient', 'amount' ), )
 
 class GramWeight(models.Model):
 	food = models.ForeignKey( Food, to_field='nbd_no' )
@@ -105,6 +155,9 @@ class Footnote(models.Model):
 	text = models.CharField(max_length=200)
 	id = models.AutoField( primary_key=True )
 
+	class Meta:
+		index_together = ( ( 'food', 'nutrient_definition' ), )
+
 
 class DataSource(models.Model):
 	code = models.CharField(max_length=6,primary_key=True)
@@ -125,3 +178,93 @@ class DataSourceLink(models.Model):
 	food = models.ForeignKey( Food, to_field='nbd_no' )
 	nutrient_definition = models.ForeignKey( NutrientDefinition, to_field='code' )
 	data_source = models.ForeignKey( DataSource, to_field='code' )
+
+	class Meta:
+		index_together = ( ( 'food', 'nutrient_definition' ), )
+
+class FoodDocument(models.Model):
+	# Everything the food page and api/food/ show of a food, precomputed
+	# by usda.documents after each import as zlib compressed JSON.
+	food = models.OneToOneField( Food, primary_key=True, to_field='nbd_no', related_name='document' )
+	data = models.BinaryField()
+
+class DailyValueProfile(models.Model):
+	# A set of daily values, of a labelling standard or an age group, loaded
+	# by load_daily. version goes up whenever its values change. The default
+	# profile is copied to NutrientDefinition.daily_amount, the others are
+	# picked per request with ?dv=<name>.
+	name = models.SlugField( max_length=40, unique=True )
+	description = models.CharField( max_length=200, blank=True )
+	version = models.PositiveIntegerField( default=0 )
+	is_default = models.BooleanField( default=False )
+	modified = models.DateTimeField( blank=True, null=True )
+
+	def __str__( self ):
+		return self.name
+
+class DailyValue(models.Model):
+	# The nutrient codes stay the same from one SR release to the next, so
+	# the values are kept while load_sr27 reloads the nutrient definitions,
+	# which a database constraint or a cascading delete would not allow.
+	profile = models.ForeignKey( DailyValueProfile, related_name='daily_values' )
+	nutrient = models.ForeignKey( NutrientDefinition, to_field='code', db_constraint=False, on_delete=models.DO_NOTHING )
+	amount = models.DecimalField( max_digits=13, decimal_places=3 )
+
+	class Meta:
+		unique_together = ( ( 'profile', 'nutrient' ), )
+
+class DatasetVersion(models.Model):
+	# A single row, bumped by load_sr27 and load_daily whenever they
+	# change the data, which invalidates everything cached for it.
+	version = models.PositiveIntegerField( default=0 )
+	modified = models.DateTimeField( blank=True, null=True )
+
+class ImportJob(models.Model):
+	# An SR27 import run in the background by usda.jobs, with the progress
+	# the imports API reports.
+	QUEUED = 'queued'
+	COUNTING = 'counting'
+	LOADING = 'loading'
+	SWAPPING = 'swapping'
+	INDEXING = 'indexing'
+	DONE = 'done'
+	FAILED = 'failed'
+	PHASES = ( QUEUED, COUNTING, LOADING, SWAPPING, INDEXING, DONE, FAILED )
+
+	filename = models.CharField( max_length=255 )
+	loader = models.CharField( max_length=20 )
+	phase = models.CharField( max_length=10, choices=[ ( p, p ) for p in PHASES ], default=QUEUED )
+	table = models.CharField( max_length=40, blank=True )
+	rows_done = models.BigIntegerField( default=0 )
+	rows_total = models.BigIntegerField( default=0 )
+	created = models.DateTimeField( auto_now_add=True )
+	started = models.DateTimeField( blank=True, null=True )
+	updated = models.DateTimeField( blank=True, null=True )
+	finished = models.DateTimeField( blank=True, null=True )
+	error = models.TextField( blank=True )
+	# True while the job runs, None once it is done or failed. Being
+	# unique, it lets only one job run whatever the timing of the requests.
+	active = models.NullBooleanField( unique=True, editable=False )
+
+	def running( self ):
+		return self.phase not in ( self.DONE, self.FAILED )
+
+	def progress( self, now=None ):
+		# Rows per second over the loading so far and the time left at
+		# that rate, rows_total being counted from the zip beforehand.
+		seconds = None
+		if self.started:
+			seconds = ( ( self.finished or now or self.updated or self.started ) - self.started ).total_seconds()
+		rate = self.rows_done / seconds if seconds else None
+		eta = None
+		if rate and self.phase == self.LOADING:
+			eta = round( max( self.rows_total - self.rows_done, 0 ) / rate, 1 )
+		return { 'id' : self.pk, 'filename' : self.filename, 'loader' : self.loader, 'phase' : self.phase, 'table' : self.table,
+				'rows_done' : self.rows_done, 'rows_total' : self.rows_total,
+				'percent' : round( 100.0 * self.rows_done / self.rows_total, 1 ) if self.rows_total else None,
+				'rows_per_sec' : round( rate, 1 ) if rate else None, 'eta_seconds' : eta,
+				'elapsed_seconds' : round( seconds, 1 ) if seconds is not None else None,
+				'created' : self.created.isoformat() if self.created else None,
+				'started' : self.started.isoformat() if self.started else None,
+				'finished' : self.finished.isoformat() if self.finished else None,
+				'error' : self.error }
@@ -0,0 +1,102 @@
+from array import array
+import math
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from usda.models import Nutrient, GramWeight
+from usda.registry import nutrient_definitions
+
+# Per serving nutrient amounts and %DV, computed for all nutrients and all
+# servings of a food at once instead of one Decimal cell at a time.
+# numpy is used when it is installed, otherwise plain float arrays.
+
+# Stay below the SQLite limit on host parameters in an IN ( ... ) clause.
+CHUNK_SIZE = 900
+
+def chunks( values, size=CHUNK_SIZE ):
+	values = list( values )
+	for i in range( 0, len( values ), size ):
+		yield values[ i:i + size ]
+
+def round_half_up( value, places ):
+	# The rounding of both NutritionMatrix paths : halves go up, on the
+	# value scaled by the same float operations, so that they agree to the
+	# last digit whether numpy is installed or not.
+	scale = 10.0 ** places
+	return math.floor( value * scale + 0.5 ) / scale
+
+class NutritionMatrix( object ):
+	# amounts are per 100g, one per nutrient, daily_amounts may hold None
+	# for nutrients without a daily value and grams are the serving
+	# weights. The results are lists of rows, one per nutrient, with a
+	# column per serving.
+	def __init__( self, amounts, daily_amounts, decimal_places, grams ):
+		self.grams = [ float( g ) for g in grams ]
+		amounts = [ float( a ) for a in amounts ]
+		daily_amounts = [ float( d ) if d else 0.0 for d in daily_amounts ]
+		decimal_places = [ int( d ) for d in decimal_places ]
+		if numpy is not None:
+			self.amounts, self.daily_values = self.compute_numpy( amounts, daily_amounts, decimal_places )
+		else:
+			self.amounts, self.daily_values = self.compute_array( amounts, daily_amounts, decimal_places )
+
+	def compute_numpy( self, amounts, daily_amounts, decimal_places ):
+		grams = numpy.array( self.grams, dtype=float ) / 100
+		scale = 10.0 ** numpy.array( decimal_places, dtype=float )[ :, None ]
+		values = numpy.outer( numpy.array( amounts, dtype=float ), grams )
+		rounded = numpy.floor( values * scale + 0.5 ) / scale
+		daily = numpy.array( daily_amounts, dtype=float )[ :, None ]
+		with numpy.errstate( divide='ignore', invalid='ignore' ):
+			dv = numpy.floor( values / daily * 100 * 10.0 + 0.5 ) / 10.0
+		dv = [ [ v if d else None for v in row ] for row, d in zip( dv.tolist(), daily_amounts ) ]
+		return rounded.tolist(), dv
+
+	def compute_array( self, amounts, daily_amounts, decimal_places ):
+		grams = array( 'd', [ g / 100 for g in self.grams ] )
+		rounded = []
+		dv = []
+		for amount, daily, places in zip( amounts, daily_amounts, decimal_places ):
+			values = array( 'd', [ amount * g for g in grams ] )
+			rounded.append( [ round_half_up( v, places ) for v in values ] )
+			dv.append( [ round_half_up( v / daily * 100, 1 ) if daily else None for v in values ] )
+		return rounded, dv
+
+class FoodNutrition( object ):
+	# The nutrients of one food, in sr_order, with their amounts for 100g
+	# followed by every GramWeight of the food. The nutrient definitions
+	# come from the registry unless they are given, the %DV from their
+	# daily_amount unless the daily amounts of a profile are.
+	def __init__( self, food_id, nutrients, weights, definitions=None, daily_amounts=None ):
+		if definitions is None:
+			definitions = nutrient_definitions()
+		self.food_id = food_id
+		self.nutrients = sorted( nutrients, key=lambda n: definitions[ n.nutrient_id ].sr_order )
+		self.weights = weights
+		self.definitions = definitions = [ definitions[ n.nutrient_id ] for n in self.nutrients ]
+		self.matrix = NutritionMatrix( [ n.amount for n in self.nutrients ],
+				[ d.daily_amount for d in definitions ] if daily_amounts is None else [ daily_amounts.get( d.code ) for d in definitions ],
+				[ d.num_decimal_places for d in definitions ],
+				[ 100 ] + [ w.weight for w in weights ] )
+
+	def rows( self ):
+		return zip( self.nutrients, self.definitions, self.matrix.amounts, self.matrix.daily_values )
+
+def food_nutrition( food_ids, nutrient_codes=None, daily_amounts=None ):
+	# Nutrition of many foods, from one nutrient and one weight query per
+	# chunk of foods. Returns a dict of FoodNutrition keyed by nbd_no.
+	nutrients = {}
+	weights = {}
+	for ids in chunks( food_ids ):
+		query = Nutrient.objects.filter( food__in=ids )
+		if nutrient_codes is not None:
+			query = query.filter( nutrient__in=nutrient_codes )
+		for n in query.lean():
+			nutrients.setdefault( n.food_id, [] ).append( n )
+		for w in GramWeight.objects.filter( food__in=ids ).order_by( 'food', 'sequence' ):
+			weights.setdefault( w.food_id, [] ).append( w )
+	definitions = nutrient_definitions()
+	return dict( ( food_id, FoodNutrition( food_id, nutrients.get( food_id, [] ), weights.get( food_id, [] ), definitions, daily_amounts ) )
+			for food_id in food_ids )
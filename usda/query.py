@@ -0,0 +1,107 @@
+import re
+
+from django.apps import apps as live_apps
+from django.db import connection, transaction
+
+from usda.registry import nutrient_definitions
+
+# Nutrient threshold queries such as "protein > 20 and sodium < 140 per
+# 100g, sorted by fiber". They run against usda_foodnutrients, a food by
+# nutrient wide table with one indexed column per nutrient, which
+# rebuild_table() derives from the Nutrient table. load_sr27 rebuilds it
+# after an import.
+
+TABLE = 'usda_foodnutrients'
+OPERATORS = ( '>=', '<=', '>', '<', '=' )
+
+PREDICATE = re.compile( r'^\s*(\w+)\s*(%s)\s*(-?\d+(?:\.\d+)?)\s*$' % '|'.join( re.escape( o ) for o in OPERATORS ) )
+
+class QueryError( ValueError ):
+	pass
+
+def column( code ):
+	return 'n_%s' % code
+
+def rebuild_table( table=TABLE, apps=live_apps ):
+	# Into table from the tables of apps, the live ones or the shadow ones
+	# of an import.
+	codes = list( apps.get_model( 'usda', 'NutrientDefinition' ).objects.order_by( 'code' ).values_list( 'code', flat=True ) )
+	qn = connection.ops.quote_name
+	food = apps.get_model( 'usda', 'Food' )._meta
+	nutrient = apps.get_model( 'usda', 'Nutrient' )._meta
+	food_pk = qn( food.pk.column )
+	with transaction.atomic():
+		cursor = connection.cursor()
+		cursor.execute( 'DROP TABLE IF EXISTS %s' % table )
+		cursor.execute( 'CREATE TABLE %s ( nbd_no varchar(5) PRIMARY KEY, food_group varchar(4), short_desc varchar(60)%s )' % (
+				table, ''.join( ', %s double precision' % column( c ) for c in codes ) ) )
+		# Pivot the nutrients of each food into its row in one statement.
+		cursor.execute( 'INSERT INTO %s SELECT f.%s, f.%s, f.%s%s FROM %s f LEFT JOIN %s n ON n.%s = f.%s GROUP BY f.%s, f.%s, f.%s' % (
+				table, food_pk, qn( food.get_field( 'food_group' ).column ), qn( food.get_field( 'short_desc' ).column ),
+				''.join( ', MAX( CASE WHEN n.%s = %%s THEN n.%s END )' % (
+					qn( nutrient.get_field( 'nutrient' ).column ), qn( nutrient.get_field( 'amount' ).column ) ) for c in codes ),
+				qn( food.db_table ), qn( nutrient.db_table ), qn( nutrient.get_field( 'food' ).column ), food_pk,
+				food_pk, qn( food.get_field( 'food_group' ).column ), qn( food.get_field( 'short_desc' ).column ) ), codes )
+		cursor.execute( 'CREATE INDEX %s_food_group ON %s ( food_group )' % ( table, table ) )
+		for c in codes:
+			cursor.execute( 'CREATE INDEX %s_%s ON %s ( %s )' % ( table, column( c ), table, column( c ) ) )
+	return len( codes )
+
+def nutrient_codes():
+	# Nutrients by code and by lower case tagname, e.g. '203' and 'procnt'.
+	codes = {}
+	for d in nutrient_definitions().values():
+		codes[ d.code ] = d.code
+		if d.tagname:
+			codes[ d.tagname.lower() ] = d.code
+	return codes
+
+def parse_predicates( text, codes=None ):
+	# "203 > 20, sodium < 140" into [ ( '203', '>', 20.0 ), ... ]
+	if codes is None:
+		codes = nutrient_codes()
+	predicates = []
+	for part in re.split( r'[,;]|\band\b', text ):
+		if not part.strip():
+			continue
+		match = PREDICATE.match( part )
+		if not match:
+			raise QueryError( 'Can not understand "%s", use e.g. 203 > 20' % part.strip() )
+		name, op, value = match.groups()
+		if name.lower() not in codes:
+			raise QueryError( 'Unknown nutrient %s' % name )
+		predicates.append( ( codes[ name.lower() ], op, float( value ) ) )
+	return predicates
+
+def find_foods( predicates, food_groups=None, order_by=None, descending=True, limit=100 ):
+	# Foods whose per 100g amounts satisfy every ( code, operator, value )
+	# predicate. Returns ( nbd_no, short_desc, food_group, amounts ) tuples
+	# with the amounts of the nutrients used, keyed by code.
+	used = []
+	for code, op, value in predicates:
+		if op not in OPERATORS:
+			raise QueryError( 'Unknown operator %s' % op )
+		if code not in used:
+			used.append( code )
+	if order_by and order_by not in used:
+		used.append( order_by )
+	for code in used:
+		if not re.match( r'^\w+$', code ):
+			raise QueryError( 'Unknown nutrient %s' % code )
+
+	where = [ '%s %s %%s' % ( column( code ), op ) for code, op, value in predicates ]
+	params = [ value for code, op, value in predicates ]
+	if food_groups:
+		where.append( 'food_group IN (%s)' % ', '.join( [ '%s' ] * len( food_groups ) ) )
+		params.extend( food_groups )
+	if order_by:
+		where.append( '%s IS NOT NULL' % column( order_by ) )
+		order = '%s %s, short_desc' % ( column( order_by ), 'DESC' if descending else 'ASC' )
+	else:
+		order = 'short_desc'
+	sql = 'SELECT nbd_no, short_desc, food_group%s FROM %s%s ORDER BY %s LIMIT %%s' % (
+			''.join( ', %s' % column( c ) for c in used ), TABLE,
+			' WHERE ' + ' AND '.join( where ) if where else '', order )
+	cursor = connection.cursor()
+	cursor.execute( sql, params + [ limit ] )
+	return [ ( r[0], r[1], r[2], dict( zip( used, r[3:] ) ) ) for r in cursor.fetchall() ]
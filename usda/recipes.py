@@ -0,0 +1,159 @@
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from usda.models import Food, Nutrient, GramWeight
+from usda.nutrition import chunks, round_half_up
+from usda.registry import nutrient_definitions
+
+# Nutrition totals of recipes and meals. An ingredient is ( nbd_no, sequence )
+# for one serving of that GramWeight of the food, ( nbd_no, grams ) for a
+# weight as purchased, or either with a third item, the number of servings.
+# Weights as purchased lose the food's refuse_percent, the GramWeight weights
+# are edible portions already. Nutrients a food has no value for count as 0.
+#
+# Many meals are totalled at once by aggregate_many(), which loads all of
+# their foods with one query per table and, with numpy, computes all of the
+# totals with one matrix product.
+
+class RecipeError( ValueError ):
+	pass
+
+def positive( value ):
+	# Also false for NaN and infinity.
+	return 0 < value < float( 'inf' )
+
+def parse_ingredient( ingredient ):
+	# Into ( nbd_no, sequence, grams, servings ), one of sequence and grams is None.
+	try:
+		if len( ingredient ) == 2:
+			nbd_no, quantity = ingredient
+			servings = 1.0
+		else:
+			nbd_no, quantity, servings = ingredient
+			servings = float( servings )
+	except ( TypeError, ValueError ):
+		raise RecipeError( 'Give an ingredient as ( nbd_no, sequence or grams [, servings ] ), not %r' % ( ingredient, ) )
+	nbd_no = str( nbd_no )
+	if not positive( servings ):
+		raise RecipeError( 'Give a number of servings above 0 for %s, not %r' % ( nbd_no, servings ) )
+	if isinstance( quantity, str ):
+		return nbd_no, quantity, None, servings
+	try:
+		grams = float( quantity )
+	except ( TypeError, ValueError ):
+		raise RecipeError( 'Unknown quantity %r of %s' % ( quantity, nbd_no ) )
+	if not positive( grams ):
+		raise RecipeError( 'Give a weight above 0g for %s, not %r' % ( nbd_no, quantity ) )
+	return nbd_no, None, grams, servings
+
+class Meal( object ):
+	# The totals of one meal, nutrients are ( definition, amount, daily_value )
+	# tuples in sr_order and grams is the edible weight of the meal.
+	def __init__( self, grams, nutrients ):
+		self.grams = grams
+		self.nutrients = nutrients
+
+	def as_dict( self ):
+		return { 'grams' : self.grams, 'nutrients' : [ { 'code' : d.code, 'name' : d.name, 'units' : d.units,
+				'amount' : amount, 'daily_value' : daily_value } for d, amount, daily_value in self.nutrients ] }
+
+class Ingredients( object ):
+	# Nutrients per gram and serving weights of the given foods.
+	def __init__( self, food_ids, definitions=None ):
+		if definitions is None:
+			definitions = nutrient_definitions()
+		food_ids = sorted( set( food_ids ) )
+		self.refuse = {}
+		self.weights = {}
+		amounts = {}
+		for ids in chunks( food_ids ):
+			self.refuse.update( Food.objects.filter( nbd_no__in=ids ).values_list( 'nbd_no', 'refuse_percent' ) )
+			for food_id, sequence, weight in GramWeight.objects.filter( food__in=ids ).values_list( 'food', 'sequence', 'weight' ):
+				self.weights[ ( food_id, sequence ) ] = float( weight )
+			for food_id, code, amount in Nutrient.objects.filter( food__in=ids ).values_list( 'food', 'nutrient', 'amount' ):
+				amounts.setdefault( food_id, {} )[ code ] = float( amount ) / 100
+		codes = set()
+		for values in amounts.values():
+			codes.update( values )
+		self.definitions = [ definitions[ c ] for c in sorted( codes, key=lambda c: definitions[ c ].sr_order ) ]
+		self.columns = dict( ( d.code, i ) for i, d in enumerate( self.definitions ) )
+		self.rows = dict( ( f, i ) for i, f in enumerate( food_ids ) )
+		# One row per food, one column per nutrient, per gram of food.
+		self.per_gram = [ [ ( self.columns[ c ], a ) for c, a in amounts.get( f, {} ).items() ] for f in food_ids ]
+
+	def grams( self, ingredient ):
+		nbd_no, sequence, grams, servings = parse_ingredient( ingredient )
+		if nbd_no not in self.refuse:
+			raise RecipeError( 'No food %s' % nbd_no )
+		if sequence is not None:
+			if ( nbd_no, sequence ) not in self.weights:
+				raise RecipeError( 'Food %s has no weight %s' % ( nbd_no, sequence ) )
+			return nbd_no, self.weights[ ( nbd_no, sequence ) ] * servings
+		return nbd_no, grams * servings * ( 100 - ( self.refuse[ nbd_no ] or 0 ) ) / 100.0
+
+	def totals( self, meals ):
+		# The edible grams of every meal and their nutrient totals, as a
+		# meal by nutrient list of rows with None where no ingredient of the
+		# meal has a value for the nutrient.
+		foods = [ [ self.grams( i ) for i in meal ] for meal in meals ]
+		if numpy is not None:
+			return self.totals_numpy( foods )
+		return self.totals_list( foods )
+
+	def totals_numpy( self, foods ):
+		per_gram = numpy.zeros( ( len( self.rows ), len( self.definitions ) ) )
+		present = numpy.zeros( per_gram.shape )
+		for row, values in enumerate( self.per_gram ):
+			for column, amount in values:
+				per_gram[ row, column ] = amount
+				present[ row, column ] = 1
+		grams = numpy.zeros( ( len( foods ), len( self.rows ) ) )
+		for m, ingredients in enumerate( foods ):
+			for food_id, g in ingredients:
+				grams[ m, self.rows[ food_id ] ] += g
+		totals = grams.dot( per_gram )
+		has_value = ( grams > 0 ).astype( float ).dot( present ) > 0
+		totals = numpy.where( has_value, totals, numpy.nan )
+		rows = [ [ None if v != v else v for v in row ] for row in totals.tolist() ]
+		return grams.sum( axis=1 ).tolist(), rows
+
+	def totals_list( self, foods ):
+		meal_grams = []
+		rows = []
+		for ingredients in foods:
+			row = [ None ] * len( self.definitions )
+			for food_id, g in ingredients:
+				if not g:
+					continue
+				for column, amount in self.per_gram[ self.rows[ food_id ] ]:
+					row[ column ] = ( row[ column ] or 0.0 ) + amount * g
+			meal_grams.append( sum( g for food_id, g in ingredients ) )
+			rows.append( row )
+		return meal_grams, rows
+
+	def meals( self, meals ):
+		meal_grams, rows = self.totals( meals )
+		results = []
+		for grams, row in zip( meal_grams, rows ):
+			nutrients = []
+			for d, total in zip( self.definitions, row ):
+				if total is None:
+					continue
+				daily = float( d.daily_amount ) if d.daily_amount else None
+				nutrients.append( ( d, round_half_up( total, d.num_decimal_places ), round_half_up( total / daily * 100, 1 ) if daily else None ) )
+			results.append( Meal( round( grams, 1 ), nutrients ) )
+		return results
+
+def aggregate_many( meals ):
+	# A Meal for every list of ingredients in meals, in order.
+	try:
+		meals = [ list( m ) for m in meals ]
+	except TypeError:
+		raise RecipeError( 'Give every meal as a list of ingredients' )
+	food_ids = set( parse_ingredient( i )[0] for meal in meals for i in meal )
+	return Ingredients( food_ids ).meals( meals )
+
+def aggregate( ingredients ):
+	return aggregate_many( [ ingredients ] )[0]
@@ -0,0 +1,96 @@
+from collections import namedtuple
+import threading
+from types import MappingProxyType
+
+from usda.caching import get_version
+from usda.models import FoodGroup, NutrientDefinition, DataType, DataDerivation, DailyValueProfile, DailyValue
+
+# The small reference tables, loaded once per process into read only maps
+# of namedtuples keyed by code. They are reloaded the first time they are
+# used after the dataset version changed, i.e. after an import. The daily
+# value profiles are kept with them as { code : amount } maps by name.
+
+MODELS = ( FoodGroup, NutrientDefinition, DataType, DataDerivation )
+
+class Registry( object ):
+
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.version = None
+		self.tables = {}
+		self.profiles = {}
+		self.default_profile = None
+		self.entries = dict( ( model, namedtuple( model.__name__ + 'Entry',
+				[ f.attname for f in model._meta.concrete_fields ] ) ) for model in MODELS )
+
+	def load( self, model, source=None ):
+		# source, a copy of model on other tables, is read in its place.
+		entry = self.entries[ model ]
+		rows = ( source or model ).objects.values_list( *entry._fields )
+		return MappingProxyType( dict( ( r[0], entry( *r ) ) for r in rows ) )
+
+	def load_profiles( self ):
+		profiles = {}
+		default = None
+		for name, is_default in DailyValueProfile.objects.values_list( 'name', 'is_default' ):
+			profiles[ name ] = {}
+			if is_default:
+				default = name
+		for name, code, amount in DailyValue.objects.values_list( 'profile__name', 'nutrient', 'amount' ):
+			profiles[ name ][ code ] = float( amount )
+		return dict( ( name, MappingProxyType( amounts ) ) for name, amounts in profiles.items() ), default
+
+	def reload( self ):
+		version = get_version()[0]
+		if version != self.version:
+			with self.lock:
+				if version != self.version:
+					self.tables = dict( ( m, self.load( m ) ) for m in MODELS )
+					self.profiles, self.default_profile = self.load_profiles()
+					self.version = version
+
+	def table( self, model ):
+		self.reload()
+		return self.tables[ model ]
+
+	def profile( self, name ):
+		self.reload()
+		return self.profiles[ name ]
+
+	def invalidate( self ):
+		with self.lock:
+			self.version = None
+
+registry = Registry()
+
+def food_groups():
+	return registry.table( FoodGroup )
+
+def nutrient_definitions():
+	return registry.table( NutrientDefinition )
+
+def data_types():
+	return registry.table( DataType )
+
+def data_derivations():
+	return registry.table( DataDerivation )
+
+def food_group_choices():
+	return sorted( ( ( g.food_group_code, g.name ) for g in food_groups().values() ), key=lambda c: c[1] )
+
+def nutrient_choices():
+	return [ ( d.code, d.name ) for d in sorted( nutrient_definitions().values(), key=lambda d: d.sr_order ) ]
+
+def read_table( model, apps ):
+	# The map of one of MODELS as read from the tables of apps, e.g. the
+	# shadow tables of an import, leaving what the registry holds alone.
+	return registry.load( model, apps.get_model( model._meta.app_label, model._meta.object_name ) )
+
+def daily_value_profiles():
+	# Names of the daily value profiles, the default one first.
+	registry.reload()
+	return sorted( registry.profiles, key=lambda name: ( name != registry.default_profile, name ) )
+
+def daily_value_profile( name ):
+	# { code : daily amount } of the profile, KeyError if there is none.
+	return registry.profile( name )
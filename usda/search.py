@@ -0,0 +1,247 @@
+import bisect
+import logging
+import math
+import re
+import threading
+
+from django.apps import apps as live_apps
+from django.db import connection, transaction, DatabaseError
+
+from usda.caching import get_version
+from usda.models import Food
+
+logger = logging.getLogger(__name__)
+
+# Ranked food search over long_desc, short_desc, common_name and the LanguaL
+# descriptions of each food. The index is kept in usda_foodsearch, a table
+# the backends manage themselves : a tsvector with a GIN index on
+# PostgreSQL, an FTS5 table on SQLite. Any other database, or a database
+# without FTS5, is searched through an inverted index held in memory,
+# which is rebuilt the first time it is used after the dataset version
+# changed. rebuild_index() has to be run after the foods change, load_sr27
+# does so.
+
+TABLE = 'usda_foodsearch'
+DEFAULT_LIMIT = 1000
+
+def tokenize( text ):
+	return re.findall( r'[^\W_]+', text.lower() )
+
+def documents( apps=live_apps ):
+	# ( nbd_no, food_group, names, langual ) for every food of the tables
+	# of apps, the live ones or the shadow ones of an import.
+	langual = {}
+	for food_id, description in apps.get_model( 'usda', 'LanguaLFactor' ).objects.values_list( 'food_id', 'factor__description' ).iterator():
+		langual.setdefault( food_id, [] ).append( description )
+	for nbd_no, group, long_desc, short_desc, common_name in apps.get_model( 'usda', 'Food' ).objects.values_list(
+			'nbd_no', 'food_group_id', 'long_desc', 'short_desc', 'common_name' ).iterator():
+		names = ' '.join( t for t in ( long_desc, short_desc.replace( ',', ', ' ), common_name ) if t )
+		yield nbd_no, group, names, ' '.join( langual.get( nbd_no, [] ) )
+
+class SearchBackend( object ):
+	name = None
+	# Whether the index is a table, which an import builds under another
+	# name from its shadow tables, rather than held in memory.
+	stored = True
+
+	def rebuild( self, table=TABLE, apps=live_apps ):
+		raise NotImplementedError
+
+	def search( self, text, food_groups=None, limit=DEFAULT_LIMIT ):
+		raise NotImplementedError
+
+	def group_filter( self, food_groups ):
+		if not food_groups:
+			return '', []
+		return ' AND food_group IN (%s)' % ', '.join( [ '%s' ] * len( food_groups ) ), list( food_groups )
+
+class PostgresBackend( SearchBackend ):
+	name = 'postgresql'
+
+	def rebuild( self, table=TABLE, apps=live_apps ):
+		with transaction.atomic():
+			cursor = connection.cursor()
+			cursor.execute( 'DROP TABLE IF EXISTS %s' % table )
+			cursor.execute( 'CREATE TABLE %s ( nbd_no varchar(5) PRIMARY KEY, food_group varchar(4), '
+					'document text, vector tsvector )' % table )
+			cursor.executemany( "INSERT INTO " + table + " VALUES ( %s, %s, %s || ' ' || %s, "
+					"setweight( to_tsvector( 'english', %s ), 'A' ) || setweight( to_tsvector( 'english', %s ), 'C' ) )",
+					[ ( n, g, names, langual, names, langual ) for n, g, names, langual in documents( apps ) ] )
+			cursor.execute( 'CREATE INDEX %s_vector ON %s USING gin( vector )' % ( table, table ) )
+			self.trigram = self.create_trigram_index( cursor, table )
+
+	def create_trigram_index( self, cursor, table ):
+		# The trigram fallback needs the pg_trgm extension, which may not
+		# be installed or the user not allowed to create it.
+		try:
+			with transaction.atomic():
+				cursor.execute( 'CREATE EXTENSION IF NOT EXISTS pg_trgm' )
+				cursor.execute( 'CREATE INDEX %s_trigram ON %s USING gin( document gin_trgm_ops )' % ( table, table ) )
+			return True
+		except DatabaseError:
+			logger.warning( 'pg_trgm is not available, food search has no trigram fallback' )
+			return False
+
+	def search( self, text, food_groups=None, limit=DEFAULT_LIMIT ):
+		words = tokenize( text )
+		if not words:
+			return []
+		groups, params = self.group_filter( food_groups )
+		cursor = connection.cursor()
+		cursor.execute( "SELECT nbd_no FROM " + TABLE + ", to_tsquery( 'english', %s ) query "
+				"WHERE vector @@ query" + groups + " ORDER BY ts_rank( vector, query ) DESC, nbd_no LIMIT %s",
+				[ ' & '.join( '%s:*' % w for w in words ) ] + params + [ limit ] )
+		ids = [ r[0] for r in cursor.fetchall() ]
+		if not ids and getattr( self, 'trigram', True ):
+			# Nothing matched word for word, so try for misspellings.
+			text = ' '.join( words )
+			try:
+				with transaction.atomic():
+					cursor.execute( "SELECT nbd_no FROM " + TABLE + " WHERE document %% %s" + groups +
+							" ORDER BY similarity( document, %s ) DESC, nbd_no LIMIT %s", [ text ] + params + [ text, limit ] )
+					ids = [ r[0] for r in cursor.fetchall() ]
+			except DatabaseError:
+				self.trigram = False
+		return ids
+
+class SqliteBackend( SearchBackend ):
+	name = 'sqlite fts5'
+
+	@classmethod
+	def available( cls ):
+		try:
+			with transaction.atomic():
+				cursor = connection.cursor()
+				cursor.execute( 'CREATE VIRTUAL TABLE temp.usda_fts5_probe USING fts5( x )' )
+				cursor.execute( 'DROP TABLE temp.usda_fts5_probe' )
+			return True
+		except DatabaseError:
+			return False
+
+	def rebuild( self, table=TABLE, apps=live_apps ):
+		with transaction.atomic():
+			cursor = connection.cursor()
+			cursor.execute( 'DROP TABLE IF EXISTS %s' % table )
+			cursor.execute( "CREATE VIRTUAL TABLE %s USING fts5( nbd_no UNINDEXED, food_group UNINDEXED, "
+					"names, langual, tokenize='porter unicode61' )" % table )
+			cursor.executemany( 'INSERT INTO ' + table + ' VALUES ( %s, %s, %s, %s )', list( documents( apps ) ) )
+
+	def search( self, text, food_groups=None, limit=DEFAULT_LIMIT ):
+		words = tokenize( text )
+		if not words:
+			return []
+		groups, params = self.group_filter( food_groups )
+		cursor = connection.cursor()
+		# bm25 weighs a match in the names ten times a LanguaL one.
+		cursor.execute( 'SELECT nbd_no FROM ' + TABLE + ' WHERE ' + TABLE + ' MATCH %s' + groups +
+				' ORDER BY bm25( ' + TABLE + ', 0, 0, 10.0, 1.0 ), nbd_no LIMIT %s',
+				[ ' '.join( '"%s"*' % w for w in words ) ] + params + [ limit ] )
+		return [ r[0] for r in cursor.fetchall() ]
+
+class MemoryBackend( SearchBackend ):
+	name = 'memory'
+	stored = False
+	# Matches in the names count this much more than LanguaL ones.
+	name_weight = 10
+
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.version = None
+		self.index = None
+
+	def rebuild( self ):
+		version = get_version()[0]
+		index = {}
+		groups = {}
+		for nbd_no, group, names, langual in documents():
+			groups[ nbd_no ] = group
+			for weight, text in ( ( self.name_weight, names ), ( 1, langual ) ):
+				for word in tokenize( text ):
+					postings = index.setdefault( word, {} )
+					postings[ nbd_no ] = postings.get( nbd_no, 0 ) + weight
+		count = len( groups ) or 1
+		for postings in index.values():
+			idf = math.log( 1 + count / len( postings ) )
+			for nbd_no in postings:
+				postings[ nbd_no ] *= idf
+		self.words = sorted( index )
+		self.groups = groups
+		self.index = index
+		self.version = version
+
+	def prefixed( self, word ):
+		# Every indexed word starting with word, found in the sorted list.
+		i = bisect.bisect_left( self.words, word )
+		while i < len( self.words ) and self.words[ i ].startswith( word ):
+			yield self.words[ i ]
+			i += 1
+
+	def search( self, text, food_groups=None, limit=DEFAULT_LIMIT ):
+		if self.index is None or self.version != get_version()[0]:
+			with self.lock:
+				if self.index is None or self.version != get_version()[0]:
+					self.rebuild()
+		scores = None
+		for word in tokenize( text ):
+			matches = {}
+			for w in self.prefixed( word ):
+				for nbd_no, score in self.index[ w ].items():
+					matches[ nbd_no ] = max( score, matches.get( nbd_no, 0 ) )
+			if scores is None:
+				scores = matches
+			else:
+				scores = dict( ( n, s + matches[ n ] ) for n, s in scores.items() if n in matches )
+		if not scores:
+			return []
+		if food_groups:
+			food_groups = set( food_groups )
+			scores = dict( ( n, s ) for n, s in scores.items() if self.groups[ n ] in food_groups )
+		return sorted( scores, key=lambda n: ( -scores[ n ], n ) )[ :limit ]
+
+_backend = None
+# Searches while the backend of the database fails.
+fallback = MemoryBackend()
+
+def get_backend():
+	global _backend
+	if _backend is None:
+		if connection.vendor == 'postgresql':
+			_backend = PostgresBackend()
+		elif connection.vendor == 'sqlite' and SqliteBackend.available():
+			_backend = SqliteBackend()
+		else:
+			_backend = MemoryBackend()
+	return _backend
+
+def rebuild_index():
+	backend = get_backend()
+	backend.rebuild()
+	return backend
+
+def search( text, food_groups=None, limit=DEFAULT_LIMIT ):
+	# nbd_no of the foods matching every word of text, best match first.
+	backend = get_backend()
+	try:
+		with transaction.atomic():
+			return backend.search( text, food_groups, limit )
+	except DatabaseError:
+		if isinstance( backend, MemoryBackend ):
+			raise
+		# Most likely the index was never built for this database, or is
+		# being rebuilt. The next search tries the backend again.
+		logger.warning( 'The %s food search failed, searching an in memory index instead', backend.name, exc_info=True )
+		return fallback.search( text, food_groups, limit )
+
+class RankedFoods( object ):
+	# The foods of a search in rank order, for a Paginator. Only the foods
+	# on the page that is sliced out are fetched.
+	def __init__( self, ids ):
+		self.ids = ids
+
+	def __len__( self ):
+		return len( self.ids )
+
+	def __getitem__( self, index ):
+		ids = self.ids[ index ]
+		foods = Food.objects.select_related( 'food_group' ).in_bulk( ids )
+		return [ foods[ i ] for i in ids if i in foods ]
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from django.conf import settings
+
+from usda.caching import get_version
+from usda.models import Food, Nutrient
+from usda.query import OPERATORS, QueryError
+
+# Foods with a similar nutrient profile. build_index() writes a food by
+# nutrient matrix of the per 100g amounts to INDEX_DIR, scaled so that every
+# nutrient has unit standard deviation, together with the raw amounts for
+# constraints such as "less sodium than X". load_sr27 builds it after an
+# import. The .npy files are opened memory mapped and read only, so all the
+# worker processes of a server share one copy through the page cache.
+#
+# This needs numpy.
+
+INDEX_DIR = getattr( settings, 'USDA_INDEX_DIR', os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'index' ) )
+METRICS = ( 'cosine', 'euclidean' )
+
+class SimilarityError( ValueError ):
+	pass
+
+def index_path( name, directory=None ):
+	return os.path.join( directory or INDEX_DIR, name )
+
+def save( name, array, directory ):
+	# Replace the file in one step, servers keep the old one mapped until
+	# they reload.
+	path = index_path( name, directory )
+	with open( path + '.tmp', 'wb' ) as f:
+		numpy.save( f, array )
+	os.replace( path + '.tmp', path )
+
+def build_index( directory=None ):
+	if numpy is None:
+		raise SimilarityError( 'The similarity index needs numpy' )
+	directory = directory or INDEX_DIR
+	if not os.path.isdir( directory ):
+		os.makedirs( directory )
+	foods = list( Food.objects.order_by( 'nbd_no' ).values_list( 'nbd_no', 'food_group' ) )
+	rows = dict( ( f[0], i ) for i, f in enumerate( foods ) )
+	groups = sorted( set( f[1] for f in foods ) )
+	group_index = dict( ( g, i ) for i, g in enumerate( groups ) )
+	codes = sorted( set( Nutrient.objects.values_list( 'nutrient', flat=True ).distinct() ) )
+	columns = dict( ( c, i ) for i, c in enumerate( codes ) )
+
+	amounts = numpy.full( ( len( foods ), len( codes ) ), numpy.nan, dtype=numpy.float32 )
+	for food_id, code, amount in Nutrient.objects.values_list( 'food', 'nutrient', 'amount' ).iterator():
+		amounts[ rows[ food_id ], columns[ code ] ] = amount
+	values = numpy.nan_to_num( amounts )
+	scale = values.std( axis=0 )
+	scale[ scale == 0 ] = 1
+	matrix = ( values / scale ).astype( numpy.float32 )
+
+	save( 'amounts.npy', amounts, directory )
+	save( 'matrix.npy', matrix, directory )
+	save( 'norms.npy', numpy.sqrt( ( matrix * matrix ).sum( axis=1 ) ), directory )
+	save( 'groups.npy', numpy.array( [ group_index[ f[1] ] for f in foods ], dtype=numpy.int16 ), directory )
+	meta = { 'foods' : [ f[0] for f in foods ], 'groups' : groups, 'nutrients' : codes }
+	with open( index_path( 'index.json.tmp', directory ), 'w' ) as f:
+		json.dump( meta, f )
+	os.replace( index_path( 'index.json.tmp', directory ), index_path( 'index.json', directory ) )
+	return matrix.shape
+
+class SimilarityIndex( object ):
+
+	def __init__( self, directory=None ):
+		directory = directory or INDEX_DIR
+		try:
+			with open( index_path( 'index.json', directory ) ) as f:
+				meta = json.load( f )
+		except IOError:
+			raise SimilarityError( 'There is no similarity index in %s, run load_sr27 to build it' % directory )
+		self.foods = meta[ 'foods' ]
+		self.rows = dict( ( f, i ) for i, f in enumerate( self.foods ) )
+		self.groups = dict( ( g, i ) for i, g in enumerate( meta[ 'groups' ] ) )
+		self.columns = dict( ( c, i ) for i, c in enumerate( meta[ 'nutrients' ] ) )
+		load = lambda name: numpy.load( index_path( name, directory ), mmap_mode='r' )
+		self.amounts = load( 'amounts.npy' )
+		self.matrix = load( 'matrix.npy' )
+		self.norms = load( 'norms.npy' )
+		self.food_groups = load( 'groups.npy' )
+
+	def row( self, nbd_no ):
+		if nbd_no not in self.rows:
+			raise SimilarityError( 'No food %s' % nbd_no )
+		return self.rows[ nbd_no ]
+
+	def mask( self, row, food_groups=None, constraints=None, less=None, more=None ):
+		# The foods that may be returned. constraints are ( code, operator,
+		# value ) as parsed by usda.query, less and more are nutrient codes
+		# the food must have less or more of than the one at row.
+		keep = numpy.ones( len( self.foods ), dtype=bool )
+		keep[ row ] = False
+		if food_groups:
+			codes = [ self.groups[ g ] for g in food_groups if g in self.groups ]
+			keep &= numpy.isin( self.food_groups, codes )
+		comparisons = list( constraints or [] )
+		comparisons.extend( ( code, '<', None ) for code in less or () )
+		comparisons.extend( ( code, '>', None ) for code in more or () )
+		for code, op, value in comparisons:
+			if code not in self.columns:
+				raise SimilarityError( 'Unknown nutrient %s' % code )
+			if op not in OPERATORS:
+				raise QueryError( 'Unknown operator %s' % op )
+			column = self.amounts[ :, self.columns[ code ] ]
+			if value is None:
+				value = column[ row ]
+			# Comparisons with a missing amount are False, which drops foods
+			# without a value for the nutrient.
+			with numpy.errstate( invalid='ignore' ):
+				if op == '>=':
+					keep &= column >= value
+				elif op == '<=':
+					keep &= column <= value
+				elif op == '>':
+					keep &= column > value
+				elif op == '<':
+					keep &= column < value
+				else:
+					keep &= column == value
+		return keep
+
+	def similar( self, nbd_no, k=10, metric='cosine', **filters ):
+		# The k foods nearest to nbd_no as ( nbd_no, score ) tuples, nearest
+		# first. The score is the cosine similarity or the distance.
+		if metric not in METRICS:
+			raise SimilarityError( 'Unknown metric %s, use one of %s' % ( metric, ', '.join( METRICS ) ) )
+		row = self.row( nbd_no )
+		keep = self.mask( row, **filters )
+		target = numpy.asarray( self.matrix[ row ] )
+		dots = self.matrix.dot( target )
+		norm = float( self.norms[ row ] )
+		if metric == 'cosine':
+			with numpy.errstate( divide='ignore', invalid='ignore' ):
+				scores = dots / ( self.norms * norm )
+			scores = numpy.where( keep, numpy.nan_to_num( scores ), -numpy.inf )
+			order = -scores
+		else:
+			scores = numpy.sqrt( numpy.maximum( self.norms * self.norms - 2 * dots + norm * norm, 0 ) )
+			scores = numpy.where( keep, scores, numpy.inf )
+			order = scores
+		k = min( k, int( keep.sum() ) )
+		if k <= 0:
+			return []
+		nearest = numpy.argpartition( order, k - 1 )[ :k ]
+		nearest = nearest[ numpy.argsort( order[ nearest ], kind='mergesort' ) ]
+		return [ ( self.foods[ i ], float( scores[ i ] ) ) for i in nearest ]
+
+class Indexes( object ):
+	# The index of this process, reopened after an import like the registry.
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.version = None
+		self.index = None
+
+	def get( self ):
+		if numpy is None:
+			raise SimilarityError( 'The similarity index needs numpy' )
+		version = get_version()[0]
+		if version != self.version:
+			with self.lock:
+				if version != self.version:
+					self.index = SimilarityIndex()
+					self.version = version
+		return self.index
+
+	def invalidate( self ):
+		with self.lock:
+			self.version = None
+
+indexes = Indexes()
+
+def similar( nbd_no, k=10, metric='cosine', **filters ):
+	return indexes.get().similar( nbd_no, k, metric, **filters )
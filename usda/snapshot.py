@@ -0,0 +1,246 @@
+from array import array
+import decimal
+import datetime
+import json
+import mmap
+import struct
+import zlib
+
+from django.apps import apps
+
+# A columnar binary snapshot of the SR27 tables, written by
+# load_sr27 --snapshot and read back by load_snapshot or served straight
+# from the file by Snapshot.
+#
+# Every column is one fixed width array of the values of all rows: doubles
+# for decimals, 64 bit integers, one byte booleans and dates as ordinals.
+# Text, including the codes foreign keys hold, is interned into one string
+# table shared by all columns, which is stored deflated, and the columns
+# hold 32 bit indexes into it. The numeric columns stay uncompressed and 8
+# byte aligned so they can be used in place from a memory map.
+#
+# The file is the column blocks, the string table and then a JSON header
+# describing them, followed by a trailer with the offset and length of the
+# header, so it can be written one table at a time.
+
+MAGIC = b'USDASNAP'
+FORMAT = 1
+TRAILER = struct.Struct( '<QQ8s' )
+
+STRING = 'I'
+NUMBER = 'd'
+INTEGER = 'q'
+BOOLEAN = 'b'
+DATE = 'i'
+NULLS = { STRING : 0xFFFFFFFF, NUMBER : float( 'nan' ), INTEGER : -2 ** 63, BOOLEAN : -1, DATE : 0 }
+
+class SnapshotError( ValueError ):
+	pass
+
+def column_type( field ):
+	if field.rel:
+		field = field.rel.get_related_field()
+	kind = field.get_internal_type()
+	if kind in ( 'CharField', 'TextField' ):
+		return STRING
+	if kind in ( 'DecimalField', 'FloatField' ):
+		return NUMBER
+	if kind in ( 'BooleanField', 'NullBooleanField' ):
+		return BOOLEAN
+	if kind == 'DateField':
+		return DATE
+	if kind in ( 'AutoField', 'IntegerField', 'PositiveIntegerField', 'SmallIntegerField', 'PositiveSmallIntegerField', 'BigIntegerField' ):
+		return INTEGER
+	raise SnapshotError( 'Can not store %s.%s, a %s' % ( field.model.__name__, field.name, kind ) )
+
+def pad( f ):
+	f.write( b'\0' * ( -f.tell() % 8 ) )
+
+class SnapshotWriter( object ):
+
+	def __init__( self, path ):
+		self.path = path
+		self.file = open( path, 'wb' )
+		self.strings = {}
+		self.tables = []
+
+	def intern( self, value ):
+		index = self.strings.get( value )
+		if index is None:
+			index = self.strings[ value ] = len( self.strings )
+		return index
+
+	def encode( self, kind, value ):
+		if value is None:
+			return NULLS[ kind ]
+		if kind == STRING:
+			return self.intern( value )
+		if kind == NUMBER:
+			return float( value )
+		if kind == BOOLEAN:
+			return 1 if value else 0
+		if kind == DATE:
+			return value.toordinal()
+		return int( value )
+
+	def write_table( self, model, rows ):
+		# rows are dicts keyed by attname as USDAFile.process_row makes them.
+		# The columns are taken from the first row.
+		fields = dict( ( f.attname, f ) for f in model._meta.concrete_fields )
+		attnames = None
+		columns = None
+		count = 0
+		for row in rows:
+			if attnames is None:
+				attnames = [ f.attname for f in model._meta.concrete_fields if f.attname in row ]
+				columns = [ ( a, column_type( fields[ a ] ), array( column_type( fields[ a ] ) ) ) for a in attnames ]
+			for attname, kind, values in columns:
+				values.append( self.encode( kind, row[ attname ] ) )
+			count += 1
+		table = { 'model' : '%s.%s' % ( model._meta.app_label, model._meta.object_name ), 'rows' : count, 'columns' : [] }
+		for attname, kind, values in columns or ():
+			pad( self.file )
+			table[ 'columns' ].append( { 'name' : attname, 'type' : kind, 'offset' : self.file.tell() } )
+			values.tofile( self.file )
+		self.tables.append( table )
+		return count
+
+	def close( self ):
+		strings = sorted( self.strings, key=self.strings.get )
+		data = [ s.encode( 'utf-8' ) for s in strings ]
+		offsets = array( 'Q', [ 0 ] )
+		for d in data:
+			offsets.append( offsets[ -1 ] + len( d ) )
+		pad( self.file )
+		header = { 'format' : FORMAT, 'tables' : self.tables,
+				'strings' : { 'count' : len( strings ), 'offsets' : self.file.tell() } }
+		offsets.tofile( self.file )
+		blob = zlib.compress( b''.join( data ), 6 )
+		header[ 'strings' ][ 'data' ] = self.file.tell()
+		header[ 'strings' ][ 'size' ] = len( blob )
+		self.file.write( blob )
+		header_data = json.dumps( header ).encode( 'utf-8' )
+		offset = self.file.tell()
+		self.file.write( header_data )
+		self.file.write( TRAILER.pack( offset, len( header_data ), MAGIC ) )
+		self.file.close()
+		return len( strings )
+
+class Table( object ):
+	# One table of a snapshot. Columns are read straight from the map, rows
+	# and lookups decode values to what the model fields hold.
+	def __init__( self, snapshot, header ):
+		self.snapshot = snapshot
+		self.model = apps.get_model( header[ 'model' ] )
+		self.rows = header[ 'rows' ]
+		self.types = dict( ( c[ 'name' ], c[ 'type' ] ) for c in header[ 'columns' ] )
+		self.offsets = dict( ( c[ 'name' ], c[ 'offset' ] ) for c in header[ 'columns' ] )
+		self.attnames = [ c[ 'name' ] for c in header[ 'columns' ] ]
+		self.fields = dict( ( f.attname, f ) for f in self.model._meta.concrete_fields )
+		self.indexes = {}
+
+	def __len__( self ):
+		return self.rows
+
+	def column( self, attname ):
+		# The raw values, a memoryview of the map.
+		kind = self.types[ attname ]
+		size = struct.calcsize( kind )
+		offset = self.offsets[ attname ]
+		return self.snapshot.view[ offset:offset + size * self.rows ].cast( kind )
+
+	def decoder( self, attname ):
+		kind = self.types[ attname ]
+		field = self.fields[ attname ]
+		null = NULLS[ kind ]
+		if kind == STRING:
+			strings = self.snapshot.strings
+			return lambda v: None if v == null else strings[ v ]
+		if kind == NUMBER:
+			if field.get_internal_type() == 'DecimalField':
+				exponent = decimal.Decimal( 1 ).scaleb( -field.decimal_places )
+				return lambda v: None if v != v else decimal.Decimal( v ).quantize( exponent )
+			return lambda v: None if v != v else v
+		if kind == BOOLEAN:
+			return lambda v: None if v == null else bool( v )
+		if kind == DATE:
+			return lambda v: None if v == null else datetime.date.fromordinal( v )
+		return lambda v: None if v == null else v
+
+	def values( self, attname ):
+		decode = self.decoder( attname )
+		return [ decode( v ) for v in self.column( attname ) ]
+
+	def iter_rows( self ):
+		columns = [ ( a, self.decoder( a ), self.column( a ) ) for a in self.attnames ]
+		for i in range( self.rows ):
+			yield dict( ( a, decode( values[ i ] ) ) for a, decode, values in columns )
+
+	def row( self, i ):
+		return dict( ( a, self.decoder( a )( self.column( a )[ i ] ) ) for a in self.attnames )
+
+	def index( self, attname ):
+		# Row numbers by value of a column, built the first time it is used.
+		if attname not in self.indexes:
+			index = {}
+			for i, v in enumerate( self.values( attname ) ):
+				index.setdefault( v, [] ).append( i )
+			self.indexes[ attname ] = index
+		return self.indexes[ attname ]
+
+	def filter( self, **kwargs ):
+		# Rows whose columns equal the given values, e.g. food_id='01001'.
+		found = None
+		for attname, value in kwargs.items():
+			rows = set( self.index( attname ).get( value, () ) )
+			found = rows if found is None else found & rows
+		return [ self.row( i ) for i in sorted( found or () ) ]
+
+	def get( self, pk ):
+		rows = self.index( self.model._meta.pk.attname ).get( pk )
+		if not rows:
+			raise self.model.DoesNotExist( '%s %s is not in the snapshot' % ( self.model.__name__, pk ) )
+		return self.row( rows[ 0 ] )
+
+class Snapshot( object ):
+	# A snapshot file opened read only, shared between processes through
+	# the page cache like any other map.
+	def __init__( self, path ):
+		self.path = path
+		with open( path, 'rb' ) as f:
+			self.map = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+		self.view = memoryview( self.map )
+		if len( self.map ) < TRAILER.size:
+			raise SnapshotError( '%s is not a snapshot' % path )
+		offset, length, magic = TRAILER.unpack_from( self.map, len( self.map ) - TRAILER.size )
+		if magic != MAGIC:
+			raise SnapshotError( '%s is not a snapshot' % path )
+		header = json.loads( self.map[ offset:offset + length ].decode( 'utf-8' ) )
+		if header[ 'format' ] != FORMAT:
+			raise SnapshotError( '%s has format %s, this version reads %s' % ( path, header[ 'format' ], FORMAT ) )
+		self.header = header
+		self._strings = None
+		self.tables = dict( ( t[ 'model' ].split( '.' )[ -1 ].lower(), Table( self, t ) ) for t in header[ 'tables' ] )
+
+	@property
+	def strings( self ):
+		if self._strings is None:
+			header = self.header[ 'strings' ]
+			start = header[ 'offsets' ]
+			offsets = self.view[ start:start + 8 * ( header[ 'count' ] + 1 ) ].cast( 'Q' )
+			data = zlib.decompress( self.map[ header[ 'data' ]:header[ 'data' ] + header[ 'size' ] ] )
+			self._strings = [ data[ offsets[ i ]:offsets[ i + 1 ] ].decode( 'utf-8' ) for i in range( header[ 'count' ] ) ]
+		return self._strings
+
+	def table( self, model ):
+		name = model if isinstance( model, str ) else model.__name__
+		try:
+			return self.tables[ name.lower() ]
+		except KeyError:
+			raise SnapshotError( '%s has no table %s' % ( self.path, name ) )
+
+	def close( self ):
+		for table in self.tables.values():
+			table.indexes = {}
+		self.view.release()
+		self.map.close()
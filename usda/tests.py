@@ -1,3 +1,586 @@
-from django.test import TestCase
+import datetime
+import gzip
+import json
+import os
+import zipfile
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from decimal import Decimal
 
-# Create your tests here.
+from django.conf.urls import patterns, url, include
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections, DatabaseError
+from django.db.transaction import TransactionManagementError
+from django.test import SimpleTestCase, TestCase, RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from usda.models import Food, FoodGroup, GramWeight, NutrientDefinition, Nutrient, LanguaLFactor, FoodDocument, \
+						DataType, DataSource, DataSourceLink, Footnote, ImportJob, DailyValueProfile, DailyValue
+from usda import query
+from usda.caching import bump_version, get_version
+from usda.registry import registry, nutrient_definitions, food_groups
+from usda import nutrition
+from usda.nutrition import NutritionMatrix
+from usda import search as search_index
+from usda.search import MemoryBackend
+from usda import similarity
+from usda.snapshot import Snapshot, SnapshotWriter
+from usda.management.commands.load_sr27 import Command as LoadCommand, FoodGroupFile, NutrientDefFile, FoodFile, WeightFile, \
+						NutrientFile, clear_tables, rebuild_tables, dependency_order, with_dependents
+from usda.benchmark import line, write_zip
+from usda.loaders import LOADERS, get_loader
+from usda.views import FoodDetail, get_keyset_page
+from usda import api, documents, fanout, jobs
+from usda.instrumentation import metrics, count_queries
+from usda.recipes import RecipeError, aggregate_many
+
+urlpatterns = patterns('',
+	url( r'^usda/', include( 'usda.urls', namespace='usda' ) ),
+)
+
+@override_settings( ROOT_URLCONF='usda.tests' )
+class FoodDetailTest( TestCase ):
+
+	def setUp( self ):
+		cache.clear()
+		registry.invalidate()
+		get_version()
+		group = FoodGroup.objects.create( food_group_code='0100', name='Dairy and Egg Products' )
+		self.food = Food.objects.create( nbd_no='01001', food_group=group,
+				long_desc='Butter, salted', short_desc='BUTTER,WITH SALT' )
+		self.datatype = DataType.objects.create( code='1', description='Analytical or derived from analytical' )
+		self.source = DataSource.objects.create( code='S1', title='Composition of Foods' )
+		GramWeight.objects.create( food=self.food, sequence='1', amount=Decimal( 1 ), description='pat', weight=Decimal( 5 ) )
+		GramWeight.objects.create( food=self.food, sequence='2', amount=Decimal( 1 ), description='cup', weight=Decimal( 227 ) )
+
+	def add_nutrients( self, start, stop ):
+		for i in range( start, stop ):
+			definition = NutrientDefinition.objects.create( code='%03d' % i, units='g', name='Nutrient %d' % i,
+					num_decimal_places=2, sr_order=i, daily_amount=Decimal( 50 ) )
+			Nutrient.objects.create( food=self.food, nutrient=definition, amount=Decimal( '1.5' ),
+					num_data_points=1, data_type=self.datatype )
+			Footnote.objects.create( food=self.food, sequence='01', type_code='N', nutrient_definition=definition, text='Footnote %d' % i )
+			DataSourceLink.objects.create( food=self.food, nutrient_definition=definition, data_source=self.source )
+
+	def changed( self ):
+		# What an import does at the end, plus warming up the registry so
+		# only the queries of the page itself are counted.
+		registry.invalidate()
+		documents.rebuild_documents()
+		bump_version()
+		nutrient_definitions()
+
+	def render( self ):
+		request = RequestFactory().get( '/usda/food/%s/' % self.food.nbd_no )
+		return FoodDetail.as_view()( request, pk=self.food.nbd_no )
+
+	def test_page_is_one_document_lookup( self ):
+		self.add_nutrients( 0, 3 )
+		self.changed()
+		with self.assertNumQueries( 1 ):
+			self.render()
+
+		self.add_nutrients( 3, 60 )
+		self.changed()
+		with self.assertNumQueries( 1 ):
+			response = self.render()
+		self.assertContains( response, 'Footnote 59' )
+		self.assertContains( response, 'Composition of Foods' )
+
+	def test_lean_nutrients( self ):
+		self.add_nutrients( 0, 2 )
+		with self.assertNumQueries( 1 ):
+			values = Nutrient.objects.filter( food=self.food ).order_by( 'nutrient' ).lean()
+		self.assertEqual( [ ( v.food_id, v.nutrient_id, float( v.amount ), v.added_nutrition ) for v in values ],
+				[ ( '01001', '000', 1.5, None ), ( '01001', '001', 1.5, None ) ] )
+
+	def test_requests_are_measured( self ):
+		self.add_nutrients( 0, 3 )
+		self.changed()
+		metrics.reset()
+		with self.assertLogs( 'usda.requests', 'INFO' ) as logs:
+			self.render()
+			self.render()
+		fields = [ r.usda for r in logs.records ]
+		self.assertEqual( [ ( f[ 'view' ], f[ 'cache' ], f[ 'queries' ] ) for f in fields ], [ ( 'food', 'miss', 1 ), ( 'food', 'hit', 0 ) ] )
+		self.assertGreater( fields[0][ 'render_ms' ], 0 )
+		food = metrics.as_dict()[ 'food' ]
+		self.assertEqual( food[ 'latency_ms' ][ 'count' ], 2 )
+		self.assertEqual( food[ 'cache' ], { 'hit' : 1, 'miss' : 1 } )
+		self.assertEqual( food[ 'queries' ][ 'buckets' ][ 0 ], [ 0, 1 ] )
+
+	def test_queries_are_counted( self ):
+		with count_queries() as outer:
+			with count_queries() as inner:
+				list( Food.objects.all() )
+			Food.objects.count()
+		self.assertEqual( ( outer.count, inner.count ), ( 2, 1 ) )
+		self.assertNotIn( 'cursor', connections[ 'default' ].__dict__ )
+
+	def test_api_batch_uses_fixed_queries( self ):
+		self.add_nutrients( 0, 10 )
+		self.changed()
+		food_groups()
+		request = RequestFactory().get( '/usda/api/foods/', { 'nbd_no' : '01001,99999', 'nutrients' : '001,002',
+				'fields' : 'short_desc,nutrients' } )
+		with self.assertNumQueries( 3 ):
+			response = api.batch( request )
+			data = json.loads( b''.join( response.streaming_content ).decode( 'utf-8' ) )
+		self.assertEqual( data[ 'missing' ], [ '99999' ] )
+		food = data[ 'foods' ][ 0 ]
+		self.assertEqual( sorted( food ), [ 'nbd_no', 'nutrients', 'short_desc' ] )
+		self.assertEqual( [ n[ 'code' ] for n in food[ 'nutrients' ] ], [ '001', '002' ] )
+		self.assertEqual( food[ 'nutrients' ][ 0 ][ 'daily_value' ], 3.0 )
+
+		request = RequestFactory().post( '/usda/api/foods/', { 'nbd_no' : '01001', 'fields' : 'short_desc' } )
+		data = json.loads( b''.join( api.batch( request ).streaming_content ).decode( 'utf-8' ) )
+		self.assertEqual( data[ 'foods' ], [ { 'nbd_no' : '01001', 'short_desc' : 'BUTTER,WITH SALT' } ] )
+
+	def test_documents( self ):
+		self.add_nutrients( 0, 2 )
+		# Built from the tables until an import stores it.
+		document = documents.get_document( '01001' )
+		self.assertEqual( document[ 'weights' ], [ [ '1', 1.0, 'pat', 5.0 ], [ '2', 1.0, 'cup', 227.0 ] ] )
+		self.assertEqual( document[ 'nutrients' ][0], [ '000', 1.5, None, [ [ 1.5, 3.0 ], [ 0.08, 0.2 ], [ 3.41, 6.8 ] ],
+				[ 'Footnote 0' ], [ 'Composition of Foods' ] ] )
+		self.changed()
+		self.assertEqual( documents.update_daily_values( { '001' : Decimal( 25 ) } ), 1 )
+		document = documents.get_document( '01001' )
+		self.assertEqual( [ n[3][0][1] for n in document[ 'nutrients' ] ], [ 3.0, 6.0 ] )
+		request = RequestFactory().get( '/usda/api/food/01001/', { 'fields' : 'food_group,nutrients' } )
+		data = json.loads( api.food( request, pk='01001' ).content.decode( 'utf-8' ) )
+		self.assertEqual( data[ 'food_group' ], { 'code' : '0100', 'name' : 'Dairy and Egg Products' } )
+		self.assertEqual( data[ 'nutrients' ][1][ 'daily_value' ], 6.0 )
+
+	def test_daily_value_profiles( self ):
+		self.add_nutrients( 0, 2 )
+		self.changed()
+		path = os.path.join( tempfile.mkdtemp(), 'daily_values.json' )
+		self.addCleanup( shutil.rmtree, os.path.dirname( path ) )
+		with open( path, 'w' ) as f:
+			json.dump( { 'default' : 'adult', 'profiles' : [ { 'name' : 'adult', 'values' : { '000' : 25 } },
+					{ 'name' : 'child', 'values' : { '000' : 100, '001' : 10, '999' : 1 } } ] }, f )
+		call_command( 'load_daily', path )
+		call_command( 'load_daily', path )
+		self.assertEqual( dict( DailyValueProfile.objects.values_list( 'name', 'version' ) ), { 'adult' : 1, 'child' : 1 } )
+		self.assertEqual( dict( NutrientDefinition.objects.values_list( 'code', 'daily_amount' ) ), { '000' : 25, '001' : None } )
+		self.assertEqual( [ n[3][0][1] for n in documents.get_document( '01001' )[ 'nutrients' ] ], [ 6.0, None ] )
+
+		nutrient_definitions()
+		request = RequestFactory().get( '/usda/food/01001/', { 'dv' : 'child' } )
+		with self.assertNumQueries( 1 ):
+			response = FoodDetail.as_view()( request, pk='01001' )
+		self.assertContains( response, '<b>child</b>' )
+		request = RequestFactory().get( '/usda/api/food/01001/', { 'fields' : 'nutrients', 'dv' : 'child' } )
+		data = json.loads( api.food( request, pk='01001' ).content.decode( 'utf-8' ) )
+		self.assertEqual( [ n[ 'daily_value' ] for n in data[ 'nutrients' ] ], [ 1.5, 15.0 ] )
+		request = RequestFactory().get( '/usda/api/food/01001/', { 'dv' : 'teen' } )
+		self.assertEqual( api.food( request, pk='01001' ).status_code, 400 )
+
+	def test_daily_values_survive_a_reimport( self ):
+		self.add_nutrients( 0, 2 )
+		profile = DailyValueProfile.objects.create( name='adult', is_default=True )
+		DailyValue.objects.create( profile=profile, nutrient_id='000', amount=Decimal( 25 ) )
+		directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, directory )
+		self.addCleanup( registry.invalidate )
+		path = os.path.join( directory, 'sr27.zip' )
+		with zipfile.ZipFile( path, 'w' ) as z:
+			z.writestr( 'NUTR_DEF.txt', '~000~^~g~^~~^~Nutrient 0~^~2~^0\r\n~001~^~g~^~~^~Nutrient 1~^~2~^1\r\n' )
+		clear_tables( [ NutrientDefinition ] )
+		self.assertEqual( NutrientDefinition.objects.count(), 0 )
+		with zipfile.ZipFile( path ) as z:
+			NutrientDefFile().to_db_bulk( z, clear=False, loader='executemany' )
+		rebuild_tables( set( [ NutrientDefinition ] ) )
+		self.assertEqual( list( DailyValue.objects.values_list( 'profile__name', 'nutrient', 'amount' ) ), [ ( 'adult', '000', 25 ) ] )
+		self.assertEqual( dict( NutrientDefinition.objects.values_list( 'code', 'daily_amount' ) ), { '000' : 25, '001' : None } )
+
+	def test_fanout_runs_in_turn_inside_transactions( self ):
+		self.assertFalse( fanout.enabled() )
+		self.assertEqual( fanout.fetch( foods=lambda: Food.objects.count(), one=lambda: 1 ), { 'foods' : Food.objects.count(), 'one' : 1 } )
+
+	def test_meals_are_totalled_together( self ):
+		self.add_nutrients( 0, 2 )
+		self.changed()
+		Food.objects.filter( pk=self.food.pk ).update( refuse_percent=20 )
+		with self.assertNumQueries( 3 ):
+			meals = aggregate_many( [ [ ( '01001', '1', 2 ) ], [ ( '01001', 100 ), ( '01001', 100 ) ] ] )
+		self.assertEqual( [ m.grams for m in meals ], [ 10.0, 160.0 ] )
+		self.assertEqual( [ ( d.code, amount, dv ) for d, amount, dv in meals[1].nutrients ], [ ( '000', 2.4, 4.8 ), ( '001', 2.4, 4.8 ) ] )
+		self.assertEqual( meals[0].nutrients[0][1], 0.15 )
+		self.assertRaises( RecipeError, aggregate_many, [ [ ( '01001', '9' ) ] ] )
+		for ingredient in ( ( '01001', -100 ), ( '01001', 0 ), ( '01001', '1', 0 ), ( '01001', 100, -2 ), ( '01001', float( 'nan' ) ), ( '01001', 100, 'inf' ) ):
+			self.assertRaises( RecipeError, aggregate_many, [ [ ingredient ] ] )
+
+	def test_pages_are_cached_per_dataset_version( self ):
+		self.add_nutrients( 0, 3 )
+		self.changed()
+		first = self.render()
+		with self.assertNumQueries( 0 ):
+			cached = self.render()
+		self.assertEqual( cached.content, first.content )
+		self.assertTrue( first.has_header( 'ETag' ) )
+		self.assertEqual( first[ 'Vary' ], 'Cookie' )
+
+		request = RequestFactory().get( '/usda/food/%s/' % self.food.nbd_no, HTTP_IF_NONE_MATCH=first[ 'ETag' ] )
+		with self.assertNumQueries( 0 ):
+			response = FoodDetail.as_view()( request, pk=self.food.nbd_no )
+		self.assertEqual( response.status_code, 304 )
+
+		self.add_nutrients( 3, 4 )
+		self.changed()
+		self.assertContains( self.render(), 'Footnote 3' )
+
+	def test_pages_with_messages_are_not_cached( self ):
+		self.add_nutrients( 0, 1 )
+		self.changed()
+		request = RequestFactory().get( '/usda/food/%s/' % self.food.nbd_no )
+		request._messages = [ 'Saved' ]
+		FoodDetail.as_view()( request, pk=self.food.nbd_no )
+		self.assertEqual( request.usda_cache, 'bypass' )
+		with self.assertNumQueries( 1 ):
+			first = self.render()
+
+		# The ETag of the anonymous page does not answer for pages that
+		# are not the same for everyone.
+		request = RequestFactory().get( '/usda/food/%s/' % self.food.nbd_no, HTTP_IF_NONE_MATCH=first[ 'ETag' ] )
+		request._messages = [ 'Saved' ]
+		response = FoodDetail.as_view()( request, pk=self.food.nbd_no )
+		self.assertEqual( response.status_code, 200 )
+		self.assertFalse( response.has_header( 'ETag' ) )
+
+class NutritionMatrixTest( SimpleTestCase ):
+
+	def test_amounts_and_daily_values( self ):
+		matrix = NutritionMatrix( [ Decimal( '81.11' ), Decimal( '0.86' ) ], [ Decimal( 65 ), None ], [ 2, 1 ], [ 100, 5, 227 ] )
+		self.assertEqual( matrix.amounts, [ [ 81.11, 4.06, 184.12 ], [ 0.9, 0.0, 2.0 ] ] )
+		self.assertEqual( matrix.daily_values, [ [ 124.8, 6.2, 283.3 ], [ None, None, None ] ] )
+
+	def test_numpy_and_arrays_agree( self ):
+		# Halves such as 1.5g in a 227g cup, 3.405g, and 0.5% of a daily
+		# value must round the same way on both paths.
+		args = ( [ Decimal( '1.5' ), Decimal( '0.086' ), Decimal( '0.25' ), Decimal( '81.11' ) ],
+				[ Decimal( 50 ), Decimal( '2.4' ), Decimal( 50 ), None ], [ 2, 1, 3, 2 ], [ 100, 5, 227, 0.5, 2.5 ] )
+		with mock.patch.object( nutrition, 'numpy', None ):
+			expected = NutritionMatrix( *args )
+		self.assertEqual( expected.amounts[0], [ 1.5, 0.08, 3.41, 0.01, 0.04 ] )
+		self.assertEqual( expected.daily_values[0], [ 3.0, 0.2, 6.8, 0.0, 0.1 ] )
+		if nutrition.numpy is None:
+			self.skipTest( 'numpy is not installed' )
+		matrix = NutritionMatrix( *args )
+		self.assertEqual( matrix.amounts, expected.amounts )
+		self.assertEqual( matrix.daily_values, expected.daily_values )
+
+class MemorySearchTest( TestCase ):
+
+	def setUp( self ):
+		group = FoodGroup.objects.create( food_group_code='0100', name='Dairy and Egg Products' )
+		Food.objects.create( nbd_no='01001', food_group=group, long_desc='Butter, salted', short_desc='BUTTER,WITH SALT' )
+		Food.objects.create( nbd_no='01002', food_group=group, long_desc='Butter, whipped, with salt', short_desc='BUTTER,WHIPPED,W/ SALT' )
+		Food.objects.create( nbd_no='01009', food_group=group, long_desc='Cheese, cheddar', short_desc='CHEESE,CHEDDAR' )
+
+	def test_every_word_must_match( self ):
+		backend = MemoryBackend()
+		self.assertEqual( backend.search( 'butter whip' ), [ '01002' ] )
+		self.assertEqual( backend.search( 'ched' ), [ '01009' ] )
+		self.assertEqual( sorted( backend.search( 'butter' ) ), [ '01001', '01002' ] )
+		self.assertEqual( backend.search( 'butter', [ '0200' ] ), [] )
+
+	def test_index_follows_the_dataset_version( self ):
+		cache.clear()
+		backend = MemoryBackend()
+		self.assertEqual( backend.search( 'gouda' ), [] )
+		Food.objects.create( nbd_no='01022', food_group_id='0100', long_desc='Cheese, gouda', short_desc='CHEESE,GOUDA' )
+		self.assertEqual( backend.search( 'gouda' ), [] )
+		bump_version()
+		self.assertEqual( backend.search( 'gouda' ), [ '01022' ] )
+
+	def test_failing_backend_falls_back_per_search( self ):
+		broken = mock.Mock( search=mock.Mock( side_effect=DatabaseError( 'no such table: usda_foodsearch' ) ) )
+		broken.name = 'broken'
+		with mock.patch.object( search_index, '_backend', broken ):
+			with self.assertLogs( 'usda.search', 'WARNING' ):
+				self.assertEqual( search_index.search( 'ched' ), [ '01009' ] )
+			self.assertIs( search_index.get_backend(), broken )
+
+class NutrientQueryTest( TestCase ):
+
+	def setUp( self ):
+		group = FoodGroup.objects.create( food_group_code='0100', name='Dairy and Egg Products' )
+		datatype = DataType.objects.create( code='1', description='Analytical or derived from analytical' )
+		protein = NutrientDefinition.objects.create( code='203', units='g', tagname='PROCNT', name='Protein', num_decimal_places=2, sr_order=600 )
+		sodium = NutrientDefinition.objects.create( code='307', units='mg', tagname='NA', name='Sodium, Na', num_decimal_places=0, sr_order=5800 )
+		for nbd_no, amounts in ( ( '01001', ( '0.85', '643' ) ), ( '01009', ( '22.87', '653' ) ), ( '01012', ( '24.60', '82' ) ) ):
+			food = Food.objects.create( nbd_no=nbd_no, food_group=group, long_desc=nbd_no, short_desc=nbd_no )
+			for definition, amount in zip( ( protein, sodium ), amounts ):
+				Nutrient.objects.create( food=food, nutrient=definition, amount=Decimal( amount ), num_data_points=1, data_type=datatype )
+		query.rebuild_table()
+		registry.invalidate()
+
+	def test_parse_predicates( self ):
+		self.assertEqual( query.parse_predicates( '203 > 20, na<=140' ), [ ( '203', '>', 20.0 ), ( '307', '<=', 140.0 ) ] )
+		self.assertRaises( query.QueryError, query.parse_predicates, '999 > 1' )
+		self.assertRaises( query.QueryError, query.parse_predicates, 'protein' )
+
+	def test_find_foods( self ):
+		foods = query.find_foods( [ ( '203', '>', 20 ) ], order_by='307', descending=False )
+		self.assertEqual( [ f[0] for f in foods ], [ '01012', '01009' ] )
+		foods = query.find_foods( [ ( '203', '>', 20 ), ( '307', '<', 140 ) ], food_groups=[ '0100' ] )
+		self.assertEqual( [ f[0] for f in foods ], [ '01012' ] )
+		self.assertEqual( foods[0][3], { '203' : 24.6, '307' : 82.0 } )
+
+@unittest.skipIf( similarity.numpy is None, 'needs numpy' )
+class SimilarityTest( TestCase ):
+
+	def setUp( self ):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, self.directory )
+		dairy = FoodGroup.objects.create( food_group_code='0100', name='Dairy and Egg Products' )
+		fats = FoodGroup.objects.create( food_group_code='0400', name='Fats and Oils' )
+		datatype = DataType.objects.create( code='1', description='Analytical or derived from analytical' )
+		fat = NutrientDefinition.objects.create( code='204', units='g', name='Total lipid (fat)', num_decimal_places=2, sr_order=800 )
+		sodium = NutrientDefinition.objects.create( code='307', units='mg', name='Sodium, Na', num_decimal_places=0, sr_order=5800 )
+		for nbd_no, group, amounts in ( ( '01001', dairy, ( 81, 643 ) ), ( '01145', dairy, ( 81, 11 ) ),
+				( '04001', fats, ( 99, 0 ) ), ( '01077', dairy, ( 3, 43 ) ) ):
+			food = Food.objects.create( nbd_no=nbd_no, food_group=group, long_desc=nbd_no, short_desc=nbd_no )
+			for definition, amount in zip( ( fat, sodium ), amounts ):
+				Nutrient.objects.create( food=food, nutrient=definition, amount=amount, num_data_points=1, data_type=datatype )
+
+	def test_nearest_foods( self ):
+		self.assertEqual( similarity.build_index( self.directory ), ( 4, 2 ) )
+		index = similarity.SimilarityIndex( self.directory )
+		self.assertEqual( [ f for f, score in index.similar( '01145', 2, 'euclidean' ) ], [ '04001', '01077' ] )
+		self.assertEqual( [ f for f, score in index.similar( '01145', 2, 'euclidean', food_groups=[ '0100' ] ) ], [ '01077', '01001' ] )
+		self.assertEqual( [ f for f, score in index.similar( '01001', 3, less=[ '307' ], constraints=[ ( '204', '>', 50 ) ] ) ],
+				[ '01145', '04001' ] )
+
+class SnapshotTest( SimpleTestCase ):
+
+	def test_lookups_from_the_file( self ):
+		directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, directory )
+		path = os.path.join( directory, 'sr27.snapshot' )
+		writer = SnapshotWriter( path )
+		writer.write_table( FoodGroup, [ { 'food_group_code' : '0100', 'name' : 'Dairy and Egg Products' } ] )
+		writer.write_table( Food, [ { 'nbd_no' : nbd_no, 'food_group_id' : '0100', 'long_desc' : desc, 'short_desc' : desc.upper(),
+				'survey' : survey, 'refuse_percent' : refuse, 'nitrogen_factor' : factor }
+				for nbd_no, desc, survey, refuse, factor in ( ( '01001', 'Butter, salted', True, 0, Decimal( '6.38' ) ),
+					( '01002', 'Butter, whipped', None, None, None ) ) ] )
+		self.assertEqual( writer.close(), 8 )
+
+		snapshot = Snapshot( path )
+		self.addCleanup( snapshot.close )
+		foods = snapshot.table( Food )
+		self.assertEqual( len( foods ), 2 )
+		self.assertEqual( foods.get( '01001' ), { 'nbd_no' : '01001', 'food_group_id' : '0100', 'long_desc' : 'Butter, salted',
+				'short_desc' : 'BUTTER, SALTED', 'survey' : True, 'refuse_percent' : 0, 'nitrogen_factor' : Decimal( '6.38' ) } )
+		self.assertEqual( [ f[ 'nbd_no' ] for f in foods.filter( food_group_id='0100', survey=None ) ], [ '01002' ] )
+		self.assertEqual( foods.values( 'refuse_percent' ), [ 0, None ] )
+
+class FixtureTest( SimpleTestCase ):
+
+	def test_json_fixture_has_pks_and_typed_fields( self ):
+		directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, directory )
+		with zipfile.ZipFile( os.path.join( directory, 'sr27.zip' ), 'w' ) as z:
+			z.writestr( 'WEIGHT.txt', '~01001~^1^1^~pat (1" sq, 1/3" high)~^5.0^^\r\n~01001~^2^1^~tbsp~^14.2^3^0.2\r\n' )
+		path = os.path.join( directory, 'usda_gramweight.json.gz' )
+		with zipfile.ZipFile( os.path.join( directory, 'sr27.zip' ) ) as z:
+			self.assertEqual( WeightFile().to_json( z, path, compress=True ), 2 )
+		with gzip.open( path, 'rt', encoding='utf-8' ) as f:
+			records = json.load( f )
+		self.assertEqual( records[0][ 'pk' ], 1 )
+		self.assertEqual( records[1], { 'model' : 'usda.gramweight', 'pk' : 2, 'fields' : { 'food' : '01001', 'sequence' : '2',
+				'amount' : '1', 'description' : 'tbsp', 'weight' : '14.2', 'num_data_points' : 3, 'std_deviation' : '0.2' } } )
+
+	def test_synthetic_release( self ):
+		directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, directory )
+		path = os.path.join( directory, 'sr27.zip' )
+		counts = write_zip( path, scale=0.01 )
+		self.assertEqual( counts[ 'FOOD_DES.txt' ], 88 )
+		self.assertEqual( counts[ 'NUT_DATA.txt' ], 88 * 77 )
+		with zipfile.ZipFile( path ) as z:
+			rows = list( NutrientFile().typed_rows( z ) )
+		self.assertEqual( len( rows ), counts[ 'NUT_DATA.txt' ] )
+		self.assertEqual( rows[0][ 'food_id' ], '00001' )
+		self.assertEqual( rows[0][ 'last_modified' ].day, 1 )
+
+class ImportJobTest( TestCase ):
+
+	def setUp( self ):
+		cache.clear()
+		registry.invalidate()
+		self.addCleanup( registry.invalidate )
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, self.directory )
+
+	def test_shadow_tables_are_renamed_in( self ):
+		FoodGroup.objects.create( food_group_code='9900', name='Of the last release' )
+		profile = DailyValueProfile.objects.create( name='adult', is_default=True )
+		DailyValue.objects.create( profile=profile, nutrient_id='001', amount=Decimal( 50 ) )
+		path = os.path.join( self.directory, 'sr27.zip' )
+		counts = write_zip( path, scale=0.01 )
+		job = jobs.create( path, 'executemany' )
+		with mock.patch.object( similarity, 'INDEX_DIR', self.directory ):
+			jobs.run( job )
+		job = ImportJob.objects.get( pk=job.pk )
+		self.assertEqual( ( job.phase, job.active, job.rows_done ), ( ImportJob.DONE, None, sum( counts.values() ) ) )
+		self.assertEqual( job.progress()[ 'percent' ], 100.0 )
+
+		for cls in jobs.FILES:
+			self.assertEqual( cls.model.objects.count(), counts[ cls.fileName ] )
+		self.assertFalse( FoodGroup.objects.filter( pk='9900' ).exists() )
+		self.assertEqual( NutrientDefinition.objects.get( pk='001' ).daily_amount, 50 )
+		self.assertEqual( FoodDocument.objects.count(), counts[ 'FOOD_DES.txt' ] )
+		self.assertEqual( len( query.find_foods( [], limit=1000 ) ), counts[ 'FOOD_DES.txt' ] )
+		self.assertIn( '00001', search_index.search( Food.objects.get( pk='00001' ).long_desc ) )
+
+		# The live tables have their indexes and nothing else of the job is left.
+		connection = connections[ 'default' ]
+		with connection.cursor() as cursor:
+			constraints = connection.introspection.get_constraints( cursor, Nutrient._meta.db_table ).values()
+		self.assertIn( ( [ 'food_id', 'nutrient_id' ], True ), [ ( c[ 'columns' ], c[ 'unique' ] ) for c in constraints ] )
+		self.assertIn( ( [ 'nutrient_id', 'amount' ], False ), [ ( c[ 'columns' ], c[ 'unique' ] ) for c in constraints ] )
+		self.assertFalse( set( connection.introspection.table_names() ).intersection( jobs.job_tables( job ) ) )
+
+	def test_one_import_at_a_time( self ):
+		job = jobs.create( 'sr27.zip', 'executemany' )
+		# The worker thread would not see a job of an open transaction.
+		self.assertRaises( TransactionManagementError, jobs.start, 'sr27.zip' )
+		self.assertRaises( jobs.JobError, jobs.create, 'sr27.zip', 'copy' )
+		# Until its process is known to have died, which leaves its tables.
+		ImportJob.objects.filter( pk=job.pk ).update( updated=timezone.now() - datetime.timedelta( seconds=jobs.STALE_AFTER + 1 ) )
+		connection = connections[ 'default' ]
+		connection.cursor().execute( 'CREATE TABLE %s ( id integer )' % jobs.shadow_name( Food._meta.db_table, job ) )
+		jobs.create( 'sr27.zip', 'executemany' )
+		self.assertNotIn( jobs.shadow_name( Food._meta.db_table, job ), connection.introspection.table_names() )
+		self.assertEqual( list( ImportJob.objects.order_by( 'pk' ).values_list( 'phase', 'active' ) ),
+				[ ( ImportJob.FAILED, None ), ( ImportJob.QUEUED, True ) ] )
+
+	def test_failures_outside_of_run_are_recorded( self ):
+		job = jobs.create( 'sr27.zip', 'executemany' )
+		with mock.patch.object( jobs, 'run', side_effect=DatabaseError( 'No such job' ) ), \
+				mock.patch.object( jobs.connection, 'close' ), self.assertLogs( 'usda.jobs', 'ERROR' ):
+			jobs.run_in_thread( job.pk )
+		job = ImportJob.objects.get( pk=job.pk )
+		self.assertEqual( ( job.phase, job.active ), ( ImportJob.FAILED, None ) )
+		self.assertIn( 'No such job', job.error )
+
+class LoadTest( TestCase ):
+
+	def setUp( self ):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, self.directory )
+		registry.invalidate()
+
+	def write( self, name, **files ):
+		# A release zip with the given files, as lists of rows.
+		path = os.path.join( self.directory, name )
+		with zipfile.ZipFile( path, 'w' ) as z:
+			for filename, rows in files.items():
+				z.writestr( filename, ''.join( line( *row ) for row in rows ) )
+		return path
+
+	def test_full_load_with_every_loader( self ):
+		path = os.path.join( self.directory, 'sr27.zip' )
+		counts = write_zip( path, scale=0.01 )
+		for loader in sorted( LOADERS ):
+			try:
+				get_loader( loader, FoodGroup )
+			except ValueError:
+				continue # copy needs PostgreSQL.
+			with self.subTest( loader=loader ):
+				clear_tables( [ f.model for f in jobs.FILES ] )
+				with zipfile.ZipFile( path ) as z:
+					for cls in jobs.FILES:
+						self.assertEqual( cls().to_db_bulk( z, clear=False, loader=loader ), counts[ cls.fileName ] )
+				for cls in jobs.FILES:
+					self.assertEqual( cls.model.objects.count(), counts[ cls.fileName ] )
+				self.assertEqual( min( GramWeight.objects.values_list( 'pk', flat=True ) ), 1 )
+
+	def test_incremental_load( self ):
+		foods = [ ( '01001', '0100', 'Butter, salted', 'BUTTER,WITH SALT', '', '', 'Y', '', 0, '', 6.38, 4.27, 8.79, 3.87 ) ]
+		first = self.write( 'first.zip', **{ 'FD_GROUP.txt' : [ ( '0100', 'Dairy' ), ( '0200', 'Spices and Herbs' ) ],
+				'FOOD_DES.txt' : foods,
+				'WEIGHT.txt' : [ ( '01001', '1', 1, 'pat', 5.0, None, None ), ( '01001', '2', 1, 'tbsp', 14.2, None, None ),
+					( '01001', '3', 1, 'stick', 113.0, None, None ) ] } )
+		second = self.write( 'second.zip', **{ 'FD_GROUP.txt' : [ ( '0100', 'Dairy and Egg Products' ), ( '0300', 'Baby Foods' ) ],
+				'FOOD_DES.txt' : foods,
+				'WEIGHT.txt' : [ ( '01001', '1', 1, 'pat', 5.0, None, None ), ( '01001', '2', 1, 'tbsp', 14.3, None, None ),
+					( '01001', '4', 1, 'cup', 227.0, None, None ) ] } )
+		with zipfile.ZipFile( first ) as z:
+			for f in ( FoodGroupFile(), FoodFile(), WeightFile() ):
+				f.to_db_bulk( z, clear=False )
+		LoadCommand().update_incremental( [ FoodGroupFile(), FoodFile(), WeightFile() ], second, 'orm' )
+		self.assertEqual( dict( FoodGroup.objects.values_list( 'pk', 'name' ) ), { '0100' : 'Dairy and Egg Products', '0300' : 'Baby Foods' } )
+		self.assertEqual( list( Food.objects.values_list( 'pk', flat=True ) ), [ '01001' ] )
+		# Unchanged and changed rows keep their pk, added ones get new ones.
+		self.assertEqual( list( GramWeight.objects.order_by( 'pk' ).values_list( 'pk', 'sequence', 'weight' ) ),
+				[ ( 1, '1', Decimal( '5.0' ) ), ( 2, '2', Decimal( '14.3' ) ), ( 4, '4', Decimal( '227.0' ) ) ] )
+
+	def test_changes_take_one_statement_per_table( self ):
+		FoodGroup.objects.bulk_create( [ FoodGroup( food_group_code='%04d' % i, name='Group %d' % i ) for i in range( 50 ) ] )
+		food = Food.objects.create( nbd_no='01001', food_group_id='0001', long_desc='Butter, salted', short_desc='BUTTER,WITH SALT' )
+		GramWeight.objects.create( food=food, sequence='1', amount=Decimal( 1 ), description='pat', weight=Decimal( 5 ) )
+		# The temporary table, the rows loaded into it in a savepoint, the
+		# update and the drop.
+		with self.assertNumQueries( 6 ):
+			FoodGroupFile().update_rows( [ FoodGroup._meta.get_field( 'name' ) ],
+					[ { 'food_group_code' : '%04d' % i, 'name' : 'Renamed %d' % i } for i in range( 50 ) ], 'orm' )
+		self.assertEqual( FoodGroup.objects.filter( name__startswith='Renamed' ).count(), 50 )
+		# The groups, their foods and the seven tables referencing foods.
+		with self.assertNumQueries( 9 ):
+			FoodGroupFile().delete_rows( [ '%04d' % i for i in range( 40 ) ] )
+		self.assertEqual( ( FoodGroup.objects.count(), Food.objects.count(), GramWeight.objects.count() ), ( 10, 0, 0 ) )
+
+	def test_unknown_references_are_reported( self ):
+		path = self.write( 'sr27.zip', **{ 'FD_GROUP.txt' : [ ( '0100', 'Dairy and Egg Products' ) ],
+				'FOOD_DES.txt' : [ ( '01001', '9900', 'Butter, salted', 'BUTTER,WITH SALT', '', '', '', '', 0, '', None, None, None, None ) ] } )
+		with zipfile.ZipFile( path ) as z:
+			FoodGroupFile().to_db_bulk( z, clear=False )
+			with self.assertRaisesRegex( CommandError, "FOOD_DES.txt references unknown FoodGroup '9900' in column food_group" ):
+				FoodFile().to_db_bulk( z, clear=False )
+
+	def test_dependency_order( self ):
+		order = dependency_order( [ Nutrient, GramWeight, Food, NutrientDefinition, FoodGroup, DataType ] )
+		for parent, child in ( ( FoodGroup, Food ), ( Food, Nutrient ), ( Food, GramWeight ), ( NutrientDefinition, Nutrient ),
+				( DataType, Nutrient ) ):
+			self.assertLess( order.index( parent ), order.index( child ) )
+		self.assertEqual( with_dependents( [ DataType ] ), set( [ DataType, Nutrient ] ) )
+		self.assertEqual( with_dependents( [ FoodGroup ] ), set( [ FoodGroup, Food, Nutrient, GramWeight, Footnote, LanguaLFactor,
+				DataSourceLink, FoodDocument ] ) )
+		# The daily values outlive their nutrient definitions.
+		self.assertEqual( with_dependents( [ NutrientDefinition ] ), set( [ NutrientDefinition, Nutrient, Footnote, DataSourceLink ] ) )
+
+@override_settings( ROOT_URLCONF='usda.tests' )
+class KeysetPageTest( TestCase ):
+
+	def setUp( self ):
+		cache.clear()
+		group = FoodGroup.objects.create( food_group_code='0100', name='Dairy and Egg Products' )
+		for i in range( 250 ):
+			Food.objects.create( nbd_no='%05d' % i, food_group=group, long_desc='Food %d' % i, short_desc='FOOD %03d' % ( i % 120 ) )
+
+	def test_pages_follow_each_other( self ):
+		factory = RequestFactory()
+		page, number = get_keyset_page( factory.get( '/usda/' ), Food.objects.all(), 'test' )
+		seen = [ f.nbd_no for f in page.object_list ]
+		self.assertEqual( page.num_pages, 3 )
+		self.assertFalse( page.has_previous() )
+		while page.has_next():
+			with self.assertNumQueries( 1 ):
+				page, number = get_keyset_page( factory.get( '/usda/?' + page.next_query ), Food.objects.all(), 'test' )
+			seen.extend( f.nbd_no for f in page.object_list )
+		self.assertEqual( number, 3 )
+		expected = Food.objects.order_by( 'short_desc', 'nbd_no' ).values_list( 'nbd_no', flat=True )
+		self.assertEqual( seen, list( expected ) )
+
+		page, number = get_keyset_page( factory.get( '/usda/?' + page.previous_query ), Food.objects.all(), 'test' )
+		self.assertEqual( number, 2 )
+		self.assertEqual( [ f.nbd_no for f in page.object_list ], seen[ 100:200 ] )
@@ -1,10 +1,20 @@
 from django.conf.urls import patterns, url, include
 
 
-from usda import views
+from usda import api, views
+from usda.instrumentation import metrics_view
 
 urlpatterns = patterns('',
 	#url(r"^(\d+)/$", views.show_food, name="show" ),
 	url(r"^food/(?P<pk>\d+)/$", views.FoodDetail.as_view(), name="show_food" ),
+	url(r"^nutrients/$", views.nutrient_search, name="nutrients" ),
+	url(r"^api/food/(?P<pk>\d+)/$", api.food, name="api_food" ),
+	url(r"^api/foods/$", api.batch, name="api_foods" ),
+	url(r"^api/search/$", api.search, name="api_search" ),
+	url(r"^api/recipes/$", api.recipes, name="api_recipes" ),
+	url(r"^api/similar/(?P<pk>\d+)/$", api.similar, name="api_similar" ),
+	url(r"^api/imports/$", api.imports, name="api_imports" ),
+	url(r"^api/imports/(?P<pk>\d+)/$", api.import_job, name="api_import" ),
+	url(r"^metrics/$", metrics_view, name="metrics" ),
 	url(r"^$", views.main, name="main"),
 )
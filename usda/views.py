@@ -1,10 +1,19 @@
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import get_object_or_404
 from django import forms
-from usda.models import Food, Nutrient, FoodGroup, GramWeight, Footnote, DataSourceLink, LanguaLFactor
+from usda.models import Food
+from usda.caching import versioned_key, versioned_page
+from usda.instrumentation import instrumented, render, timed
+from usda import documents, fanout, query, registry
+from usda import search as search_index
+from usda.search import RankedFoods
+from django.core.cache import cache
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db.models import Q
 from django.http import Http404
+from django.utils.http import urlencode
+from django.db import DatabaseError
+from django.utils.decorators import method_decorator
 from django.views.generic import DetailView
-from decimal import *
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,83 +21,175 @@ logger = logging.getLogger(__name__)
 # Create your views here.
 class SearchForm( forms.Form ):
 	food = forms.CharField( max_length=100, required=False )
-	food_group = forms.ModelMultipleChoiceField( queryset=FoodGroup.objects.all(), required=False )
+	food_group = forms.MultipleChoiceField( required=False )
 
-class NutrientData( object ):
-	nutrient = None
-	footnotes = None
-	datasourcelinks = None
+	def __init__( self, *args, **kwargs ):
+		super( SearchForm, self ).__init__( *args, **kwargs )
+		self.fields[ 'food_group' ].choices = registry.food_group_choices()
 
-class WeightData( object ):
-	grams = None
-	description = None
-	amount = None
-	daily_value = None
+class NutrientQueryForm( forms.Form ):
+	nutrients = forms.CharField( max_length=200, label='Per 100g',
+			help_text='Nutrient codes or tagnames with a limit, e.g. 203 > 20, NA < 140' )
+	food_group = forms.MultipleChoiceField( required=False )
+	order_by = forms.ChoiceField( required=False )
+	ascending = forms.BooleanField( required=False )
+
+	def __init__( self, *args, **kwargs ):
+		super( NutrientQueryForm, self ).__init__( *args, **kwargs )
+		self.fields[ 'food_group' ].choices = registry.food_group_choices()
+		self.fields[ 'order_by' ].choices = [ ( '', '---------' ) ] + registry.nutrient_choices()
+
+	def clean_nutrients( self ):
+		try:
+			return query.parse_predicates( self.cleaned_data[ 'nutrients' ] )
+		except query.QueryError as e:
+			raise forms.ValidationError( str( e ) )
 
 class FoodDetail( DetailView ):
+	# Shows the precomputed document of the food, see usda.documents.
 	context_object_name = 'food'
 	template_name = 'usda/food.html'
-	model = Food
+
+	@method_decorator( instrumented( 'food' ) )
+	@method_decorator( versioned_page )
+	def dispatch( self, *args, **kwargs ):
+		return super( FoodDetail, self ).dispatch( *args, **kwargs )
+
+	def get_object( self, queryset=None ):
+		document = documents.get_document( self.kwargs[ 'pk' ] )
+		if document is None:
+			raise Http404( 'No food %s' % self.kwargs[ 'pk' ] )
+		return document
 
 	def get_context_data( self, **kwargs ):
 		context = super( FoodDetail, self ).get_context_data( **kwargs )
 		food = context[ 'food' ]
-		weights = GramWeight.objects.filter( food = food )
-		context[ 'weights' ] = weights
-		context[ 'langual' ] = LanguaLFactor.objects.filter( food = food )
-		nutrients = Nutrient.objects.filter( food = food ).order_by( 'nutrient__sr_order' )
-		context[ 'nutrients' ] = nutrients
-		nutrient_data = []
-		for n in nutrients:
-			data = NutrientData()
-			data.footnotes = Footnote.objects.filter( food = food, nutrient_definition = n.nutrient )
-			data.datasourcelinks = DataSourceLink.objects.filter( food = food, nutrient_definition = n.nutrient )
-			data.nutrient = n
-			data.weight_data = []
-			weight = WeightData()
-			weight.grams = Decimal( 100 )
-			weight.description = 'Value per'
-			data.weight_data.append( weight )
-			for w in weights:
-				weight = WeightData()
-				weight.grams = w.weight
-				weight.description = '%d %s' % ( w.amount, w.description )
-				data.weight_data.append( weight )
-
-			for w in data.weight_data:
-				w.amount = w.grams / Decimal( 100 ) * n.amount
-				if n.nutrient.daily_amount:
-					w.daily_value = round( ( w.amount / n.nutrient.daily_amount) * 100, 1 )
-
-			nutrient_data.append( data )
-		context[ 'nutrient_data' ] = nutrient_data
+		context[ 'weights' ] = documents.weight_entries( food )
+		context[ 'langual' ] = food[ 'langual' ]
+		# ?dv=<name> shows the %DV of another daily value profile.
+		profile = self.request.GET.get( 'dv' )
+		try:
+			daily_amounts = registry.daily_value_profile( profile ) if profile else None
+		except KeyError:
+			raise Http404( 'No daily value profile %s' % profile )
+		context[ 'nutrients' ] = documents.nutrient_entries( food, daily_amounts=daily_amounts )
+		context[ 'profiles' ] = registry.daily_value_profiles()
+		context[ 'profile' ] = profile or registry.registry.default_profile
 		return context
 
+PAGE_SIZE = 100
+COUNT_CACHE_TIMEOUT = 24 * 60 * 60
+
+class KeysetPage( object ):
+	# A page of foods ordered by ( short_desc, nbd_no ). It is found by
+	# seeking past the last ( or before the first ) food of the page the
+	# user came from, so any page costs the same as the first one.
+	def __init__( self, object_list, number, num_pages, has_next, has_previous ):
+		self.object_list = object_list
+		self.number = number
+		self.num_pages = num_pages
+		self.next_query = None
+		self.previous_query = None
+		if has_next and object_list:
+			self.next_query = urlencode( { 'page' : number + 1, 'after' : cursor( object_list[ -1 ] ) } )
+		if has_previous and object_list:
+			self.previous_query = urlencode( { 'page' : max( number - 1, 1 ), 'before' : cursor( object_list[ 0 ] ) } )
+
+	def has_next( self ):
+		return self.next_query is not None
+
+	def has_previous( self ):
+		return self.previous_query is not None
+
+def cursor( food ):
+	return '%s:%s' % ( food.nbd_no, food.short_desc )
+
+def parse_cursor( value ):
+	nbd_no, sep, short_desc = value.partition( ':' )
+	if not sep:
+		return None
+	return short_desc, nbd_no
+
+def cached_count( objs, key ):
+	# Counts only change with an import, so one COUNT(*) per search is enough.
+	key = versioned_key( 'count', key )
+	count = cache.get( key )
+	if count is None:
+		count = objs.count()
+		cache.set( key, count, COUNT_CACHE_TIMEOUT )
+	return count
+
+@timed( 'paginate' )
+def get_keyset_page( request, objs, count_key ):
+	try:
+		number = max( int( request.GET.get( 'page', 1 ) ), 1 )
+	except ValueError:
+		number = 1
+	after = parse_cursor( request.GET.get( 'after', '' ) )
+	before = parse_cursor( request.GET.get( 'before', '' ) )
+	base = objs
+	objs = objs.select_related( 'food_group' )
+	if before:
+		short_desc, nbd_no = before
+		objs = objs.filter( Q( short_desc__lt=short_desc ) | Q( short_desc=short_desc, nbd_no__lt=nbd_no ) ).order_by( '-short_desc', '-nbd_no' )
+	else:
+		if after:
+			short_desc, nbd_no = after
+			objs = objs.filter( Q( short_desc__gt=short_desc ) | Q( short_desc=short_desc, nbd_no__gt=nbd_no ) )
+		else:
+			number = 1
+		objs = objs.order_by( 'short_desc', 'nbd_no' )
+	# The page and, unless it is cached, the count of the search at once.
+	results = fanout.fetch( rows=lambda: list( objs[ :PAGE_SIZE + 1 ] ), count=lambda: cached_count( base, count_key ) )
+	rows = results[ 'rows' ]
+	if before:
+		has_previous = len( rows ) > PAGE_SIZE
+		rows = rows[ :PAGE_SIZE ]
+		rows.reverse()
+		has_next = True
+	else:
+		has_next = len( rows ) > PAGE_SIZE
+		rows = rows[ :PAGE_SIZE ]
+		has_previous = after is not None
+	if not has_previous:
+		number = 1
+	num_pages = max( ( results[ 'count' ] + PAGE_SIZE - 1 ) // PAGE_SIZE, 1 )
+	return KeysetPage( rows, min( number, num_pages ), num_pages, has_next, has_previous ), number
+
+@timed( 'paginate' )
 def get_page( request, objs ):
+	paginator = Paginator( objs, PAGE_SIZE )
 	try:
 		page = int( request.GET.get("page", 1 ) )
-		paginator = Paginator( objs, 100)
 		objs = paginator.page(page)
-	except (InvalidPage, EmptyPage):
+	except (InvalidPage, EmptyPage, ValueError):
 		objs = paginator.page(1)
 		page = 1
+	objs.num_pages = paginator.num_pages
+	objs.next_query = urlencode( { 'page' : page + 1 } )
+	objs.previous_query = urlencode( { 'page' : page - 1 } )
 	return objs, page
 
+@instrumented( 'main' )
+@versioned_page
 def main(request):
 	form = SearchForm()
 	food_query = Food.objects.all()
+	ranked = False
+	count_key = ''
 
 	if request.GET.items():
 		form = SearchForm( request.GET )
 		if form.is_valid():
 			group_search = form.cleaned_data[ 'food_group' ]
 			if group_search:
-				fg = FoodGroup.objects.filter( pk__in=group_search ).order_by( 'name' )
-				food_query = food_query.filter( food_group__in=group_search ).order_by("short_desc")
+				food_query = food_query.filter( food_group__in=group_search )
+				count_key = ','.join( sorted( group_search ) )
 
 			food_search = form.cleaned_data[ 'food' ]
 			if food_search:
-				food_query = food_query.filter( short_desc__icontains=food_search).order_by("short_desc")
+				food_query = RankedFoods( search_index.search( food_search, group_search ) )
+				ranked = True
 		else:
 			print( 'invalid form %s' % form.errors )
 			form = SearchForm()
@@ -96,11 +197,39 @@ def main(request):
 		form = SearchForm()
 
 	qd = request.GET.copy()
-	if 'page' in qd:
-		qd.pop( 'page' )
+	for key in ( 'page', 'after', 'before' ):
+		if key in qd:
+			qd.pop( key )
 	search = qd.urlencode()
-	food, page = get_page( request, food_query )
+	if ranked:
+		food, page = get_page( request, food_query )
+	else:
+		food, page = get_keyset_page( request, food_query, count_key )
 	search = request.path + '?' + search
 	logger.info( 'Showing search = %s : page = %d' % ( search, page ) )
 	return render(request, "usda/main.html" , { 'food' : food , 'url' : search, 'user' : request.user, 'form' : form } )
 
+
+@instrumented( 'nutrients' )
+@versioned_page
+def nutrient_search( request ):
+	form = NutrientQueryForm( request.GET or None )
+	foods = []
+	columns = []
+	error = None
+	if form.is_valid():
+		predicates = form.cleaned_data[ 'nutrients' ]
+		order_by = form.cleaned_data[ 'order_by' ] or None
+		try:
+			foods = query.find_foods( predicates, form.cleaned_data[ 'food_group' ], order_by,
+					descending=not form.cleaned_data[ 'ascending' ] )
+		except DatabaseError:
+			logger.exception( 'Nutrient query failed' )
+			error = 'The nutrient index has not been built yet, run load_sr27 to build it.'
+		codes = [ p[0] for p in predicates ]
+		if order_by and order_by not in codes:
+			codes.append( order_by )
+		definitions = registry.nutrient_definitions()
+		columns = [ definitions[ c ] for c in codes ]
+		foods = [ ( nbd_no, short_desc, [ amounts.get( c ) for c in codes ] ) for nbd_no, short_desc, group, amounts in foods ]
+	return render( request, "usda/nutrients.html", { 'form' : form, 'foods' : foods, 'columns' : columns, 'error' : error } )